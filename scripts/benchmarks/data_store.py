@@ -0,0 +1,119 @@
+import time
+import random
+import marshal
+
+from scripts.server.data_store import DataStore
+
+class NestedDataStore:
+    '''
+    The original nested-dict store/get. Kept here only as the baseline for
+    comparison.
+    '''
+    def __init__(self):
+        self.anonymous_data = {}
+
+    def store(self, body):
+        keys, payload = body["keys"], body["payload"]
+        dict_ = self.anonymous_data
+        for key in keys[:-1]:
+            if key not in dict_ or not isinstance(dict_[key], dict):
+                dict_[key] = {}
+            dict_ = dict_[key]
+        dict_[keys[-1]] = payload
+
+    def get(self, keys, default=None):
+        dict_ = self.anonymous_data
+        if not keys:
+            return dict_
+        for key in keys[:-1]:
+            if key not in dict_ or not isinstance(dict_[key], dict):
+                return default
+            dict_ = dict_[key]
+        return dict_.get(keys[-1], default)
+
+def check_same(rng, ops=20000):
+    '''
+    Random stores and gets over a small key space (so paths keep replacing
+    each other's parents and children), checking both stores agree.
+    '''
+    nested, indexed = NestedDataStore(), DataStore()
+    keys = ["a", "b", "c", 1, 2]
+    for _ in range(ops):
+        path = [rng.choice(keys) for _ in range(rng.randint(1, 4))]
+        if rng.random() < 0.6:
+            payload = rng.choice([rng.randint(0, 9), "x", [1, 2], {}, {"a": 1, "b": {"c": 2}}, {rng.choice(keys): {}}])
+            body = {"keys": path, "payload": payload}
+            nested.store(dict(body))
+            indexed.store(dict(body))
+        else:
+            assert nested.get(path) == indexed.get(path), path
+    assert nested.get([]) == indexed.get([])
+
+def timed(func, count):
+    start = time.perf_counter()
+    func()
+    return count / (time.perf_counter() - start)
+
+def main(players=20000, lookups=200000):
+    rng = random.Random(0)
+    check_same(rng)
+    ids = [f"[U:1:{1000000 + i}]" for i in range(players)]
+    records = {steam_id: {"name": f"Player {i}", "kills": i * 3, "deaths": i, "verified": i % 2 == 0} for i, steam_id in enumerate(ids)}
+    picks = [rng.choice(ids) for _ in range(lookups)]
+
+    print(f"{'operation':>26} {'nested ops/s':>14} {'indexed ops/s':>14} {'ratio':>7}")
+    results = []
+    for store in (NestedDataStore(), DataStore()):
+        rates = {}
+        def store_records():
+            for steam_id, record in records.items():
+                store.store({"keys": ["players", steam_id], "payload": dict(record)})
+        rates["store new record"] = timed(store_records, players)
+
+        def store_leaf():
+            for steam_id in picks:
+                store.store({"keys": ["players", steam_id, "kills"], "payload": 1})
+        rates["overwrite leaf"] = timed(store_leaf, lookups)
+
+        def get_leaf():
+            for steam_id in picks:
+                store.get(["players", steam_id, "kills"])
+        rates["get leaf"] = timed(get_leaf, lookups)
+
+        def get_record():
+            for steam_id in picks[:lookups // 10]:
+                store.get(["players", steam_id])
+        rates["get record"] = timed(get_record, lookups // 10)
+
+        # Paging through every player, 100 at a time, the way a plugin would
+        # have to (the nested store can only hand over the whole dict)
+        pages = players // 100
+        if isinstance(store, NestedDataStore):
+            def page_players():
+                for page in range(pages):
+                    everyone = store.get(["players"])
+                    dict(list(everyone.items())[page * 100:(page + 1) * 100])
+        else:
+            def page_players():
+                after = None
+                for _ in range(pages):
+                    _, after = store.scan(["players"], limit=100, after=after)
+        rates["page of 100 players"] = timed(page_players, pages)
+
+        if isinstance(store, NestedDataStore):
+            def subtree_size():
+                for steam_id in picks[:lookups // 10]:
+                    len(marshal.dumps(store.get(["players", steam_id])))
+        else:
+            def subtree_size():
+                for steam_id in picks[:lookups // 10]:
+                    store.size(["players", steam_id])
+        rates["size of record"] = timed(subtree_size, lookups // 10)
+        results.append(rates)
+
+    nested, indexed = results
+    for name in nested:
+        print(f"{name:>26} {nested[name]:>14,.0f} {indexed[name]:>14,.0f} {indexed[name] / nested[name]:>6.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import time
+import random
+
+from scripts.server.event_engine import EventEngine
+
+SAMPLE_LINES = [
+    'L 05/03/2025 - 01:36:24: "BOT Brokstone<193><BOT><Bandidos>" triggered "combat" (notoriety "17")',
+    'L 05/03/2025 - 01:36:25: "BOT Brokstone<193><BOT><Bandidos>" killed "BOT Kowalski<190><BOT><Rangers>" with "arrow" (headshot) (attacker_position "306 755 380") (victim_position "-150 361 280")',
+    'L 05/03/2025 - 01:36:26: "Scarfy<132><[U:1:1234567]><Vigilantes>" say "!verify Ab12Cd34"',
+    'L 05/03/2025 - 01:36:27: "Scarfy<129><[U:1:1234567]><Bandidos>" say_team "wha"',
+    'L 05/03/2025 - 01:36:28: server_cvar: "sm_nextmap" "fof_sweetwater"',
+    '-------- Mapchange to fof_fistful --------',
+    'Loading map "fof_sweetwater"',
+    'L 05/03/2025 - 01:36:29: [META] Loaded 0 plugins (1 already loaded)',
+    'L 05/03/2025 - 01:36:30: "BOT Mezcal<188><BOT><Desperados>" committed suicide with "world"',
+    'Connection to Steam servers successful.',
+]
+
+class LegacyEventEngine(EventEngine):
+    '''
+    The original process_line, which evaluates every registered condition
+    against every line. Kept here only as the baseline for comparison.
+    '''
+    def process_line(self, text):
+        loginfo = ""
+        if not text.startswith("L ") or len(text) <= 25 or text[12:15] != " - " or text[23:25] != ": ":
+            loginfo = ""
+        else:
+            loginfo = text[:25]
+            text = text[25:]
+
+        satisfaction = {k: len(v) for k, v in self.callback_registry.items()}
+        for condition, callbacks in self.condition_registry.items():
+            type_, val = condition
+            matches = True
+            if type_ == 'logged':
+                matches = str(loginfo != "") == val
+            elif type_ == 'regex':
+                matches = self.compiled_regex[val].search(text)
+            elif type_ == 'match':
+                matches = val in text
+            elif type_ == 'exclude':
+                matches = val not in text
+            elif type_ == 'startswith':
+                matches = text.startswith(val)
+            elif type_ == 'endswith':
+                matches = text.endswith(val)
+            elif type_ == 'equal':
+                matches = text == val
+            if matches:
+                for callback in callbacks:
+                    satisfaction[callback] -= 1
+
+        triggered = []
+        for callback, complete in satisfaction.items():
+            if complete == 0:
+                triggered.append(callback)
+        return text, loginfo, triggered
+
+def make_registry(count, rng):
+    '''
+    Builds a registry of `count` events shaped like the ones the plugins use,
+    with enough variety that most conditions are distinct.
+    '''
+    registry = {}
+    for i in range(count):
+        kind = i % 6
+        if kind == 0:
+            conds = {"startswith": "-------- Mapchange to " if i % 2 else f"Loading map \"fof_{i}", "exclude": "say"}
+        elif kind == 1:
+            conds = {"match": f"say \"!cmd{i} ", "logged": "True"}
+        elif kind == 2:
+            conds = {"match": f"with \"weapon{rng.randint(0, count)}\"", "exclude": "headshot"}
+        elif kind == 3:
+            conds = {"endswith": f"plugins ({i} already loaded)"}
+        elif kind == 4:
+            conds = {"equal": f"Connection to Steam servers {i}."}
+        else:
+            conds = {"regex": rf'"(.+?)<(\d+)><(\[U:\d+:\d+\]|BOT)><(.*?)>" say "!cmd{i} (\w+)"'}
+        registry[f"event_{i}"] = conds
+    return registry
+
+def run(engine, lines, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            engine.process_line(line)
+    return len(lines) * repeat / (time.perf_counter() - start)
+
+def main(sizes=(10, 100, 1000), repeat=2000):
+    rng = random.Random(0)
+    print(f"{'events':>8} {'legacy lines/s':>16} {'indexed lines/s':>16} {'speedup':>8}")
+    for size in sizes:
+        registry = make_registry(size, rng)
+        legacy, indexed = LegacyEventEngine(), EventEngine()
+        legacy.register("bench", {"registry": registry})
+        indexed.register("bench", {"registry": registry})
+
+        # Sanity check that both engines agree before timing them
+        for line in SAMPLE_LINES:
+            assert sorted(legacy.process_line(line)[2]) == sorted(indexed.process_line(line)[2]), line
+
+        lines_repeat = max(1, repeat * 10 // size)
+        legacy_rate = run(legacy, SAMPLE_LINES, lines_repeat)
+        indexed_rate = run(indexed, SAMPLE_LINES, lines_repeat)
+        print(f"{size:>8} {legacy_rate:>16,.0f} {indexed_rate:>16,.0f} {indexed_rate / legacy_rate:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import os
+import time
+import asyncio
+import tempfile
+import statistics
+
+from scripts.server.fof_server_event_handler import FofServerEventHandler
+from scripts.client.fofclient import FofClient
+
+class FakeServer:
+    '''
+    Stands in for the game server: lines are put in by hand, and commands
+    are only timestamped.
+    '''
+    def __init__(self):
+        self.lines = asyncio.Queue()
+        self.commands = {}
+
+    async def start(self): pass
+    async def shutdown(self): pass
+    def stats(self): return {}
+
+    async def read_batches(self):
+        while True:
+            batch = [await self.lines.get()]
+            while not self.lines.empty():
+                batch.append(self.lines.get_nowait())
+            yield batch
+
+    def command(self, command, capture=False):
+        self.commands[command] = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+class Redirect:
+    '''
+    The kind of plugin that has to be quick: sends a changelevel as soon as
+    it sees a map change. Runs the same way in the hub and over a socket.
+    '''
+    async def start(self, client):
+        async def setup(client):
+            await client.register_event("on_mapchange", startswith="-------- Mapchange to ")
+
+        client.on_connect(setup)
+
+        @client.on_event("on_mapchange")
+        async def on_mapchange(message):
+            await client.command(f"changelevel {message['data'].split()[-2]}")
+
+        await client.run()
+
+async def measure(server, prefix, lines):
+    latencies = []
+    for i in range(lines):
+        level = f"{prefix}_{i}"
+        sent = time.perf_counter()
+        await server.lines.put(f"-------- Mapchange to {level} --------")
+        # And some output nobody's interested in, like a real server
+        for _ in range(5):
+            await server.lines.put("L 01/01/2025 - 00:00:00: \"Player<2><[U:1:1000>\" say \"gg\"")
+        command = f"changelevel {level}"
+        while command not in server.commands:
+            await asyncio.sleep(0)
+        latencies.append((server.commands[command] - sent) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99)]
+
+async def main(lines=2000, port=9390):
+    server = FakeServer()
+    socket_path = os.path.join(tempfile.gettempdir(), f"fof-bench-{os.getpid()}.sock")
+    handler = FofServerEventHandler(server, "127.0.0.1", port, unix_socket=socket_path)
+    # Just the parts of start() the benchmark needs
+    handler.stop_event = asyncio.Event()
+    handler.running = 1
+    handler.match_pool.start(asyncio.get_running_loop())
+    tcp = await asyncio.start_server(handler.protocol.handle_client, "127.0.0.1", port)
+    await handler.start_unix_server()
+    pump = asyncio.create_task(handler.dispatch_log_events(None, server))
+
+    print(f"{'plugin runs':>16} {'median ms':>10} {'p99 ms':>10}")
+    results = {}
+
+    client = await handler.local_plugins.add("redirect", Redirect())
+    results["in the hub"] = await measure(server, "local", lines)
+    handler.protocol.event_engine.unregister_all_for_addr(client.addr)
+
+    for transport in ("unix", "tcp"):
+        client = FofClient(port=port, transport=transport, unix_socket=socket_path)
+        plugin = asyncio.create_task(Redirect().start(client))
+        # Give it a moment to connect and register
+        while not handler.protocol.clients:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+        results[f"over {transport}"] = await measure(server, transport, lines)
+        plugin.cancel()
+        await client.disconnect()
+        while handler.protocol.clients:
+            await asyncio.sleep(0.01)
+
+    for name, (median, p99) in results.items():
+        print(f"{name:>16} {median:>10.3f} {p99:>10.3f}")
+
+    pump.cancel()
+    await handler.local_plugins.stop()
+    tcp.close()
+    await handler.stop_unix_server()
+    handler.match_pool.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
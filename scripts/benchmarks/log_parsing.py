@@ -0,0 +1,106 @@
+import time
+import random
+
+from scripts.log_parsing import EVENT_PATTERNS, check_known_events
+
+def linear_check_known_events(line):
+    '''
+    The original check_known_events, which tries every pattern in order.
+    Kept here only as the baseline for comparison.
+    '''
+    for name, event in EVENT_PATTERNS.items():
+        if name == "timestamp": continue
+        match = event.pattern.match(line)
+        if match:
+            return event.name, event.extractor(match.groups())
+    return None, None
+
+TEAMS = ["Vigilantes", "Desperados", "Bandidos", "Rangers", "Unassigned", ""]
+WEAPONS = ["arrow", "coltnavy", "peacemaker", "henryrifle", "sawedoff_shotgun", "world"]
+MAPS = ["fof_fistful", "fof_depot", "fof_sweetwater", "fof_creepycreek"]
+
+def make_actor(rng):
+    if rng.random() < 0.5:
+        name, steam_id = f"BOT {rng.choice(['Mezcal', 'Brokstone', 'Kowalski', 'Gypsy'])}", "BOT"
+    else:
+        name, steam_id = rng.choice(["Scarfy", "Northern Star", "a <b> c", 'quote"d']), f"[U:1:{rng.randint(1000, 99999999)}]"
+    return f'"{name}<{rng.randint(2, 2000)}><{steam_id}><{rng.choice(TEAMS)}>"'
+
+# (weight, line) - roughly how often each kind of line shows up in a busy server's output
+TEMPLATES = [
+    (30, lambda r: f'{make_actor(r)} triggered "combat" (notoriety "{r.randint(-20, 40)}")'),
+    (20, lambda r: f'{make_actor(r)} killed {make_actor(r)} with "{r.choice(WEAPONS)}"{r.choice(["", " (headshot)"])} (attacker_position "{r.randint(-999, 999)} 755 380") (victim_position "-150 {r.randint(-999, 999)} 280")'),
+    (8, lambda r: f'{make_actor(r)} say "{r.choice(["gg", "!rtv", "!verify Ab12Cd34", "nice shot"])}"'),
+    (3, lambda r: f'{make_actor(r)} say_team "{r.choice(["go", "wha"])}"'),
+    (3, lambda r: f'{make_actor(r)} committed suicide with "{r.choice(WEAPONS)}"'),
+    (2, lambda r: f'{make_actor(r)} entered the game'),
+    (2, lambda r: f'{make_actor(r)} joined team "{r.choice(TEAMS)}"'),
+    (2, lambda r: f'{make_actor(r)} disconnected (reason "Kicked from server")'),
+    (2, lambda r: f'"BOT Mezcal<{r.randint(2, 2000)}><BOT><>" connected, address "none"'),
+    (1, lambda r: f'"Scarfy<{r.randint(2, 2000)}><[U:1:1234]><>" STEAM USERID validated'),
+    (1, lambda r: f'{make_actor(r)} changed name to "yellowbelliedcoward"'),
+    (2, lambda r: f'server_cvar: "sm_nextmap" "{r.choice(MAPS)}"'),
+    (2, lambda r: f'"sm_super_kick_version" = "1.10.{r.randint(0, 9)}"'),
+    (1, lambda r: f'Loading map "{r.choice(MAPS)}"'),
+    (1, lambda r: f'Started map "{r.choice(MAPS)}" (CRC "6863ca2417cb94ea3e1999d2305795fc")'),
+    (1, lambda r: '[META] Loaded 0 plugins (1 already loaded)'),
+    (1, lambda r: f'Scarfy                             {r.randint(0, 900)}       36       26       7        71.57% 2          1204'),
+    (1, lambda r: '========== Stats For Team VIGILANTES Score: 0  Avg Skill: <1/5 - Why go on killing?> ==========='),
+    (1, lambda r: 'Connection to Steam servers successful.'),
+    (1, lambda r: 'Log file closed.'),
+    # Output none of the patterns are for
+    (6, lambda r: f'-------- Mapchange to {r.choice(MAPS)} --------'),
+    (5, lambda r: f'{make_actor(r)} picked up "{r.choice(WEAPONS)}"'),
+    (4, lambda r: 'Sending heartbeat to master server'),
+    (3, lambda r: f'Writing cfg/banned_user.cfg. {r.randint(0, 99)}'),
+]
+
+def make_corpus(rng, lines):
+    weights = [weight for weight, _ in TEMPLATES]
+    makers = [maker for _, maker in TEMPLATES]
+    return [maker(rng) for maker in rng.choices(makers, weights, k=lines)]
+
+def check_same(rng, corpus, mutations=20000):
+    '''
+    Checks both give the same answer for the corpus, for names built to
+    look like the end of an actor block, and for lines spliced together from
+    pieces of others (so several patterns' keywords show up in one line).
+    '''
+    tricky = [
+        '"a<1><BOT><>" say "hi<5><BOT><>" joined team "X"',
+        '"x<1><BOT><>" entered the game<2><BOT><T>" say "y"',
+        '"n<1><BOT><T>" killed "m<2><BOT><T>" with "say" (attacker_position "1") (victim_position "2") say "x"',
+        '"k" = "v<1><BOT><T>" say "z"',
+        '"p<1><BOT><>" connected, address "none" committed suicide with "x"',
+        '=== x was kicked due high ping or unreliable connection (ping 1 loss 0) === Stats For Team A Score: 1  Avg Skill: <1/5 - x> =',
+        ' \t Public IP is 1.2.3.4.',
+        '',
+    ]
+    for line in corpus + tricky:
+        assert linear_check_known_events(line) == check_known_events(line), line
+    for _ in range(mutations):
+        a, b = rng.choice(corpus), rng.choice(corpus)
+        line = a[:rng.randint(0, len(a))] + b[rng.randint(0, len(b)):]
+        assert linear_check_known_events(line) == check_known_events(line), line
+
+def timed(func, corpus):
+    start = time.perf_counter()
+    for line in corpus:
+        func(line)
+    return len(corpus) / (time.perf_counter() - start)
+
+def main(lines=200000):
+    rng = random.Random(0)
+    corpus = make_corpus(rng, lines)
+    check_same(rng, corpus[:20000])
+
+    unmatched = [line for line in corpus if linear_check_known_events(line)[0] is None]
+    print(f"{lines} lines, {len(unmatched)} not matching any pattern")
+    print(f"{'lines':>16} {'linear lines/s':>16} {'prefiltered lines/s':>20} {'ratio':>7}")
+    for name, lines_ in (("whole corpus", corpus), ("unmatched only", unmatched)):
+        before = timed(linear_check_known_events, lines_)
+        after = timed(check_known_events, lines_)
+        print(f"{name:>16} {before:>16,.0f} {after:>20,.0f} {after / before:>6.2f}x")
+
+if __name__ == "__main__":
+    main()
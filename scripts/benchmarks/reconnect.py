@@ -0,0 +1,97 @@
+import time
+import asyncio
+
+from scripts.server.fof_server_event_handler import FofServerEventHandler
+from scripts.client.fofclient import FofClient
+
+class OldClient(FofClient):
+    '''
+    The old reconnect: the same wait every time, and one register packet per
+    event. Kept here only as the baseline for comparison.
+    '''
+    def _reconnect_wait(self, attempt, reconnect_delay):
+        return reconnect_delay
+
+    async def run(self, reconnect_delay=5):
+        await super().run(reconnect_delay)
+
+    async def _send_registrations(self):
+        for name, (registry, servers) in self.registrations.items():
+            message = {"type": "register", "registry": {name: registry}}
+            if servers is not None:
+                message["servers"] = servers
+            await self._write(message)
+
+class Hub:
+    '''
+    Just the socket side of a hub, which is all the plugins see.
+    '''
+    def __init__(self, port):
+        self.port = port
+        self.registered = 0
+        self.packets = 0
+        self.done = asyncio.Event()
+
+    async def start(self, expected):
+        self.handler = FofServerEventHandler({}, "127.0.0.1", self.port, unix_socket="")
+        register = self.handler.protocol.register
+
+        def counting_register(body, client):
+            self.packets += 1
+            self.registered += len(body.get("registry", {}))
+            if self.registered >= expected:
+                self.done.set()
+            register(body, client)
+
+        self.handler.protocol.register = counting_register
+        self.handler.match_pool.start(asyncio.get_running_loop())
+        self.tcp = await asyncio.start_server(self.handler.protocol.handle_client, "127.0.0.1", self.port)
+
+    async def stop(self):
+        self.tcp.close()
+        for client in list(self.handler.protocol.clients.values()):
+            await client.wait_closed()
+        await self.tcp.wait_closed()
+        self.handler.match_pool.close()
+
+async def restart(client_class, plugins, events, down_for, port):
+    expected = plugins * events
+    hub = Hub(port)
+    await hub.start(expected)
+    clients = []
+    for _ in range(plugins):
+        client = client_class(port=port, transport="tcp")
+
+        async def setup(client):
+            for i in range(events):
+                await client.register_event(f"event_{i}", match_=f"thing {i}")
+
+        client.on_connect(setup)
+        clients.append(client)
+    tasks = [asyncio.create_task(client.run()) for client in clients]
+    await hub.done.wait()
+
+    await hub.stop()
+    await asyncio.sleep(down_for)
+    hub = Hub(port)
+    await hub.start(expected)
+    started = time.perf_counter()
+    await hub.done.wait()
+    took = time.perf_counter() - started
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await hub.stop()
+    return took, hub.packets
+
+async def main(plugins=10, events=5, port=9395):
+    print(f"{plugins} plugins with {events} events each")
+    print(f"{'hub down (s)':>12} {'client':>8} {'back in (s)':>12} {'register packets':>17}")
+    for down_for in (0.5, 3):
+        for name, client_class in (("old", OldClient), ("new", FofClient)):
+            took, packets = await restart(client_class, plugins, events, down_for, port)
+            print(f"{down_for:>12} {name:>8} {took:>12.3f} {packets:>17}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,54 @@
+import time
+import asyncio
+
+from scripts.server.wire import JsonLines, BinaryFrames, SharedEvent
+from scripts.benchmarks.event_engine import SAMPLE_LINES
+
+def make_messages(count):
+    '''
+    A mix of event packets (most of the traffic) with the odd large
+    get-response, like a plugin syncing player records.
+    '''
+    records = {f"[U:1:{1000 + i}]": {"name": f"Player {i}", "kills": i * 3, "deaths": i, "verified": i % 2 == 0} for i in range(200)}
+    messages = []
+    for i in range(count):
+        if i % 50 == 0:
+            messages.append(("get", {"type": "get-response", "keys": ["players"], "payload": records}))
+        else:
+            shared = {"type": "event", "data": SAMPLE_LINES[i % len(SAMPLE_LINES)][25:], "loginfo": SAMPLE_LINES[i % len(SAMPLE_LINES)][:25]}
+            messages.append(("event", SharedEvent(shared)))
+    return messages
+
+def encode(wire, messages):
+    frames = []
+    for kind, message in messages:
+        if kind == "event":
+            frames.append(wire.frame(message.body(wire, ["on_event"])))
+        else:
+            frames.append(wire.frame(wire.dumps(message)))
+    return b"".join(frames)
+
+async def decode(wire, data, count):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    for _ in range(count):
+        await wire.read(reader)
+
+def main(count=20000):
+    formats = [("json lines", JsonLines()), ("binary", BinaryFrames()), ("binary + zlib", BinaryFrames(compress=True))]
+    print(f"{'format':>14} {'encode msg/s':>14} {'decode msg/s':>14} {'bytes':>12} {'bytes/msg':>10}")
+    for name, wire in formats:
+        # Fresh SharedEvents so cached prefixes from another format don't count
+        messages = make_messages(count)
+        start = time.perf_counter()
+        data = encode(wire, messages)
+        encode_rate = count / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        asyncio.run(decode(wire, data, count))
+        decode_rate = count / (time.perf_counter() - start)
+        print(f"{name:>14} {encode_rate:>14,.0f} {decode_rate:>14,.0f} {len(data):>12,} {len(data) / count:>10.1f}")
+
+if __name__ == "__main__":
+    main()
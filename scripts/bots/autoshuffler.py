@@ -12,8 +12,9 @@ class BotGenerator:
         self.same_team = same_team if same_team is not None else bool(int(os.environ.get("BOTS_SAME_TEAM", True)))
         self.same_team_no = same_team_no if same_team_no is not None else int(os.environ.get("BOTS_SAME_TEAM_NO", 3))
 
-    async def start(self):
-        self.fofclient = FofClient()
+    async def start(self, client=None):
+        # The plugin host passes in a client it shares with other plugins
+        self.fofclient = client if client is not None else FofClient()
 
         @self.fofclient.on_event("on_mapchange")
         async def randomize(message_data):
@@ -26,7 +27,7 @@ class BotGenerator:
         self.fofclient.on_connect(register_on_connect)
         await self.fofclient.run()
 
-if __name__ == "__main__":
+def load_plugin():
     import yaml
     with open("configs/bot_randomizer.yml", "r") as fp:
         config = yaml.safe_load(fp)
@@ -38,14 +39,16 @@ if __name__ == "__main__":
     bot_data_file: str = config.get("bots_data_file", "data/bot-specs/bot_specs.json")
     output_bot_script: str = config.get("bots_output_script", "fof/fof_scripts/bots/generated.txt")
 
+    return BotGenerator(
+                bot_data_file, 
+                output_bot_script, 
+                boss_chance, 
+                same_team, 
+                same_team_no)
+
+if __name__ == "__main__":
     async def main():
-        generator = BotGenerator(
-                        bot_data_file, 
-                        output_bot_script, 
-                        boss_chance, 
-                        same_team, 
-                        same_team_no)
-    
+        generator = load_plugin()
         await generator.start()
 
     asyncio.run(main())
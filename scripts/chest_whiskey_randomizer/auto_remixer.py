@@ -10,8 +10,14 @@ class FofAutoRemixer:
         self.templates_folder = templates_folder
         self.output_folder = output_folder
 
-    async def start(self):
-        self.fofclient = FofClient()
+    def remix(self, template_name, script_name):
+        self.remixer.import_ai_script(template_name)
+        self.remixer.create_randomized_locations()
+        self.remixer.export_to_script(script_name)
+
+    async def start(self, client=None):
+        # The plugin host passes in a client it shares with other plugins
+        self.fofclient = client if client is not None else FofClient()
 
         @self.fofclient.on_event("on_mapchange")
         async def randomize(message_data):
@@ -20,9 +26,8 @@ class FofAutoRemixer:
             if os.path.exists(template_name):
                 print("Shuffling chest and whiskey locations!")
                 script_name = os.path.join(self.output_folder, message_data["data"].split(" ")[3] + "-shootout.ai")
-                self.remixer.import_ai_script(template_name)
-                self.remixer.create_randomized_locations()
-                self.remixer.export_to_script(script_name)
+                # File work, so off the event loop
+                await asyncio.to_thread(self.remix, template_name, script_name)
 
         async def on_connect(client):
            await client.register_event("on_mapchange", startswith='-------- Mapchange to ', exclude='say')
@@ -30,19 +35,22 @@ class FofAutoRemixer:
         self.fofclient.on_connect(on_connect)
         await self.fofclient.run()
 
-if __name__ == "__main__":
+def load_plugin():
+    import yaml
+    CONFIG_FILE = "configs/remixer.yml"
+    
+    with open(CONFIG_FILE, "r") as fp:
+        config = yaml.safe_load(fp)
 
-    async def main():
-        import yaml
-        CONFIG_FILE = "configs/remixer.yml"
-        
-        with open(CONFIG_FILE, "r") as fp:
-            config = yaml.safe_load(fp)
+    templates_folder = config.get("templates_folder", "data/map-prop-templates/chest-whiskey-templates")
+    output_folder = config.get("output_folder", "fof/fof_scripts/ai_editor")
 
-        templates_folder = config.get("templates_folder", "data/map-prop-templates/chest-whiskey-templates")
-        output_folder = config.get("output_folder", "fof/fof_scripts/ai_editor")
+    return FofAutoRemixer(templates_folder, output_folder)
 
-        auto_remixer = FofAutoRemixer(templates_folder, output_folder)
+if __name__ == "__main__":
+
+    async def main():
+        auto_remixer = load_plugin()
         await auto_remixer.start()
 
     asyncio.run(main())
@@ -1,23 +1,99 @@
 import asyncio
+import itertools
 import json
 import os
+import time
+import random
+from collections import OrderedDict, deque
+
+from scripts.server.wire import JsonLines, BinaryFrames, default_socket_path
+from scripts.server.shm_ring import LogRing
 
 class FofClient:
-    COMMAND_DICT = {"type": "command", "command": ""}
-    GET_DICT = {"type": "get", "keys": []}
-    STORE_DICT = {"type": "store", "keys": [], "payload": {}}
-    REGISTER_DICT = {"type": "register", "registry": {}}
-    UNREGISTER_DICT = {"type": "unregister", "events": []}
+    # Older hubs don't answer 'hello', so don't wait on them for long
+    HELLO_TIMEOUT = 1.0
+    # The first retry after losing the hub is almost right away (a restart
+    # is usually quick), then the wait doubles from here up to run()'s
+    # reconnect_delay
+    RECONNECT_FIRST = 0.05
+    RECONNECT_BASE = 0.05
 
-    def __init__(self, host="127.0.0.1", port=9000, debug=False):
+    def __init__(self, host="127.0.0.1", port=9000, framing="binary", compress=True, batch_window_ms=None, batch_max_events=32,
+                 transport="auto", unix_socket=None, use_ring=True, cache_size=0, max_handlers=16, handler_queue_size=1000,
+                 outbox_size=1000, token=None, debug=False):
         self.host = host
         self.port = port
+        # 'auto' uses the hub's unix socket if it's on this machine, else TCP
+        self.transport = transport
+        self.unix_socket = unix_socket if unix_socket is not None else default_socket_path(port)
+        self.use_ring = use_ring
+        self.local = False
+        self.ring = None
+        # Lines overwritten in the ring before this client got to them
+        self.ring_dropped = 0
+        self.framing = framing
+        self.compress = compress
+        # The hub's FOF_RELAY_TOKEN, which a hub with one wants from clients
+        # on other machines before anything else
+        self.token = token
+        self.wire = JsonLines()
+        self.batch_window_ms = batch_window_ms
+        self.batch_max_events = batch_max_events
         self.debug = debug
         self.reader = None
         self.writer = None
         self.event_handlers = {}
+        self.parallel_handlers = set()
+        # Handlers run in their own tasks (at most max_handlers at once) so a
+        # slow one doesn't stop the client reading from the hub. Ordered ones
+        # get their calls one at a time, from a queue per handler. The
+        # listener never waits on them (responses to requests come in on the
+        # same connection), so once handler_queue_size calls are piled up,
+        # new events are dropped and counted in events_dropped. Watch changes
+        # are always kept, since skipping one would leave the handler behind.
+        self.handler_slots = asyncio.Semaphore(max_handlers)
+        self.handler_queue_size = handler_queue_size
+        self.handler_queues = {}
+        self.handler_tasks = set()
+        self.handler_pending = 0
+        self.events_dropped = 0
+        # Handler name -> [calls, errors, total ms, max ms, total ms waiting]
+        self.handler_timings = {}
         self.listen_task = None
         self.received_data = {}
+        # Values from `get`, kept until the hub says they changed. Paths
+        # pushed out of a full cache are passed along with the next get so
+        # the hub can stop watching them.
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.uncached = []
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Handlers for watched key prefixes, and the last store version seen
+        # for each so re-watching after a reconnect only gets what changed
+        self.watch_handlers = {}
+        self.watch_versions = {}
+        # Versions only mean something within one epoch of the hub's store.
+        # Prefixes being watched again after a gap ignore changes until the
+        # answer comes back, since it covers them.
+        self.store_epoch = None
+        self.rewatching = set()
+        # Requests waiting on a response with the same id
+        self.request_ids = itertools.count(1)
+        self.pending_requests = {}
+        # The last journal seq this client saw from each server, so after a
+        # reconnect the events registered in on_connect pick up where they
+        # left off
+        self.last_seq = {}
+        self.resume_from = None
+        # Every registered event (name -> (registry, servers)), sent again as
+        # one register on each connect
+        self.registrations = {}
+        self._collecting = False
+        # Messages sent while not connected, sent once the client is back
+        self.outbox = deque()
+        self.outbox_size = outbox_size
+        self.online = False
         self._on_connect = []
         self._on_disconnect = []
         self._connected = asyncio.Event()
@@ -36,19 +112,93 @@ class FofClient:
 
     async def _fire_on_disconnect(self):
         self._connected.clear()
+        self.online = False
+        # Half-closed sockets would swallow anything written to them
+        if self.writer is not None:
+            self.writer.close()
+        # Anything cached may have changed while we weren't hearing about it
+        self.clear_cache()
         for func in self._on_disconnect:
             await func(self)
 
     async def connect(self):
         try:
-            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            self.reader, self.writer = await self._open_connection()
+            self.wire = JsonLines()
+            if self.framing != "json" or self.local or self.token is not None:
+                await self._negotiate()
             self.listen_task = asyncio.create_task(self._listen())
-            await self._fire_on_connect()
+            if self.batch_window_ms is not None:
+                await self._write({"type": "batching", "window_ms": self.batch_window_ms, "max_events": self.batch_max_events})
+            await self._flush_outbox()
+            self.resume_from = self._resume_cursor()
+            # Registers in on_connect are collected and go out together
+            self._collecting = True
+            try:
+                await self._fire_on_connect()
+                self._collecting = False
+                await self._send_registrations()
+            finally:
+                self._collecting = False
+                self.resume_from = None
         except:
             await self._fire_on_disconnect()
             raise
 
+    def _resume_cursor(self):
+        # A hub running one server just takes the number
+        if not self.last_seq: return None
+        if list(self.last_seq) == [None]: return self.last_seq[None]
+        return {server: seq for server, seq in self.last_seq.items() if server is not None}
+
+    async def _open_connection(self):
+        self.local = False
+        if self.transport in ("auto", "unix") and os.path.exists(self.unix_socket):
+            try:
+                connection = await asyncio.open_unix_connection(self.unix_socket)
+                self.local = True
+                return connection
+            except OSError as e:
+                if self.transport == "unix":
+                    raise
+                if self.debug: print(f"[FofClient] Unix socket failed, using TCP: {e}")
+        elif self.transport == "unix":
+            raise FileNotFoundError(self.unix_socket)
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def _negotiate(self, ring=True):
+        hello = {"type": "hello", "framing": self.framing, "compress": self.compress, "ring": ring and self.local and self.use_ring}
+        if self.token is not None:
+            hello["token"] = self.token
+        await self._write(hello)
+        try:
+            response = await asyncio.wait_for(self.wire.read(self.reader), timeout=self.HELLO_TIMEOUT)
+        except asyncio.TimeoutError:
+            if self.debug: print("[FofClient] No hello-response, staying on JSON.")
+            return
+        if not response or response.get("type") != "hello-response":
+            return
+        if response.get("framing") == "binary":
+            self.wire = BinaryFrames(compress=response.get("compress", False))
+        if self.debug: print(f"[FofClient] Using {self.wire.name} framing.")
+
+        if "ring" in response:
+            self._close_ring()
+            try:
+                self.ring = LogRing(name=response["ring"], create=False)
+                if self.debug: print(f"[FofClient] Reading log lines from shared memory ring {self.ring.name}.")
+            except (OSError, ValueError) as e:
+                # Tell the hub to send lines over the socket after all
+                print(f"[FofClient] Couldn't open log ring, using the socket instead: {e}")
+                await self._negotiate(ring=False)
+
+    def _close_ring(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
     async def disconnect(self):
+        self.online = False
         if self.listen_task:
             self.listen_task.cancel()
             try:
@@ -58,27 +208,332 @@ class FofClient:
         if self.writer:
             self.writer.close()
             await self.writer.wait_closed()
+        self._close_ring()
+        self.clear_cache()
 
     async def send(self, payload):
+        '''
+        Sends a message to the server. While the client isn't connected, it
+        waits in the outbox (up to `outbox_size` messages) and goes out first
+        thing after the next connect.
+        '''
+        if not self.online:
+            if len(self.outbox) >= self.outbox_size:
+                raise RuntimeError("Not connected, and the outbox is full.")
+            self.outbox.append(payload)
+            return
+        await self._write(payload)
+
+    async def _write(self, payload):
         if not self.writer:
             raise RuntimeError("Not connected.")
-        self.writer.write((payload + "\n").encode())
+        # Pre-encoded JSON strings are still accepted from older plugins
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+        self.writer.write(self.wire.frame(self.wire.dumps(payload)))
         await self.writer.drain()
 
-    async def command(self, command_str):
-        self.COMMAND_DICT["command"] = command_str
-        await self.send(json.dumps(self.COMMAND_DICT))
+    async def _flush_outbox(self):
+        # Only taken off once it's written, so a failed connect keeps it
+        while self.outbox:
+            payload = self.outbox[0]
+            await self._write(payload)
+            # (Unless the request it's for gave up in the meantime)
+            if self.outbox and self.outbox[0] is payload:
+                self.outbox.popleft()
+        self.online = True
+
+    async def command(self, command_str, capture=False, timeout=10, server=None):
+        '''
+        Runs a command on the server (or the given server, if the hub runs
+        several). With capture, waits for the command to run and returns the
+        console lines it printed.
+        '''
+        message = {"type": "command", "command": command_str}
+        if server is not None:
+            message["server"] = server
+        if not capture:
+            await self.send(message)
+            return None
+        message["capture"] = True
+        response = await self.request(message, timeout=timeout)
+        return response["output"]
+
+    async def request(self, message, timeout=10):
+        '''
+        Sends a request with a fresh id and waits for the response with that
+        id. Raises RuntimeError if the server answers with an error.
+        '''
+        id_ = next(self.request_ids)
+        payload = {**message, "id": id_}
+        future = asyncio.get_running_loop().create_future()
+        self.pending_requests[id_] = future
+        try:
+            await self.send(payload)
+            response = await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            self.pending_requests.pop(id_, None)
+            # Nobody's waiting on it anymore, so it shouldn't run on the
+            # next connect
+            if payload in self.outbox:
+                self.outbox.remove(payload)
+        if "error" in response:
+            raise RuntimeError(f"{message['type']} failed: {response['error']}")
+        return response
+
+    async def mget(self, keys_list, timeout=10):
+        '''
+        Gets several key paths in one round trip and returns their values in
+        the same order.
+        '''
+        response = await self.request({"type": "mget", "keys": keys_list}, timeout=timeout)
+        for keys, payload in zip(response["keys"], response["payloads"]):
+            self._set_received(keys, payload)
+        return response["payloads"]
+
+    async def scan(self, keys, limit=100, after=None, timeout=10):
+        '''
+        Gets one page of the keys right under `keys`. Returns (items, next),
+        where items is a list of [key, value] pairs and next is the `after`
+        for the following page (None once there aren't any more).
+        '''
+        response = await self.request({"type": "scan", "keys": keys, "limit": limit, "after": after}, timeout=timeout)
+        return response["items"], response["next"]
+
+    async def mstore(self, items, timeout=10):
+        '''
+        Stores several values in one round trip. `items` is a list of
+        (keys, value) pairs.
+        '''
+        for keys, _ in items:
+            self._uncache(keys)
+        await self.request({"type": "mstore", "items": [{"keys": keys, "payload": value} for keys, value in items]}, timeout=timeout)
+
+    async def batch(self, requests, timeout=10):
+        '''
+        Sends a list of requests (like {"type": "get", "keys": [...]}) as one
+        message and returns the list of their responses.
+        '''
+        response = await self.request({"type": "batch", "requests": requests}, timeout=timeout)
+        return response["responses"]
+
+    async def store(self, keys, value, ttl=None):
+        message = {"type": "store", "keys": keys, "payload": value}
+        if ttl is not None:
+            message["ttl"] = ttl
+        self._uncache(keys)
+        await self.send(message)
+
+    async def _update(self, message, ttl, wait, timeout):
+        # Updates are fire-and-forget unless the caller wants the result
+        if ttl is not None:
+            message["ttl"] = ttl
+        self._uncache(message["keys"])
+        if not wait:
+            await self.send(message)
+            return None
+        response = await self.request(message, timeout=timeout)
+        return response["result"]
 
-    async def store(self, keys, value):
-        self.STORE_DICT["keys"] = keys
-        self.STORE_DICT["payload"] = value
-        await self.send(json.dumps(self.STORE_DICT))
+    async def incr(self, keys, amount=1, ttl=None, wait=False, timeout=10):
+        '''
+        Adds `amount` to the number at `keys` on the server (missing counts
+        as 0). With wait, returns the new total.
+        '''
+        return await self._update({"type": "incr", "keys": keys, "amount": amount}, ttl, wait, timeout)
 
-    async def get(self, keys):
-        self.GET_DICT["keys"] = keys
-        await self.send(json.dumps(self.GET_DICT))
+    async def append(self, keys, item, cap=None, ttl=None, wait=False, timeout=10):
+        '''
+        Adds an item to the end of the list at `keys`, keeping only the last
+        `cap` items. With wait, returns the new length.
+        '''
+        message = {"type": "append", "keys": keys, "payload": item}
+        if cap is not None:
+            message["cap"] = cap
+        return await self._update(message, ttl, wait, timeout)
 
-    async def register_event(self, name, regex=None, match_=None, exclude=None, startswith=None, endswith=None, logged=None, equal=None):
+    async def extend(self, keys, items, cap=None, ttl=None, wait=False, timeout=10):
+        message = {"type": "extend", "keys": keys, "payload": list(items)}
+        if cap is not None:
+            message["cap"] = cap
+        return await self._update(message, ttl, wait, timeout)
+
+    async def cas(self, keys, expected, value, ttl=None, timeout=10):
+        '''
+        Stores `value` only if what's at `keys` is still `expected` (None if
+        nothing is). Returns (stored, the value that's there now).
+        '''
+        result = await self._update({"type": "cas", "keys": keys, "expected": expected, "payload": value}, ttl, True, timeout)
+        return result["swapped"], result["value"]
+
+    async def delete(self, keys, wait=False, timeout=10):
+        return await self._update({"type": "delete", "keys": keys}, None, wait, timeout)
+
+    async def get(self, keys, timeout=10):
+        '''
+        Gets the value at a key path from the shared storage. With a cache,
+        repeat gets are answered locally until someone stores over the path.
+        '''
+        path = tuple(keys)
+        if path in self.cache:
+            self.cache.move_to_end(path)
+            self.cache_hits += 1
+            return self.cache[path]
+        message = {"type": "get", "keys": keys}
+        if self.cache_size:
+            self.cache_misses += 1
+            message["cache"] = True
+            if self.uncached:
+                message["uncache"], self.uncached = self.uncached, []
+        response = await self.request(message, timeout=timeout)
+        return response["payload"]
+
+    async def watch(self, keys, handler, window_ms=None, timeout=10):
+        '''
+        Calls `handler(change)` whenever something at or under `keys` in the
+        shared storage changes, starting with its current value. Watching the
+        same keys again (like in on_connect) only gets what changed since.
+        '''
+        path = tuple(keys)
+        self.watch_handlers[path] = handler
+        message = {"type": "watch", "keys": keys}
+        if path in self.watch_versions and self.store_epoch is not None:
+            message["since"] = self.watch_versions[path]
+            message["epoch"] = self.store_epoch
+        if window_ms is not None:
+            message["window_ms"] = window_ms
+        await self.request(message, timeout=timeout)
+
+    async def unwatch(self, keys):
+        self.watch_handlers.pop(tuple(keys), None)
+        self.watch_versions.pop(tuple(keys), None)
+        await self.send({"type": "unwatch", "keys": keys})
+
+    async def _rewatch(self, path):
+        try:
+            await self.watch(list(path), self.watch_handlers[path])
+        except Exception as e:
+            self.rewatching.discard(path)
+            print(f"[FofClient] Couldn't watch {list(path)} again: {e}")
+
+    async def _handle_changes(self, message):
+        path = tuple(message["keys"])
+        handler = self.watch_handlers.get(path)
+        if handler is None: return
+        if message["type"] == "watch-response":
+            self.rewatching.discard(path)
+        elif path in self.rewatching:
+            return
+        elif "base" in message and (message.get("epoch") != self.store_epoch or message["base"] != self.watch_versions.get(path)):
+            # Missed a packet, or the hub's store started over, so catch up
+            # with a fresh watch (from a task, the answer comes through here)
+            if self.debug: print(f"[FofClient] Gap in changes to {list(path)}, watching it again.")
+            self.rewatching.add(path)
+            self._start_handler(self._rewatch(path))
+            return
+        if "epoch" in message:
+            self.store_epoch = message["epoch"]
+        self.watch_versions[path] = message["version"]
+        for change in message["changes"]:
+            change["version"] = message["version"]
+            if message.get("reset"):
+                change["reset"] = True
+            # Always in order, or an older value could land after a newer one
+            self._dispatch(f"watch {list(path)}", handler, change, ordered=True, shed=False)
+
+    def _dispatch(self, name, handler, arg, ordered, shed=True):
+        if shed and self.handler_pending >= self.handler_queue_size:
+            self.events_dropped += 1
+            if self.debug: print(f"[FofClient] {self.handler_pending} handler calls waiting, dropped an event for {name}.")
+            return
+        self.handler_pending += 1
+        call = (handler, arg, time.monotonic())
+        if not ordered:
+            self._start_handler(self._run_handler(name, *call))
+        elif name in self.handler_queues:
+            self.handler_queues[name].append(call)
+        else:
+            self.handler_queues[name] = deque([call])
+            self._start_handler(self._run_ordered(name))
+
+    def _start_handler(self, coro):
+        task = asyncio.create_task(coro)
+        self.handler_tasks.add(task)
+        task.add_done_callback(self.handler_tasks.discard)
+
+    async def _run_ordered(self, name):
+        queue = self.handler_queues[name]
+        try:
+            while queue:
+                await self._run_handler(name, *queue.popleft())
+        finally:
+            del self.handler_queues[name]
+            self.handler_pending -= len(queue)
+
+    async def _run_handler(self, name, handler, arg, received):
+        async with self.handler_slots:
+            started = time.monotonic()
+            timings = self.handler_timings.setdefault(name, [0, 0, 0.0, 0.0, 0.0])
+            try:
+                await handler(arg)
+            except Exception as e:
+                timings[1] += 1
+                print(f"[FofClient] Error in handler for {name}: {e}")
+            finally:
+                took = (time.monotonic() - started) * 1000
+                timings[0] += 1
+                timings[2] += took
+                timings[3] = max(timings[3], took)
+                timings[4] += (started - received) * 1000
+                self.handler_pending -= 1
+
+    async def wait_handlers(self):
+        '''
+        Waits for every handler call started so far to finish.
+        '''
+        while self.handler_tasks:
+            await asyncio.gather(*self.handler_tasks, return_exceptions=True)
+
+    def handler_stats(self):
+        '''
+        How long each event (and watch) handler has been taking, in ms, and
+        how long calls waited before they started.
+        '''
+        stats = {}
+        for name, (calls, errors, total, max_ms, waited) in self.handler_timings.items():
+            stats[name] = {
+                "calls": calls,
+                "errors": errors,
+                "avg_ms": round(total / calls, 2) if calls else 0,
+                "max_ms": round(max_ms, 2),
+                "avg_wait_ms": round(waited / calls, 2) if calls else 0,
+                "queued": len(self.handler_queues.get(name, ()))
+            }
+        return stats
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.uncached = []
+
+    def _uncache(self, keys):
+        # Our own write changes the path, everything cached above it (which
+        # holds it) and everything cached under it. The hub's invalidation
+        # would say the same, but not until after a get could have read the
+        # old value from here
+        if not self.cache: return
+        path = tuple(keys)
+        for i in range(len(path) + 1):
+            self.cache.pop(path[:i], None)
+        for cached in [cached for cached in self.cache if cached[:len(path)] == path]:
+            del self.cache[cached]
+
+    def _cache_value(self, keys, payload):
+        self.cache[tuple(keys)] = payload
+        while len(self.cache) > self.cache_size:
+            path, _ = self.cache.popitem(last=False)
+            self.uncached.append(list(path))
+
+    async def register_event(self, name, regex=None, match_=None, exclude=None, startswith=None, endswith=None, logged=None, equal=None, event=None, fields=None, servers=None):
         registry = {}
         if regex is not None: registry["regex"] = regex
         if match_ is not None: registry["match"] = match_
@@ -87,54 +542,126 @@ class FofClient:
         if endswith is not None: registry["endswith"] = endswith
         if logged is not None: registry["logged"] = logged
         if equal is not None: registry["equal"] = equal
+        if event is not None: registry["event"] = event
+        if fields is not None: registry["fields"] = fields
+
+        self.registrations[name] = (registry, list(servers) if servers is not None else None)
+        # Otherwise it goes out with the rest on the next connect
+        if not self.online or self._collecting: return
+        message = {"type": "register", "registry": {name: registry}}
+        # Only hear about this event from some of the hub's servers
+        if servers is not None:
+            message["servers"] = list(servers)
+        await self.send(message)
 
-        self.REGISTER_DICT["registry"] = {name: registry}
-        await self.send(json.dumps(self.REGISTER_DICT))
+    async def _send_registrations(self):
+        '''
+        Registers everything the client has registered so far in one message,
+        asking for a replay of what was missed if there's anything to resume
+        from.
+        '''
+        if not self.registrations: return
+        message = {"type": "register", "registry": {name: registry for name, (registry, _) in self.registrations.items()}}
+        servers = {name: servers for name, (_, servers) in self.registrations.items() if servers is not None}
+        if servers:
+            message["servers"] = servers
+        if self.resume_from is not None:
+            message["resume_from"] = self.resume_from
+        await self._write(message)
 
     async def unregister_event(self, name):
-        self.UNREGISTER_DICT["events"] = [name]
-        await self.send(json.dumps(self.UNREGISTER_DICT))
+        self.registrations.pop(name, None)
+        # The server forgets everything when the client drops anyway
+        if not self.online: return
+        await self.send({"type": "unregister", "events": [name]})
 
-    def on_event(self, name):
-        # Decorator to attach a handler
+    def on_event(self, name, ordered=True):
+        # Decorator to attach a handler. Ordered handlers get one call at a
+        # time, in the order the events came in, otherwise calls can overlap
         def decorator(func):
             self.event_handlers[name] = func
+            if ordered:
+                self.parallel_handlers.discard(name)
+            else:
+                self.parallel_handlers.add(name)
             return func
         return decorator
 
+    async def _handle_message(self, message):
+        if "id" in message:
+            future = self.pending_requests.get(message["id"])
+            if future is not None and not future.done():
+                future.set_result(message)
+        if message["type"] == "get-response":
+            self._set_received(message["keys"], message["payload"])
+            # Cached here rather than in `get` so an invalidation right
+            # behind the response can't be handled before it
+            if message.get("cached") and self.cache_size:
+                self._cache_value(message["keys"], message["payload"])
+        elif message["type"] == "invalidate":
+            for keys in message["keys"]:
+                self.cache.pop(tuple(keys), None)
+        elif message["type"] in ("changes", "watch-response"):
+            # The watch-response is handled here too, so its changes always
+            # reach the handler before any pushed after it
+            await self._handle_changes(message)
+        elif message["type"] == "event":
+            if "ring" in message and "data" not in message:
+                data = self.ring.read(message["ring"]) if self.ring is not None else None
+                if data is None:
+                    # Fell more than the ring's length behind the hub
+                    self.ring_dropped += 1
+                    if self.debug: print(f"[FofClient] Line {message['ring']} was overwritten before it could be read, dropped.")
+                    return
+                message["data"] = data.decode(errors="ignore")
+            if "seq" in message:
+                self.last_seq[message.get("server")] = message["seq"]
+            triggered = message.get("triggered", [])
+
+            for event_name in triggered:
+                await self._handle_event(event_name, message)
+        elif message["type"] in ("command-response", "update-response", "mget-response", "scan-response", "batch-response", "stats-response", "ack", "error"):
+            pass
+        elif message["type"] == "pong":
+            pass
+        elif message["type"] == "batch":
+            # Batched events are handled just like they came in one at a time
+            for event in message.get("events", []):
+                await self._handle_message(event)
+        else:
+            print("[FofClient] Unrecognized message:", message)
+
+    async def _handle_event(self, event_name, message):
+        if event_name in self.event_handlers:
+            self._dispatch(event_name, self.event_handlers[event_name], message, event_name not in self.parallel_handlers)
+
+    def _set_received(self, keys, payload):
+        dict_ = self.received_data
+        for key in keys[:-1]:
+            if key not in dict_:
+                dict_[key] = {}
+            dict_ = dict_[key]
+        dict_[keys[-1]] = payload
+
     async def _listen(self):
         try:
             while True:
-                line = await self.reader.readline()
-                if not line:
+                try:
+                    message = await self.wire.read(self.reader)
+                except (ValueError, EOFError) as e:
+                    # A bad JSON line can be skipped, but after a bad binary
+                    # frame there's no telling where the next one starts, so
+                    # reconnect rather than read garbage
+                    if self.wire.name == "json":
+                        print(f"[FofClient] Failed to parse message: {e}")
+                        continue
+                    print(f"[FofClient] Failed to read a frame, disconnecting: {e}")
+                    break
+                if message is None:
                     break
+                if self.debug: print(f"[FofClient] Received {message}")
 
-                try:
-                    message = json.loads(line.decode(errors="ignore").strip())
-                    print(f"Received {message}")
-                except Exception as e:
-                    print(f"[FofClient] Failed to parse message: {e}")
-                    continue
-
-                if message["type"] == "get-response":
-                    keys = message["keys"]
-                    dict_ = self.received_data
-                    for key in keys[:-1]:
-                        if key not in dict_:
-                            dict_[key] = {}
-                        dict_ = dict_[key]
-                    dict_[keys[-1]] = message["payload"]
-                elif message["type"] == "event":
-                    triggered = message.get("triggered", [])
-
-                    for event_name in triggered:
-                        if event_name in self.event_handlers:
-                            try:
-                                await self.event_handlers[event_name](message)
-                            except Exception as e:
-                                print(f"[FofClient] Error in event handler {event_name}: {e}")
-                else:
-                    print("[FofClient] Unrecognized message:", message)
+                await self._handle_message(message)
 
         except asyncio.CancelledError:
             self._interrupted = True
@@ -142,19 +669,34 @@ class FofClient:
         except Exception as e:
             print(f"[FofClient] Listener error: {e}")
 
-    async def run(self, reconnect_delay=5):
+    def _reconnect_wait(self, attempt, reconnect_delay):
+        # Spread out, so plugins that lost the hub together don't all come
+        # back at the same moment
+        if attempt == 0:
+            return random.uniform(0, self.RECONNECT_FIRST)
+        delay = min(reconnect_delay, self.RECONNECT_BASE * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    async def run(self, reconnect_delay=1):
+        '''
+        Connects and keeps reconnecting whenever the connection drops, waiting
+        a little longer after each failed try, up to `reconnect_delay` seconds.
+        '''
         failed_connect = False
+        attempt = 0
         while True:
             try:
                 if self.debug: print("Attempting connection!")
                 await self.connect()
                 if self.debug: print("Connected!")
                 failed_connect = False
+                attempt = 0
                 await self.listen_task
                 if self._interrupted:
                     print("Interrupted - closing!")
                     break
                 print("Lost connection! Will retry.")
+                await self._fire_on_disconnect()
             except Exception as e:
                 await self._fire_on_disconnect()
                 if isinstance(e, KeyboardInterrupt):
@@ -163,7 +705,8 @@ class FofClient:
                 if not failed_connect:
                     failed_connect = True
                     print(f"[FofClient] Connection error: {e}")
-            await asyncio.sleep(reconnect_delay)
+            await asyncio.sleep(self._reconnect_wait(attempt, reconnect_delay))
+            attempt += 1
 
 async def main():
     bot = FofClient()
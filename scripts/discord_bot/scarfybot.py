@@ -54,20 +54,28 @@ verified_users = load_verified()
 fof_host = config.get("fof_local_host", "127.0.0.1")
 fof_port = config.get("fof_local_port", 9000)
 
-fof = FofClient(host=fof_host, port=fof_port)
+# Needed when the hub is an aggregator on another machine
+fof = FofClient(host=fof_host, port=fof_port, token=os.environ.get("FOF_RELAY_TOKEN", None) or None)
 
-VERIFY_REGEX = re.compile(r'"(.+)<(\d+)><\[(.+)\]><(\w+)>" say "!verify (\w+)"')
+VERIFY_CODE_REGEX = re.compile(r'!verify (\w+)')
 
-@fof.on_event("verify_attempt")
+# Different players' verifications don't depend on each other
+@fof.on_event("verify_attempt", ordered=False)
 async def handle_verification(message):
-    text = message["data"].strip()
-    match = VERIFY_REGEX.search(text)
+    # The server already parsed the say line for us
+    event = message.get("event", {})
+    # Just the code, nothing after it
+    match = VERIFY_CODE_REGEX.fullmatch(event.get("message", ""))
     if not match:
         print("No match found in verify message.")
         return
+    # Bots and the console can say things too, but they aren't players
+    if not event.get("steam_id", "").startswith("[U:"):
+        print(f"Ignoring verify from {event.get('steam_id')}.")
+        return
 
-    # Parse fields
-    player_name, entity_id, steam_id, team, verify_code = match.groups()
+    steam_id = event["steam_id"].strip("[]")
+    verify_code = match.group(1)
 
     if verify_code in pending_verifications:
         user_id = pending_verifications.pop(verify_code)
@@ -125,7 +133,8 @@ async def on_ready():
     async def on_fof_connect(client):
         await client.register_event(
             "verify_attempt",
-            match_="say \"!verify "
+            event="say",
+            fields={"message": {"startswith": "!verify "}}
         )
 
     fof.on_connect(on_fof_connect)
@@ -0,0 +1,77 @@
+class EventParser:
+    '''
+    Finds the first of a dict of EventPatterns (in dict order) that matches a
+    line, without trying every one of them. Lines are sorted by their first
+    character, and lines starting with a quote also by the word after each
+    `>" ` in them (the end of a "name<id><steamid><team>" block, like
+    `killed` or `say`). Only patterns whose `prefix` and `needs` fit the
+    line get their regex run, which is usually just the one that matches.
+
+    Patterns that can't both match a line (because their prefixes differ)
+    are tried most common first, going by the lines seen so far.
+    '''
+    ACTOR_END = '>" '
+    REORDER_EVERY = 4096
+
+    def __init__(self, patterns):
+        self.routes = [(p.name, p.pattern.match, p.extractor, p.prefix, p.needs) for p in patterns.values()]
+        self.hits = [0] * len(self.routes)
+        self.parsed = 0
+        # Word after an actor block -> the patterns that need it
+        self.by_word = {}
+        for i, (_, _, _, _, needs) in enumerate(self.routes):
+            if needs is not None and needs.startswith(self.ACTOR_END):
+                self.by_word.setdefault(needs[len(self.ACTOR_END):].partition(" ")[0], []).append(i)
+        self.actor_routes = {i for routes in self.by_word.values() for i in routes}
+        # First character (or the set of actor words, for quoted lines) ->
+        # [runs of patterns that can be reordered, the order to try them in]
+        self.candidates = {}
+
+    def _exclusive(self, a, b):
+        a, b = self.routes[a][3], self.routes[b][3]
+        return a is not None and b is not None and not a.startswith(b) and not b.startswith(a)
+
+    def _build(self, first, words):
+        runs = []
+        for i, (_, _, _, prefix, _) in enumerate(self.routes):
+            if prefix is not None and prefix[:1] != first: continue
+            if i in self.actor_routes and not any(i in self.by_word[word] for word in words): continue
+            if runs and all(self._exclusive(i, j) for j in runs[-1]):
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+        return [runs, [i for run in runs for i in run]]
+
+    def reorder(self):
+        for entry in self.candidates.values():
+            for run in entry[0]:
+                run.sort(key=lambda i: -self.hits[i])
+            entry[1] = [i for run in entry[0] for i in run]
+
+    def parse(self, line):
+        '''
+        Returns the name of the first pattern that matches and the fields it
+        extracted, or (None, None).
+        '''
+        self.parsed += 1
+        if self.parsed % self.REORDER_EVERY == 0:
+            self.reorder()
+        first = line[:1]
+        if first == '"':
+            words = (part.partition(" ")[0] for part in line.split(self.ACTOR_END)[1:])
+            key = words = frozenset(word for word in words if word in self.by_word)
+        else:
+            words = ()
+            key = first
+        entry = self.candidates.get(key)
+        if entry is None:
+            entry = self.candidates[key] = self._build(first, words)
+        for i in entry[1]:
+            name, match, extractor, prefix, needs = self.routes[i]
+            if prefix is not None and not line.startswith(prefix): continue
+            if needs is not None and needs not in line: continue
+            found = match(line)
+            if found:
+                self.hits[i] += 1
+                return name, extractor(found.groups())
+        return None, None
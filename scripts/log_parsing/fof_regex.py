@@ -1,11 +1,18 @@
 from dataclasses import dataclass
 import re
 
+from scripts.log_parsing.event_parser import EventParser
+
 @dataclass(frozen=True)
 class EventPattern:
     name: str
     pattern: re.Pattern
     extractor: callable
+    # Text every matching line starts with, and text it always contains.
+    # check_known_events skips the pattern for lines without them, so they
+    # must hold for anything the pattern can match.
+    prefix: str = None
+    needs: str = None
 
 EVENT_PATTERNS = {
     # NOTE: Chop off the timestamp with this pattern BEFORE using the other patterns.
@@ -20,77 +27,95 @@ EVENT_PATTERNS = {
     "entered_game": EventPattern(
         name="entered_game",
         pattern=re.compile(r'"(.+?)<(\d+)><(\[U:\d+:\d+\]|BOT|Console)><(.*?)>" entered the game'),
-        extractor=lambda m: {"event_type": "entered_game", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3]}
+        extractor=lambda m: {"event_type": "entered_game", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3]},
+        prefix='"',
+        needs='>" entered the game'
     ),
 
     # Example: `"Scarfy<132><[U:1:Numbers]><Unassigned>" joined team "Spectator"`
     "join_team": EventPattern(
         name="join_team",
         pattern=re.compile(r'"(.+?)<(\d+)><(\[U:\d+:\d+\]|BOT|Console)><(.*?)>" joined team "(.*?)"'),
-        extractor=lambda m: {"event_type": "join_team", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "prev_team": m[3], "new_team": m[4]}
+        extractor=lambda m: {"event_type": "join_team", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "prev_team": m[3], "new_team": m[4]},
+        prefix='"',
+        needs='>" joined team "'
     ),
 
     # Example: `"Scarfy<132><[U:1:Numbers]><Vigilantes>" say "!gt_creepycreek"`
     "say": EventPattern(
         name="say",
         pattern=re.compile(r'"(.+?)<(\d+)><(\[U:\d+:\d+\]|BOT|Console)><(.*?)>" say "(.*)"'),
-        extractor=lambda m: {"event_type": "say", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "message": m[4]}
+        extractor=lambda m: {"event_type": "say", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "message": m[4]},
+        prefix='"',
+        needs='>" say "'
     ),
 
     # Example: `"Scarfy<129><[U:1:Numbers]><Bandidos>" say_team "wha"`
     "say_team": EventPattern(
         name="say_team",
         pattern=re.compile(r'"(.+?)<(\d+)><(\[U:\d+:\d+\]|BOT|Console)><(.*?)>" say_team "(.*)"'),
-        extractor=lambda m: {"event_type": "team_say", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "message": m[4]}
+        extractor=lambda m: {"event_type": "team_say", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "message": m[4]},
+        prefix='"',
+        needs='>" say_team "'
     ),
 
     # Example: `server_message: "quit"`
     "server_message": EventPattern(
         name="server_message",
         pattern=re.compile(r'server_message: "(.*?)"'),
-        extractor=lambda m: {"event_type": "server_message", "message": m[0]}
+        extractor=lambda m: {"event_type": "server_message", "message": m[0]},
+        prefix='server_message: "'
     ),
 
     # Example: `rcon from "127.0.0.1:50478": command "quit"`
     "rcon_command": EventPattern(
         name="rcon_command",
         pattern=re.compile(r'rcon from "([\d\.:]+)": command "(.*)"'),
-        extractor=lambda m: {"event_type": "rcon_command", "address": m[0], "command": m[1]}
+        extractor=lambda m: {"event_type": "rcon_command", "address": m[0], "command": m[1]},
+        prefix='rcon from "'
     ),
 
     # Example: `"BOT Gypsy<683><BOT><Desperados>" disconnected (reason "Kicked from server")`
     "disconnect": EventPattern(
         name="disconnect",
         pattern=re.compile(r'"(.+?)<(\d+)><(\[U:\d+:\d+\]|BOT|Console)><(.*?)>" disconnected \(reason "(.*?)"?\)?'),
-        extractor=lambda m: {"event_type": "disconnect", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "reason": m[4]}
+        extractor=lambda m: {"event_type": "disconnect", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "reason": m[4]},
+        prefix='"',
+        needs='>" disconnected (reason "'
     ),
 
     # Example: `Log file started (file "logs/L0323075.log") (game "/home/fofserver/fofserver/fof") (version "0")`
     "log_start": EventPattern(
         name="log_start",
         pattern=re.compile(r'Log file started \(file "(.*?)"\) \(game "(.*?)"\) \(version "(.*?)"\)'),
-        extractor=lambda m: {"event_type": "log_start", "filename": m[0], "game_path": m[1], "version": m[2]}
+        extractor=lambda m: {"event_type": "log_start", "filename": m[0], "game_path": m[1], "version": m[2]},
+        prefix='Log file started (file "'
     ),
 
     # Example: `Log file closed.`
     "log_end": EventPattern(
         name="log_end",
         pattern=re.compile(r"Log file closed\."),
-        extractor=lambda m: {"event_type": "log_end"}
+        extractor=lambda m: {"event_type": "log_end"},
+        prefix='Log file closed.'
     ),
 
     # Example: `"BOT Mezcal<188><BOT><>" connected, address "none"`
     "connected": EventPattern(
         name="connected",
         pattern=re.compile(r'"(.+?)<(\d+)><(\[U:\d+:\d+\]|BOT|Console)><>" connected, address "(.*?)"'),
-        extractor=lambda m: {"event_type": "connected", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "address": m[3]}
+        extractor=lambda m: {"event_type": "connected", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "address": m[3]},
+        prefix='"',
+        needs='>" connected, address "'
     ),
 
     # Example: `"BOT Brokstone<193><BOT><Bandidos>" triggered "combat" (notoriety "17")`
     "triggered_combat": EventPattern(
         name="triggered_combat",
         pattern=re.compile(r'"(.+?)<(\d+)><(\[U:\d+:\d+\]|BOT|Console)><(.*?)>" triggered "combat" \(notoriety "(-?\d+)"\)'),
-        extractor=lambda m: {"event_type": "triggered_combat", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "notoriety": int(m[4])}
+        extractor=lambda m: {"event_type": "triggered_combat", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "notoriety": int(m[4])},
+        prefix='"',
+        needs='>" triggered "combat" (notoriety "'
     ),
 
     # Example: `"BOT Brokstone<193><BOT><Bandidos>" killed "BOT Kowalski<190><BOT><Rangers>" with "arrow" (headshot) (attacker_position "306 755 380") (victim_position "-150 361 280")`
@@ -106,7 +131,9 @@ EVENT_PATTERNS = {
             "attacker": {"name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "position": m[10]},
             "victim": {"name": m[4], "user_id": int(m[5]), "steam_id": m[6], "team": m[7], "position": m[11]},
             "weapon": m[8], "headshot": m[9] is not None
-        }
+        },
+        prefix='"',
+        needs='>" killed "'
     ),
 
     # Example: `[META] Loaded 0 plugins (1 already loaded)`
@@ -117,119 +144,143 @@ EVENT_PATTERNS = {
             "event_type": "loaded_plugins",
             "plugin_count": int(m[0]),
             "already_loaded": int(m[2]) if len(m) > 1 and m[2] and m[2].isdigit() else 0
-        }
+        },
+        prefix='[META] Loaded ',
+        needs=' plugins'
     ),
 
     # Example: `server_cvar: "sm_nextmap" "fof_sweetwater"`
     "server_cvar": EventPattern(
         name="server_cvar",
         pattern=re.compile(r'server_cvar: "(.+?)" "(.*?)"'),
-        extractor=lambda m: {"event_type": "server_cvar", "key": m[0], "value": m[1]}
+        extractor=lambda m: {"event_type": "server_cvar", "key": m[0], "value": m[1]},
+        prefix='server_cvar: "'
     ),
 
     # Example: `"sm_super_kick_version" = "1.10.0"`
     "init_cvar": EventPattern(
         name="init_cvar",
         pattern=re.compile(r'"(\S+)" = "(.*)"'),
-        extractor=lambda m: {"event_type": "init_cvar", "key": m[0], "value": m[1]}
+        extractor=lambda m: {"event_type": "init_cvar", "key": m[0], "value": m[1]},
+        prefix='"',
+        needs='" = "'
     ),
     
     # Example: `server cvars start`
     "start_cvars": EventPattern(
         name="start_cvars",
         pattern=re.compile(r'server cvars start'),
-        extractor=lambda m: {"event_type": "start_cvars"}
+        extractor=lambda m: {"event_type": "start_cvars"},
+        prefix='server cvars start'
     ),
 
     # Example: `server cvars end`
     "end_cvars": EventPattern(
         name="end_cvars",
         pattern=re.compile(r'server cvars end'),
-        extractor=lambda m: {"event_type": "end_cvars"}
+        extractor=lambda m: {"event_type": "end_cvars"},
+        prefix='server cvars end'
     ),
 
     # Example: `Loading map "fof_sweetwater"`
     "loading_map": EventPattern(
         name="loading_map",
         pattern=re.compile(r'Loading map "(\S+)"'),
-        extractor=lambda m: {"event_type": "loading_map", "map": m[0]}
+        extractor=lambda m: {"event_type": "loading_map", "map": m[0]},
+        prefix='Loading map "'
     ),
 
     # Example: `Started map "fof_sweetwater" (CRC "6863ca2417cb94ea3e1999d2305795fc")`
     "started_map": EventPattern(
         name="started_map",
         pattern=re.compile(r'Started map "(\S+)" \(CRC "(\w+)"\)'),
-        extractor=lambda m: {"event_type": "started_map", "map": m[0], "CRC": m[1]}
+        extractor=lambda m: {"event_type": "started_map", "map": m[0], "CRC": m[1]},
+        prefix='Started map "'
     ),
 
     # Example: `Engine error: Host_Error: WatchdogHandler called - server exiting.`
     "engine_error": EventPattern(
         name="engine_error",
         pattern=re.compile(r'Engine error: (.*)'),
-        extractor=lambda m: {"event_type": "engine_error", "error": m[0]}
+        extractor=lambda m: {"event_type": "engine_error", "error": m[0]},
+        prefix='Engine error: '
     ),
 
     # Example: Banid: "<><[U:1:Numbers]><>" was banned "permanently" by "Console"
     "ban": EventPattern(
         name="ban",
         pattern=re.compile(r'Banid: "<><(\[U:\d+:\d+\])><>" was banned "(.*?)" by "(.*?)"'),
-        extractor=lambda m: {"event_type": "ban", "steam_id": m[0], "duration": m[1], "source": m[2]}
+        extractor=lambda m: {"event_type": "ban", "steam_id": m[0], "duration": m[1], "source": m[2]},
+        prefix='Banid: "<><[U:'
     ),
 
     # Example: `"Scarfy<136><[U:1:Numbers]><>" STEAM USERID validated`
     "steamid_validated": EventPattern(
         name="steamid_validated",
         pattern=re.compile(r'"(.+?)<(\d+)><(\[U:\d+:\d+\])><.*?>" STEAM USERID validated'),
-        extractor=lambda m: {"event_type": "steamid_validated", "name": m[0], "user_id": int(m[1]), "steam_id": m[2]}
+        extractor=lambda m: {"event_type": "steamid_validated", "name": m[0], "user_id": int(m[1]), "steam_id": m[2]},
+        prefix='"',
+        needs='>" STEAM USERID validated'
     ),
 
     # Example: `"BOT Mezcal<188><BOT><Desperados>" committed suicide with "world"`
     "suicide": EventPattern(
         name="suicide",
         pattern=re.compile(r'"(.+?)<(\d+)><(\[U:\d+:\d+\]|BOT|Console)><(.*?)>" committed suicide with "(.*)"'),
-        extractor=lambda m: {"event_type": "suicide", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "weapon": m[4]}
+        extractor=lambda m: {"event_type": "suicide", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "weapon": m[4]},
+        prefix='"',
+        needs='>" committed suicide with "'
     ),
 
     # Example: `"Northern Star<1948><[U:1:Numbers]><Rangers>" changed name to "yellowbelliedcoward"`
     "change_name": EventPattern(
         name="change_name",
         pattern=re.compile(r'"(.+?)<(\d+)><(\[U:\d+:\d+\]|BOT|Console)><(.*?)>" changed name to "(.*)"'),
-        extractor=lambda m: {"event_type": "change_name", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "new_name": m[4]}
+        extractor=lambda m: {"event_type": "change_name", "name": m[0], "user_id": int(m[1]), "steam_id": m[2], "team": m[3], "new_name": m[4]},
+        prefix='"',
+        needs='>" changed name to "'
     ),
 
     # Example: `Connection to Steam servers successful.`
     "steam_server_connection": EventPattern(
         name="steam_server_connection",
         pattern=re.compile(r'Connection to Steam servers successful\.'),
-        extractor=lambda m: {"event_type": "steam_server_connection"}
+        extractor=lambda m: {"event_type": "steam_server_connection"},
+        prefix='Connection to Steam servers successful.'
     ),
 
     # Example: `Connection to Steam servers lost.  (Result = 3)`
     "steam_connection_lost": EventPattern(
         name="steam_connection_lost",
         pattern=re.compile(r'Connection to Steam servers lost\.\s*\(Result = (\d+)\)'),
-        extractor=lambda m: {"event_type": "steam_connection_lost", "result": int(m[0])}
+        extractor=lambda m: {"event_type": "steam_connection_lost", "result": int(m[0])},
+        prefix='Connection to Steam servers lost.'
     ),
 
     # Example: `STEAMAUTH: Client Scarfy received failure code 6`
     "steamauth_fail": EventPattern(
         name="steamauth_fail",
         pattern=re.compile(r'STEAMAUTH: Client (.*?) received failure code (\d+)'),
-        extractor=lambda m: {"event_type": "steamauth_fail", "client": m[0], "code": int(m[1])}
+        extractor=lambda m: {"event_type": "steamauth_fail", "client": m[0], "code": int(m[1])},
+        prefix='STEAMAUTH: Client ',
+        needs=' received failure code '
     ),
 
     # Example: `=== Scarfy was kicked due high ping or unreliable connection (ping 253 loss 0) ===`
     "ping_kick": EventPattern(
         name="ping_kick",
         pattern=re.compile(r'=== (.*) was kicked due high ping or unreliable connection \(ping (\d+) loss (\d+)\) ==='),
-        extractor=lambda m: {"event_type": "ping_kick", "client": m[0], "ping": int(m[1]), "loss": int(m[2])}
+        extractor=lambda m: {"event_type": "ping_kick", "client": m[0], "ping": int(m[1]), "loss": int(m[2])},
+        prefix='=== ',
+        needs=' was kicked due high ping or unreliable connection (ping '
     ),
 
     # Example: `Public IP is 138.197.125.1`
     "public_ip": EventPattern(
         name="public_ip",
         pattern=re.compile(r'\s*Public IP is ([\d\.]+)\.'),
-        extractor=lambda m: {"event_type": "public_ip", "address": m[0]}
+        extractor=lambda m: {"event_type": "public_ip", "address": m[0]},
+        needs='Public IP is '
     ),
 
     # Example: `Assigned anonymous gameserver Steam ID [A:1:Some:Numbers].`
@@ -241,21 +292,26 @@ EVENT_PATTERNS = {
             "persistent": m[0] == "persistent",
             "anonymous": m[0] == "anonymous",
             "id": m[1]
-        }
+        },
+        prefix='Assigned ',
+        needs=' gameserver Steam ID ['
     ),
 
     # Example: `VAC secure mode is activated.`
     "vac_mode": EventPattern(
         name="vac_mode",
         pattern=re.compile(r'VAC secure mode is (\w+)\.'),
-        extractor=lambda m: {"event_type": "vac_mode", "activated": m[0] == "activated"}
+        extractor=lambda m: {"event_type": "vac_mode", "activated": m[0] == "activated"},
+        prefix='VAC secure mode is '
     ),
 
     # Example: `========== Stats For Team VIGILANTES Score: 0  Avg Skill: <1/5 - Why go on killing?> ===========\n`
     "scoreboard_team_header": EventPattern(
         name="scoreboard_team_header",
         pattern=re.compile(r'=+ Stats For Team (\w+) Score: (\d+)  Avg Skill: <(\d+)/5 - .+> =+'),
-        extractor=lambda m: {"event_type": "scoreboard_team_header", "team": m[0], "skill": int(m[1])}
+        extractor=lambda m: {"event_type": "scoreboard_team_header", "team": m[0], "skill": int(m[1])},
+        prefix='=',
+        needs=' Stats For Team '
     ),
 
     # Example: `Scarfy                             602       36       26       7        71.57% 2          1204`
@@ -286,13 +342,11 @@ def check_event(line, event):
     else:
         return None, None
 
+# The timestamp is chopped off before the rest are used
+_known_events = EventParser({name: event for name, event in EVENT_PATTERNS.items() if name != "timestamp"})
+
 def check_known_events(line):
-    for name, event in EVENT_PATTERNS.items():
-        if name == "timestamp": continue
-        match = event.pattern.match(line)
-        if match:
-            return event.name, event.extractor(match.groups())
-    return None, None
+    return _known_events.parse(line)
 
 def strip_timestamp(line): 
     return line[25:]
\ No newline at end of file
@@ -41,10 +41,13 @@ class MapSelector:
 
         self.fofclient = FofClient(host=local_addr, port=local_port, debug=debug)
 
-    async def start(self):
+    async def start(self, client=None):
+        # The plugin host passes in a client it shares with other plugins
+        if client is not None:
+            self.fofclient = client
         @self.fofclient.on_event("on_mapchange_fast")
         async def pick_map(message_data):
-            choice = message_data["data"].split(" ")[2].replace('"', '').strip()
+            choice = message_data["event"]["map"]
             if self.debug:
                 print(f"Here's the choice: {choice}")
             if choice in self.maps or choice == "_":
@@ -76,27 +79,30 @@ class MapSelector:
         #         self.nextmap = ""
 
         async def on_connect(client):
-            await client.register_event("on_mapchange_fast", startswith='Loading map "')
+            await client.register_event("on_mapchange_fast", event="loading_map")
 
         self.fofclient.on_connect(on_connect)
         await self.fofclient.run()
 
-if __name__ == "__main__":
-    async def main():
-        import yaml
-        config = {}
-        with open("configs/maplists.yml", "r") as fp:
-            config.update(yaml.safe_load(fp))
-        with open("configs/server-wrapper.yml", "r") as fp:
-            config.update(yaml.safe_load(fp))
+def load_plugin(debug=False):
+    import yaml
+    config = {}
+    with open("configs/maplists.yml", "r") as fp:
+        config.update(yaml.safe_load(fp))
+    with open("configs/server-wrapper.yml", "r") as fp:
+        config.update(yaml.safe_load(fp))
+
+    nomlist = config.get("nominate_maplist_file", "fof/maplists/team_shootout_nominate_list.txt")
+    rotlist = config.get("rotation_maplist_file", "fof/mapcycle.txt")
 
-        nomlist = config.get("nominate_maplist_file", "fof/maplists/team_shootout_nominate_list.txt")
-        rotlist = config.get("rotation_maplist_file", "fof/mapcycle.txt")
+    local_addr = config.get("fof_local_host", "127.0.0.1")
+    local_port = config.get("fof_local_port", 9000)
 
-        local_addr = config.get("fof_local_host", "127.0.0.1")
-        local_port = config.get("fof_local_port", 9000)
+    return MapSelector(nomlist, rotlist, local_addr, local_port, debug=debug)
 
-        selector = MapSelector(nomlist, rotlist, local_addr, local_port, debug=True)
+if __name__ == "__main__":
+    async def main():
+        selector = load_plugin(debug=True)
         await selector.start()
 
     asyncio.run(main())
\ No newline at end of file
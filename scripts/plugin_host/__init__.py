@@ -0,0 +1 @@
+from .plugin_host import PluginHost
@@ -0,0 +1,22 @@
+import asyncio
+
+import yaml
+
+from scripts.plugin_host import PluginHost
+
+with open("configs/server-wrapper.yml", "r") as fp:
+    config = yaml.safe_load(fp)
+with open("configs/plugin_host.yml", "r") as fp:
+    config.update(yaml.safe_load(fp))
+
+local_host = config.get("fof_local_host", "127.0.0.1")
+local_port = config.get("fof_local_port", 9000)
+plugins = config.get("plugins", [])
+max_handlers = config.get("max_handlers", 16)
+debug = config.get("debug", False)
+
+async def main():
+    host = PluginHost(plugins, local_host, local_port, debug=debug, max_handlers=max_handlers)
+    await host.run()
+
+asyncio.run(main())
@@ -0,0 +1,161 @@
+import json
+import asyncio
+import importlib
+
+from scripts.client.fofclient import FofClient
+
+class SharedClient(FofClient):
+    '''
+    A FofClient that several plugins share. Plugins that register the same
+    conditions get one event at the hub, and each line it matches is sent
+    once and handed to every plugin that asked for it.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Conditions -> the name they're registered under at the hub, and
+        # hub name -> [(plugin, the plugin's name for it)]
+        self.hub_names = {}
+        self.subscribers = {}
+        # Hub names registered since the last connect
+        self.sent = set()
+        self.on_disconnect(self._forget_sent)
+
+    async def _forget_sent(self, client):
+        self.sent.clear()
+
+    async def subscribe(self, plugin, name, registry, servers=None):
+        key = json.dumps([registry, sorted(servers) if servers is not None else None], sort_keys=True)
+        hub_name = self.hub_names.get(key)
+        if hub_name is None:
+            hub_name = name
+            # Another plugin already has something else called this
+            while hub_name in self.subscribers:
+                hub_name = f"{plugin.name}.{hub_name}"
+            self.hub_names[key] = hub_name
+            self.subscribers[hub_name] = []
+        elif self.debug:
+            print(f"[PluginHost] {plugin.name}'s {name} is the same as {hub_name}, sharing it.")
+        if (plugin, name) not in self.subscribers[hub_name]:
+            self.subscribers[hub_name].append((plugin, name))
+        # Plugins register again on every connect, but the hub only needs
+        # to hear it once
+        if hub_name not in self.sent:
+            self.sent.add(hub_name)
+            await self.register_event(hub_name, servers=servers, **registry)
+
+    async def unsubscribe(self, plugin, name):
+        for key, hub_name in list(self.hub_names.items()):
+            subscribers = self.subscribers[hub_name]
+            if (plugin, name) not in subscribers: continue
+            subscribers.remove((plugin, name))
+            if subscribers: continue
+            del self.hub_names[key]
+            del self.subscribers[hub_name]
+            self.sent.discard(hub_name)
+            await self.unregister_event(hub_name)
+
+    async def _handle_event(self, event_name, message):
+        for plugin, name in self.subscribers.get(event_name, ()):
+            handler = plugin.event_handlers.get(name)
+            if handler is None: continue
+            # Each plugin sees the event under its own name for it
+            self._dispatch(f"{plugin.name}.{name}", handler, {**message, "triggered": [name]}, name not in plugin.parallel_handlers)
+
+    def stats(self):
+        subscriptions = sum(len(subscribers) for subscribers in self.subscribers.values())
+        return {"hub_events": len(self.subscribers), "subscriptions": subscriptions, "shared": subscriptions - len(self.subscribers)}
+
+class PluginClient:
+    '''
+    What a plugin gets in place of its own FofClient when it runs in a
+    PluginHost. Events are registered through the shared client, and
+    everything else (get, store, command...) goes straight to it.
+    '''
+    def __init__(self, shared, name):
+        self.shared = shared
+        self.name = name
+        self.event_handlers = {}
+        self.parallel_handlers = set()
+        self.ready = asyncio.get_running_loop().create_future()
+        self.stopped = asyncio.Event()
+
+    def __getattr__(self, attr):
+        return getattr(self.shared, attr)
+
+    def on_event(self, name, ordered=True):
+        def decorator(func):
+            self.event_handlers[name] = func
+            if ordered:
+                self.parallel_handlers.discard(name)
+            else:
+                self.parallel_handlers.add(name)
+            return func
+        return decorator
+
+    def on_connect(self, behavior):
+        # Plugins expect to be handed their client
+        async def wrapper(client):
+            await behavior(self)
+        self.shared.on_connect(wrapper)
+
+    def on_disconnect(self, behavior):
+        async def wrapper(client):
+            await behavior(self)
+        self.shared.on_disconnect(wrapper)
+
+    async def register_event(self, name, servers=None, **registry):
+        registry = {key: value for key, value in registry.items() if value is not None}
+        await self.shared.subscribe(self, name, registry, servers)
+
+    async def unregister_event(self, name):
+        await self.shared.unsubscribe(self, name)
+
+    async def run(self, reconnect_delay=1):
+        # The host runs the connection, the plugin just has to be set up
+        if not self.ready.done():
+            self.ready.set_result(True)
+        await self.stopped.wait()
+
+class PluginHost:
+    '''
+    Runs several plugins in one process over one connection to the hub.
+    Each plugin is a module with a `load_plugin()` that returns something
+    with an async `start(client)`, which sets up its handlers and then
+    awaits `client.run()` like it would on its own.
+    '''
+    def __init__(self, modules, host="127.0.0.1", port=9000, debug=False, **client_args):
+        self.modules = modules
+        self.debug = debug
+        self.client = SharedClient(host=host, port=port, debug=debug, **client_args)
+        self.plugins = {}
+        self.plugin_tasks = []
+
+    async def start_plugin(self, module_name):
+        # One broken plugin shouldn't take the others down with it
+        name = module_name.split(".")[-1]
+        plugin_client = PluginClient(self.client, name)
+        try:
+            plugin = importlib.import_module(module_name).load_plugin()
+        except Exception as e:
+            print(f"[PluginHost] Couldn't load {module_name}: {e}")
+            return
+        task = asyncio.create_task(plugin.start(plugin_client))
+        # Wait until it's registered its on_connect, or given up
+        await asyncio.wait([task, plugin_client.ready], return_when=asyncio.FIRST_COMPLETED)
+        if task.done() and task.exception() is not None:
+            print(f"[PluginHost] {module_name} failed to start: {task.exception()}")
+            return
+        self.plugins[name] = plugin_client
+        self.plugin_tasks.append(task)
+        if self.debug: print(f"[PluginHost] Loaded {module_name}.")
+
+    async def run(self, reconnect_delay=1):
+        for module_name in self.modules:
+            await self.start_plugin(module_name)
+        print(f"[PluginHost] Running {len(self.plugins)} plugins: {', '.join(self.plugins)}")
+        try:
+            await self.client.run(reconnect_delay)
+        finally:
+            for plugin_client in self.plugins.values():
+                plugin_client.stopped.set()
+            await asyncio.gather(*self.plugin_tasks, return_exceptions=True)
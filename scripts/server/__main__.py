@@ -10,32 +10,112 @@ from scripts.server.fof_server_event_handler import FofServerEventHandler
 with open("configs/server-wrapper.yml", "r") as fp:
     config = yaml.safe_load(fp)
 load_dotenv("configs/server-wrapper.env")
+load_dotenv("configs/server-wrapper-secrets.env")
 
 local_host = config.get("fof_local_host", "127.0.0.1")
 local_port = config.get("fof_local_port", "9000")
+client_queue_size = config.get("client_queue_size", 1000)
+client_overflow_policy = config.get("client_overflow_policy", "drop_oldest")
+local_socket = config.get("fof_local_socket", None)
+ring_slots = config.get("shm_ring_slots", 4096)
+ring_slot_size = config.get("shm_ring_slot_size", 1024)
+journal_dir = config.get("journal_dir", None)
+journal_segment_mb = config.get("journal_segment_mb", 16)
+journal_max_age_hours = config.get("journal_max_age_hours", 24)
+store_dir = config.get("store_dir", None)
+store_memory_mb = config.get("store_memory_mb", 0)
+store_wal_mb = config.get("store_wal_mb", 16)
+store_snapshot_minutes = config.get("store_snapshot_minutes", 5)
+local_plugins = config.get("local_plugins", [])
+local_plugin_budget_ms = config.get("local_plugin_budget_ms", 5)
+local_plugin_max_overruns = config.get("local_plugin_max_overruns", 10)
 
 starting_map = config.get("starting_map", "fof_fistful")
 max_players = str(config.get("max_players", "20"))
 server_port = str(config.get("server_port", "27015"))
+pty_buffer_lines = config.get("pty_buffer_lines", 10000)
+command_rate = config.get("command_rate", 20)
+command_timeout = config.get("command_timeout", 5.0)
+rcon_addr = config.get("fof_rcon_address", None)
+rcon_port = config.get("fof_rcon_port", 27015)
+rcon_password = os.environ.get("FOF_RCON_PASSWORD", "")
+rcon_pool_size = config.get("rcon_pool_size", 2)
 
-launch_cmd = [
-    './srcds_run',
-    '-game', 'fof',
-    '+map', starting_map,
-    '+maxplayers', max_players,
-    '-debug',
-    '-port', server_port
-]
-
-fof_server = FofServerWrapper(
-    launch_cmd=launch_cmd,
-    debug=True
-)
+servers = config.get("servers", None)
+match_workers = config.get("match_workers", 0)
+aggregator = config.get("aggregator", False)
+relay_token = os.environ.get("FOF_RELAY_TOKEN", None) or None
+relay_upstream = config.get("relay_upstream", None)
+# Relay links come from other machines, so there's no relaying without a token
+if (aggregator or relay_upstream) and not relay_token:
+    raise SystemExit("Set FOF_RELAY_TOKEN in server-wrapper-secrets.env to run an aggregator or relay.")
+relay = None
+if relay_upstream:
+    relay_host, relay_port = relay_upstream.rsplit(":", 1)
+    relay = {
+        "host": relay_host,
+        "port": int(relay_port),
+        "origin": config.get("relay_origin", relay_host),
+        "registry": config.get("relay_events", {}),
+        "token": relay_token,
+        "window_ms": config.get("relay_window_ms", 100),
+        "max_events": config.get("relay_max_events", 256),
+        "max_pending": config.get("relay_max_pending", 10000)
+    }
+
+def make_server(entry):
+    # Entries in 'servers' can override any of the single-server settings
+    port = str(entry.get("server_port", server_port))
+    launch_cmd = [
+        './srcds_run',
+        '-game', 'fof',
+        '+map', entry.get("starting_map", starting_map),
+        '+maxplayers', str(entry.get("max_players", max_players)),
+        '-debug',
+        '-port', port
+    ]
+    return FofServerWrapper(
+        launch_cmd=launch_cmd,
+        buffer_lines=pty_buffer_lines,
+        command_rate=command_rate,
+        command_timeout=command_timeout,
+        rcon_addr=entry.get("fof_rcon_address", rcon_addr),
+        rcon_port=entry.get("fof_rcon_port", entry.get("server_port", rcon_port)),
+        rcon_password=rcon_password,
+        rcon_pool_size=rcon_pool_size,
+        debug=True
+    )
+
+if aggregator:
+    # No servers of its own, just events relayed from other hubs
+    fof_server = {}
+elif servers:
+    fof_server = {entry["id"]: make_server(entry) for entry in servers}
+else:
+    fof_server = make_server({})
 
 event_handler = FofServerEventHandler(
     fof_server,
     host=local_host,
     port=local_port,
+    client_queue_size=client_queue_size,
+    client_overflow_policy=client_overflow_policy,
+    unix_socket=local_socket,
+    ring_slots=ring_slots,
+    ring_slot_size=ring_slot_size,
+    journal_dir=journal_dir,
+    journal_segment_bytes=journal_segment_mb * 1024 * 1024,
+    journal_max_age=journal_max_age_hours * 60 * 60,
+    match_workers=match_workers,
+    relay=relay,
+    relay_token=relay_token,
+    store_dir=store_dir,
+    store_memory_budget=store_memory_mb * 1024 * 1024 or None,
+    store_wal_bytes=store_wal_mb * 1024 * 1024,
+    store_snapshot_interval=store_snapshot_minutes * 60,
+    local_plugins=local_plugins,
+    local_plugin_budget_ms=local_plugin_budget_ms,
+    local_plugin_max_overruns=local_plugin_max_overruns,
     debug=True
 )
 
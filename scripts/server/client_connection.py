@@ -0,0 +1,258 @@
+import asyncio
+from collections import deque
+
+from scripts.server.wire import JsonLines, is_loopback
+
+class ClientConnection:
+    '''
+    Outbound side of a plugin connection. Messages are put on a queue and
+    written by a separate task, so nothing that sends to a client ever waits
+    on that client reading its socket.
+
+    Events go on a bounded queue, and the overflow policy decides what
+    happens when a client falls behind. Everything else (responses,
+    invalidations, watch changes) is something the client is counting on, so
+    it goes on its own queue that's never dropped from. A client that lets
+    even that pile up past `URGENT_LIMIT` times the event queue size is
+    disconnected.
+    '''
+    OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "disconnect")
+    URGENT_LIMIT = 10
+
+    def __init__(self, addr, writer, local=False, max_queue=1000, overflow="drop_oldest", debug=False):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}', expected one of {self.OVERFLOW_POLICIES}")
+        self.addr = addr
+        self.writer = writer
+        self.wire = JsonLines()
+        # Same-host clients (on the unix socket) can read lines from the
+        # shared memory ring instead of getting them over the socket
+        self.local = local
+        # Clients allowed binary (marshal) framing: ones on this machine, or
+        # that sent the hub's token
+        self.trusted = local or is_loopback(addr)
+        self.use_ring = False
+        self.overflow = overflow
+        self.debug = debug
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.urgent = deque()
+        self.urgent_high_water = 0
+        self.wakeup = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.closed = False
+        # Opt-in event batching: events are held for up to batch_window
+        # seconds (or batch_max_events events) and sent as one frame
+        self.batch_window = None
+        self.batch_max_events = None
+        self.pending_events = []
+        self.batch_timer = None
+        # While a journal replay is running, live events are held back so
+        # they don't arrive ahead of the older ones being replayed (up to
+        # max_queue of them, then the overflow policy applies)
+        self.holding = False
+        self.held_events = deque()
+        self.replay_pending = {}
+        self.replay_start = None
+        self.replay_task = None
+        # Events registered for only some servers (supervisor mode)
+        self.event_servers = {}
+        # Data store changes waiting to go out to a watching client, and
+        # how long each watched prefix lets them pile up
+        self.pending_changes = {}
+        self.change_timer = None
+        self.watch_windows = {}
+        # The last store version sent for each watched prefix, which the
+        # next 'changes' names as its base
+        self.watch_versions = {}
+        # Set if this connection is another hub relaying its events here
+        self.origin = None
+        self.writer_task = asyncio.create_task(self._write_queued())
+
+    def set_wire(self, wire):
+        # Anything already queued was framed for the old format
+        self.flush_events()
+        self.wire = wire
+
+    def send(self, message):
+        '''
+        Queues a response or control message, which is never dropped.
+        '''
+        if self.closed: return False
+        limit = self.queue.maxsize * self.URGENT_LIMIT
+        if limit and len(self.urgent) >= limit:
+            if self.debug:
+                print(f"[ClientConnection] {self.addr} isn't reading its responses, disconnecting.")
+            self.close()
+            return False
+        self.urgent.append(self.wire.frame(self.wire.dumps(message)))
+        self.urgent_high_water = max(self.urgent_high_water, len(self.urgent))
+        self.wakeup.set()
+        return True
+
+    def send_body(self, body):
+        return self.send_frame(self.wire.frame(body))
+
+    def send_frame(self, data):
+        '''
+        Queues a framed event for the client without waiting. Returns False
+        if the message was dropped (or the client is going away).
+        '''
+        if self.closed: return False
+        if self.queue.full():
+            if not self._overflowed():
+                return False
+            self.queue.get_nowait()
+        self.queue.put_nowait(data)
+        self.high_water = max(self.high_water, self.queue.qsize())
+        self.wakeup.set()
+        return True
+
+    def _overflowed(self):
+        # For a full queue: counts the drop and returns True if the oldest
+        # message should make room for the new one
+        self.dropped += 1
+        if self.overflow == "drop_oldest":
+            return True
+        if self.overflow == "disconnect":
+            if self.debug:
+                print(f"[ClientConnection] {self.addr} fell {self.queue.maxsize} messages behind, disconnecting.")
+            self.close()
+        return False
+
+    def set_batching(self, window_ms=None, max_events=32):
+        '''
+        Turns batching on with the given window, or off if window_ms is None.
+        '''
+        self.flush_events()
+        # A missing or nonsense value shouldn't cost the client its connection
+        try:
+            self.batch_window = max(0.0, float(window_ms)) / 1000 if window_ms is not None else None
+        except (TypeError, ValueError):
+            self.batch_window = None
+        try:
+            self.batch_max_events = max(1, int(max_events))
+        except (TypeError, ValueError):
+            self.batch_max_events = 32
+
+    def send_event(self, event, triggered, replay=False):
+        '''
+        Sends a SharedEvent with this client's triggered events, either right
+        away or as part of the next batch frame.
+        '''
+        if self.holding and not replay:
+            if self.closed: return False
+            if self.queue.maxsize and len(self.held_events) >= self.queue.maxsize:
+                if not self._overflowed():
+                    return False
+                self.held_events.popleft()
+            self.held_events.append((event, triggered))
+            return True
+        body = event.body(self.wire, triggered, self.use_ring)
+        if self.batch_window is None:
+            return self.send_body(body)
+        self.pending_events.append(body)
+        if len(self.pending_events) >= self.batch_max_events:
+            self.flush_events()
+        elif self.batch_timer is None:
+            self.batch_timer = asyncio.get_running_loop().call_later(self.batch_window, self.flush_events)
+        return True
+
+    def wants(self, event_name, server_id):
+        servers = self.event_servers.get(event_name)
+        return servers is None or server_id in servers
+
+    def hold_events(self):
+        self.holding = True
+
+    def release_events(self, replayed):
+        '''
+        Sends everything held during a replay. `replayed` maps (server id,
+        event name) to the last sequence number the replay covered, and those
+        are left out since the client already got them from the replay.
+        '''
+        held, self.held_events = self.held_events, deque()
+        self.holding = False
+        for event, triggered in held:
+            seq, server_id = event.shared.get("seq", 0), event.shared.get("server")
+            triggered = [name for name in triggered if seq > replayed.get((server_id, name), 0)]
+            if triggered:
+                self.send_event(event, triggered)
+
+    async def wait_for_room(self):
+        # Replays can produce events much faster than they can be written, so
+        # they wait for the queue to come down instead of overflowing it
+        while not self.closed and self.queue.maxsize and self.queue.qsize() >= self.queue.maxsize // 2:
+            await asyncio.sleep(0.01)
+
+    def flush_events(self):
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        if not self.pending_events: return
+        body = self.wire.batch_body(self.pending_events)
+        self.pending_events = []
+        self.send_body(body)
+
+    async def _write_queued(self):
+        try:
+            while True:
+                if not self.urgent and self.queue.empty():
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                # Everything that piled up goes out with the same drain,
+                # responses first
+                while self.urgent:
+                    self.writer.write(self.urgent.popleft())
+                    self.sent += 1
+                while not self.queue.empty():
+                    self.writer.write(self.queue.get_nowait())
+                    self.sent += 1
+                await self.writer.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.debug:
+                print(f"[ClientConnection] Write to {self.addr} failed: {e}")
+            self.close()
+
+    def close(self):
+        # Closing the transport also ends the protocol's read loop for this
+        # client, which takes care of unregistering its events
+        self.closed = True
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        if self.change_timer is not None:
+            self.change_timer.cancel()
+            self.change_timer = None
+        self.writer.close()
+
+    async def wait_closed(self):
+        self.close()
+        self.writer_task.cancel()
+        try:
+            await self.writer_task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "responses_queued": len(self.urgent),
+            "responses_high_water": self.urgent_high_water,
+            "max_queue": self.queue.maxsize,
+            "high_water": self.high_water,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "overflow": self.overflow,
+            "framing": self.wire.name,
+            "ring": self.use_ring,
+            "batch_window_ms": self.batch_window * 1000 if self.batch_window is not None else None,
+            "replaying": self.holding
+        }
@@ -0,0 +1,168 @@
+import os
+import time
+import asyncio
+import itertools
+
+class CommandPipeline:
+    '''
+    Serializes console commands going to the server. Commands are written one
+    at a time (at most `rate` per second) by a single task. A captured read
+    (one of READ_COMMANDS) that's sent again while an identical one is still
+    waiting to go out just shares the first one's future. Anything else is
+    sent as many times as it was asked for, since running it twice isn't the
+    same as running it once.
+
+    A captured command is wrapped in two `echo` markers, and the console lines
+    that come back between them are the command's output. Output lines are fed
+    in with `feed` as they're read, so capturing only works while something is
+    reading the server output.
+    '''
+    MARKER = "fofcmd"
+    # Commands that only print something, so one run can answer everyone
+    # waiting on it
+    READ_COMMANDS = frozenset(("status", "stats", "users", "version", "maps *", "listid", "listip", "cvarlist", "sm plugins list", "meta list"))
+
+    def __init__(self, fd, rate=20, timeout=5.0, debug=False):
+        self.fd = fd
+        self.min_interval = 1 / rate if rate else 0
+        self.timeout = timeout
+        self.debug = debug
+        self.queue = asyncio.Queue()
+        self.queued = {}
+        # Captures that have been written, oldest first
+        self.captures = []
+        self.ids = itertools.count(1)
+        self.last_write = 0
+        self.worker_task = None
+        # The command the worker has taken off the queue, if any
+        self.writing = None
+        # Metrics
+        self.written = 0
+        self.coalesced = 0
+        self.timed_out = 0
+
+    def start(self):
+        self.worker_task = asyncio.create_task(self._write_commands())
+
+    async def stop(self):
+        if self.worker_task is not None:
+            self.worker_task.cancel()
+            try:
+                await self.worker_task
+            except asyncio.CancelledError:
+                pass
+            self.worker_task = None
+        # Nothing's going to write these now
+        if self.writing is not None and not self.writing["future"].done():
+            self.writing["future"].cancel()
+        self.writing = None
+        while not self.queue.empty():
+            entry = self.queue.get_nowait()
+            if not entry["future"].done():
+                entry["future"].cancel()
+        self.queued = {}
+        for capture in self.captures:
+            if not capture["future"].done():
+                capture["future"].cancel()
+        self.captures = []
+
+    def submit(self, command, capture=False):
+        '''
+        Queues a command and returns a future. Plain commands resolve to None
+        once they've been written, captured ones to the list of output lines.
+        '''
+        key = command.strip() if capture and command.strip() in self.READ_COMMANDS else None
+        entry = self.queued.get(key) if key is not None else None
+        if entry is not None:
+            self.coalesced += 1
+            return entry["future"]
+        entry = {"command": command, "capture": capture, "key": key, "future": asyncio.get_running_loop().create_future()}
+        if key is not None:
+            self.queued[key] = entry
+        self.queue.put_nowait(entry)
+        return entry["future"]
+
+    async def _write_commands(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.writing = None
+            entry = self.writing = await self.queue.get()
+            if entry["key"] is not None:
+                self.queued.pop(entry["key"], None)
+            wait = self.last_write + self.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            text = f"{entry['command']}\n"
+            if entry["capture"]:
+                marker = f"{self.MARKER}-{next(self.ids)}"
+                capture = {
+                    "command": entry["command"], "begin": f"{marker}-begin", "end": f"{marker}-end",
+                    "started": False, "lines": [], "future": entry["future"]
+                }
+                capture["timer"] = loop.call_later(self.timeout, self._expire, capture)
+                self.captures.append(capture)
+                text = f"echo {capture['begin']}\n{text}echo {capture['end']}\n"
+
+            try:
+                # A full PTY input buffer would block, so keep it off the loop
+                await loop.run_in_executor(None, os.write, self.fd, text.encode())
+            except Exception as e:
+                if self.debug:
+                    print(f"[CommandPipeline] Failed to write '{entry['command']}': {e}")
+                if entry["capture"]:
+                    self._finish(capture)
+                if not entry["future"].done():
+                    entry["future"].set_exception(e)
+                continue
+            self.last_write = time.monotonic()
+            self.written += 1
+            if not entry["capture"] and not entry["future"].done():
+                entry["future"].set_result(None)
+
+    def feed(self, line):
+        '''
+        Checks a line of server output against the running captures. Returns
+        True if it was one of the markers, which aren't real server output.
+        '''
+        if self.MARKER not in line:
+            for capture in self.captures:
+                if capture["started"]:
+                    # The terminal echoes the command itself back first
+                    if capture["lines"] or line.strip() != capture["command"]:
+                        capture["lines"].append(line.rstrip("\r"))
+                    return False
+            return False
+
+        stripped = line.strip()
+        for capture in self.captures:
+            if stripped == capture["begin"]:
+                capture["started"] = True
+                return True
+            if stripped == capture["end"]:
+                self._finish(capture)
+                if not capture["future"].done():
+                    capture["future"].set_result(capture["lines"])
+                return True
+        # The terminal's echo of the 'echo' commands
+        return stripped.startswith(f"echo {self.MARKER}-")
+
+    def _finish(self, capture):
+        capture["timer"].cancel()
+        if capture in self.captures:
+            self.captures.remove(capture)
+
+    def _expire(self, capture):
+        self._finish(capture)
+        self.timed_out += 1
+        if not capture["future"].done():
+            capture["future"].set_exception(asyncio.TimeoutError(f"No output marker for '{capture['command']}'"))
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "capturing": len(self.captures),
+            "written": self.written,
+            "coalesced": self.coalesced,
+            "timed_out": self.timed_out
+        }
@@ -0,0 +1,396 @@
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+class SubstringAutomaton:
+    '''
+    Aho-Corasick automaton over a fixed set of substrings. One pass over the
+    text reports every pattern that occurs in it.
+    '''
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        self.always = "" in patterns
+
+        for pattern in patterns:
+            if not pattern: continue
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                node = nxt
+            self.out[node] = (pattern,)
+
+        # Breadth-first pass for the failure links, folding outputs of the
+        # failure target into each node so the scan never walks output chains
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and ch not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(ch, 0)
+                if self.out[self.fail[child]]:
+                    self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def search(self, text):
+        found = {""} if self.always else set()
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class AffixTrie:
+    '''
+    Character trie of prefixes (or suffixes when reverse=True). Walking a line
+    through it yields every registered value the line starts (or ends) with.
+    '''
+    def __init__(self, reverse=False):
+        self.root = {}
+        self.reverse = reverse
+
+    def _chars(self, text):
+        return reversed(text) if self.reverse else text
+
+    def add(self, value):
+        node = self.root
+        for ch in self._chars(value):
+            node = node.setdefault(ch, {})
+        node[None] = value
+
+    def remove(self, value):
+        path = []
+        node = self.root
+        for ch in self._chars(value):
+            if ch not in node: return
+            path.append((node, ch))
+            node = node[ch]
+        node.pop(None, None)
+
+        # Prune branches that no longer lead anywhere
+        for parent, ch in reversed(path):
+            if parent[ch]: break
+            del parent[ch]
+
+    def search(self, text):
+        node = self.root
+        found = [node[None]] if None in node else []
+        for ch in self._chars(text):
+            node = node.get(ch)
+            if node is None: break
+            if None in node: found.append(node[None])
+        return found
+
+
+class SubstringSet:
+    '''
+    Reference-counted set of substrings that can report which of them occur
+    in a line. Large sets are searched with a SubstringAutomaton.
+    '''
+    # Below this many substrings, the C-level `in` check beats walking the
+    # automaton character by character in Python
+    AUTOMATON_MIN_PATTERNS = 24
+
+    def __init__(self):
+        self.refcounts = {}
+        self.automaton = None
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.refcounts)
+
+    def add(self, value):
+        self.refcounts[value] = self.refcounts.get(value, 0) + 1
+        if self.refcounts[value] == 1:
+            self.dirty = True
+
+    def remove(self, value):
+        if value not in self.refcounts: return
+        self.refcounts[value] -= 1
+        if not self.refcounts[value]:
+            del self.refcounts[value]
+            self.dirty = True
+
+    def search(self, text):
+        # The automaton only changes when the substring set does, so it is
+        # rebuilt lazily on the next line rather than on every add/remove
+        if self.dirty:
+            if len(self.refcounts) >= self.AUTOMATON_MIN_PATTERNS:
+                self.automaton = SubstringAutomaton(list(self.refcounts))
+            else:
+                self.automaton = None
+            self.dirty = False
+
+        if self.automaton is not None:
+            return self.automaton.search(text)
+        return [val for val in self.refcounts if val in text]
+
+
+class ConditionIndex:
+    '''
+    Compiled lookup structures for the plain-string condition types used by
+    EventEngine. Conditions are added when they first appear in the registry
+    and removed when their last callback goes away.
+    '''
+    SUBSTRING_TYPES = ("match", "exclude")
+
+    def __init__(self):
+        self.substrings = SubstringSet()
+        self.prefixes = AffixTrie()
+        self.suffixes = AffixTrie(reverse=True)
+
+    def add(self, condition):
+        type_, val = condition
+        if type_ in self.SUBSTRING_TYPES:
+            self.substrings.add(val)
+        elif type_ == "startswith":
+            self.prefixes.add(val)
+        elif type_ == "endswith":
+            self.suffixes.add(val)
+
+    def remove(self, condition):
+        type_, val = condition
+        if type_ in self.SUBSTRING_TYPES:
+            self.substrings.remove(val)
+        elif type_ == "startswith":
+            self.prefixes.remove(val)
+        elif type_ == "endswith":
+            self.suffixes.remove(val)
+
+    def search(self, text):
+        '''
+        Returns the conditions whose value was found in the text. For
+        'exclude' conditions, being found means the condition failed.
+        '''
+        hits = []
+        for val in self.substrings.search(text):
+            hits.append(("match", val))
+            hits.append(("exclude", val))
+        for val in self.prefixes.search(text):
+            hits.append(("startswith", val))
+        for val in self.suffixes.search(text):
+            hits.append(("endswith", val))
+        return hits
+
+
+def _iter_ops(items):
+    # Yields every opcode in a parsed pattern, including nested ones
+    for op, av in items:
+        yield op
+        stack = [av]
+        while stack:
+            value = stack.pop()
+            if isinstance(value, sre_parse.SubPattern):
+                yield from _iter_ops(value.data)
+            elif isinstance(value, (tuple, list)):
+                stack.extend(value)
+
+def _literal_runs(items):
+    # Runs of literal characters that every match of `items` has to contain
+    runs, current = [], []
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            current.append(chr(av))
+            continue
+        if current:
+            runs.append("".join(current))
+            current = []
+        if op is sre_parse.SUBPATTERN:
+            _, add_flags, del_flags, sub = av
+            if not add_flags and not del_flags:
+                runs.extend(_literal_runs(sub.data))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            runs.extend(_literal_runs(av[2].data))
+    if current:
+        runs.append("".join(current))
+    return runs
+
+def analyze_regex(pattern):
+    '''
+    Returns (literal, mergeable) for a pattern: the longest literal substring
+    any match must contain (None if there isn't one), and whether the pattern
+    can be embedded in a larger alternation without changing its meaning.
+    '''
+    parsed = sre_parse.parse(pattern)
+    flags = parsed.state.flags & ~re.UNICODE
+
+    literal = None
+    if not flags & re.IGNORECASE:
+        literal = max(_literal_runs(parsed.data), key=len, default=None)
+
+    # Global flags, named groups and backreferences all break (or change
+    # meaning) once the pattern is wrapped in somebody else's group
+    mergeable = not flags and not parsed.state.groupdict and not any(
+        op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS) for op in _iter_ops(parsed.data)
+    )
+    return literal, mergeable
+
+
+class RegexIndex:
+    '''
+    Reference-counted set of regex conditions. Each pattern is compiled once,
+    patterns are skipped when a literal they require is missing from the line,
+    and the survivors are searched together as a single alternation.
+    '''
+    MERGED_CACHE_SIZE = 256
+
+    def __init__(self):
+        self.compiled = {}
+        self.refcounts = {}
+        self.literals = SubstringSet()
+        self.literal_of = {}
+        self.by_literal = {}
+        self.unfiltered = set()
+        self.standalone = set()
+        self.group_names = {}
+        self.by_group = {}
+        self.next_group = 0
+        self.merged_cache = {}
+
+    def add(self, pattern):
+        if pattern in self.refcounts:
+            self.refcounts[pattern] += 1
+            return
+        compiled = re.compile(pattern)
+        literal, mergeable = analyze_regex(pattern)
+
+        self.refcounts[pattern] = 1
+        self.compiled[pattern] = compiled
+        self.literal_of[pattern] = literal
+        if literal is None:
+            self.unfiltered.add(pattern)
+        else:
+            self.literals.add(literal)
+            self.by_literal.setdefault(literal, set()).add(pattern)
+        if mergeable:
+            name = f"r{self.next_group}"
+            self.next_group += 1
+            self.group_names[pattern] = name
+            self.by_group[name] = pattern
+        else:
+            self.standalone.add(pattern)
+        self.merged_cache.clear()
+
+    def remove(self, pattern):
+        if pattern not in self.refcounts: return
+        self.refcounts[pattern] -= 1
+        if self.refcounts[pattern]: return
+
+        del self.refcounts[pattern]
+        del self.compiled[pattern]
+        literal = self.literal_of.pop(pattern)
+        if literal is None:
+            self.unfiltered.discard(pattern)
+        else:
+            self.literals.remove(literal)
+            self.by_literal[literal].discard(pattern)
+            if not self.by_literal[literal]:
+                del self.by_literal[literal]
+        if pattern in self.group_names:
+            del self.by_group[self.group_names.pop(pattern)]
+        self.standalone.discard(pattern)
+        self.merged_cache.clear()
+
+    def _merged(self, patterns):
+        key = frozenset(patterns)
+        merged = self.merged_cache.get(key)
+        if merged is None:
+            if len(self.merged_cache) >= self.MERGED_CACHE_SIZE:
+                self.merged_cache.clear()
+            merged = re.compile("|".join(f"(?P<{self.group_names[p]}>{p})" for p in patterns))
+            self.merged_cache[key] = merged
+        return merged
+
+    def search(self, text):
+        '''
+        Returns the patterns that match somewhere in the text.
+        '''
+        if not self.refcounts: return []
+
+        candidates = set(self.unfiltered)
+        for literal in self.literals.search(text):
+            candidates.update(self.by_literal[literal])
+
+        matched = []
+        remaining = []
+        for pattern in candidates:
+            if pattern in self.standalone:
+                if self.compiled[pattern].search(text):
+                    matched.append(pattern)
+            else:
+                remaining.append(pattern)
+
+        # A failed search of the alternation means none of its members match;
+        # a hit names one member, which is dropped before scanning again
+        while remaining:
+            if len(remaining) == 1:
+                if self.compiled[remaining[0]].search(text):
+                    matched.append(remaining[0])
+                break
+            match = self._merged(remaining).search(text)
+            if not match: break
+            pattern = self.by_group[match.lastgroup]
+            matched.append(pattern)
+            remaining.remove(pattern)
+        return matched
+
+
+class FieldPredicate:
+    '''
+    Compiled 'fields' condition for structured events. The spec maps field
+    names (dotted for nested fields, like 'attacker.steam_id') to either a
+    plain value to compare against, or a dict of string-condition checks.
+    '''
+    OPS = ("equal", "match", "exclude", "startswith", "endswith", "regex", "in")
+
+    def __init__(self, spec):
+        self.checks = []
+        for path, expected in spec.items():
+            ops = expected if isinstance(expected, dict) else {"equal": expected}
+            for op, val in ops.items():
+                if op not in self.OPS:
+                    raise ValueError(f"Unknown field check '{op}' for field '{path}'")
+                if op == "regex":
+                    val = re.compile(val)
+                self.checks.append((path.split("."), op, val))
+
+    @staticmethod
+    def _lookup(fields, path):
+        for key in path:
+            if not isinstance(fields, dict) or key not in fields:
+                raise KeyError(key)
+            fields = fields[key]
+        return fields
+
+    def __call__(self, fields):
+        for path, op, val in self.checks:
+            try:
+                value = self._lookup(fields, path)
+            except KeyError:
+                return False
+            if op == "equal": ok = value == val
+            elif op == "in": ok = value in val
+            elif not isinstance(value, str): ok = False
+            elif op == "match": ok = val in value
+            elif op == "exclude": ok = val not in value
+            elif op == "startswith": ok = value.startswith(val)
+            elif op == "endswith": ok = value.endswith(val)
+            else: ok = val.search(value) is not None
+            if not ok: return False
+        return True
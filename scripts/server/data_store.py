@@ -1,20 +1,346 @@
+import os
+import time
+import heapq
+from collections import deque, OrderedDict
+
+from scripts.server.path_index import PathIndex
+
 class DataStore:
-    def __init__(self):
-        self.anonymous_data = {}
+    '''
+    Shared storage for plugins, indexed by lists of keys. It reads and writes
+    like a nested dict (and is kept as one, see PathIndex), but any subtree
+    can be listed a page at a time with `scan` and knows roughly how big it
+    is. Every change bumps `version`, and the last `history` changed paths are kept so
+    watchers can catch up on what changed since a version they've seen. Versions only mean
+    anything within one `epoch`, which is new every time the store is created or restored.
+
+    Besides plain stores, the usual read-modify-write updates (counters,
+    capped lists, compare-and-set) happen here in one step, so plugins don't
+    race each other doing them with a get and a store. Any path can be given
+    a TTL, after which it's deleted by `expire`.
+
+    With `files` (a StoreFiles), every change is logged and `checkpoint`
+    snapshots the store, so it survives restarts. With a `memory_budget` as
+    well, the least recently used top-level keys are dropped from memory at
+    checkpoints (and read back from their snapshot files when they're next
+    used) until the rest fit in it.
+    '''
+    # Returned by `get` for paths that don't exist when asked for it
+    MISSING = object()
+
+    def __init__(self, history=10000, files=None, memory_budget=None, wal_max_bytes=16 * 1024 * 1024):
+        self.index = PathIndex()
+        self.version = 0
+        self.epoch = os.urandom(8).hex()
+        self.changes = deque(maxlen=history)
+        self.files = files
+        self.memory_budget = memory_budget
+        self.wal_max_bytes = wal_max_bytes
+        # Called when the log outgrows wal_max_bytes, so the owner can
+        # checkpoint soon (rather than in the middle of a store). Without
+        # one, it checkpoints right away.
+        self.on_wal_full = None
+        # Top-level keys only on disk, the snapshot size of each top-level
+        # key (least recently used first), and ones changed since the last
+        # snapshot
+        self.evicted = set()
+        self.sizes = OrderedDict()
+        self.dirty = set()
+        self.replaying = False
+        # Metrics
+        self.loads = 0
+        self.evictions = 0
+        self.checkpoints = 0
+        # Path -> deadline, and a heap of (deadline, path) to find the next
+        # one (entries for TTLs that were changed since are skipped)
+        self.expiries = {}
+        self.expiry_heap = []
+
+    def _touch(self, keys):
+        # Reads an evicted top-level key back in before it's used
+        if not keys:
+            for key in list(self.evicted):
+                self._touch([key])
+            return
+        key = keys[0]
+        if key in self.evicted:
+            self.evicted.discard(key)
+            self.index.set((key,), self.files.read_subtree(key))
+            self.loads += 1
+        if key in self.sizes:
+            self.sizes.move_to_end(key)
+
+    def _log(self, record):
+        if self.files is None or self.replaying: return
+        self.files.log((self.version,) + record)
+        if self.files.wal_bytes > self.wal_max_bytes:
+            if self.on_wal_full is not None:
+                self.on_wal_full()
+            else:
+                self.checkpoint()
+
+    def _deadline(self, ttl):
+        # TTLs are logged as wall clock deadlines so they survive restarts
+        return time.time() + ttl if ttl is not None else None
+
+    def _changed(self, keys, ttl=None, keep_ttl=False):
+        self.version += 1
+        self.changes.append((self.version, list(keys)))
+        if self.files is not None:
+            self.dirty.add(keys[0])
+            self.sizes.setdefault(keys[0], 0)
+        if ttl is not None:
+            self.set_ttl(keys, ttl)
+        elif not keep_ttl and self.expiries:
+            self.expiries.pop(tuple(keys), None)
+        return self.version
+
+    def _replaced(self, path):
+        # TTLs under a replaced dict would otherwise go off on whatever is
+        # stored there next
+        if not self.expiries or not self.index.has_children(path): return
+        for expiring in [p for p in self.expiries if len(p) > len(path) and p[:len(path)] == path]:
+            del self.expiries[expiring]
 
     def store(self, body):
-        keys, payload = body["keys"], body["payload"]
-        dict_ = self.anonymous_data
-        for key in keys[:-1]:
-            if key not in dict_ or not isinstance(dict_[key], dict):
-                dict_[key] = {}
-            dict_ = dict_[key]
-        dict_[keys[-1]] = payload
-
-    def get(self, keys):
-        dict_ = self.anonymous_data
-        for key in keys[:-1]:
-            if key not in dict_ or not isinstance(dict_[key], dict):
-                return None
-            dict_ = dict_[key]
-        return dict_.get(keys[-1], None)
\ No newline at end of file
+        keys, payload, ttl = body["keys"], body["payload"], body.get("ttl")
+        # The hot path, so the steps that only matter with files or TTLs
+        # are skipped up front
+        if self.files is not None:
+            self._touch(keys)
+        path = tuple(keys)
+        if self.expiries:
+            self._replaced(path)
+        self.index.set(path, payload)
+        self._changed(keys, ttl)
+        if self.files is not None:
+            self._log(("store", keys, payload, self._deadline(ttl)))
+        return self.version
+
+    def get(self, keys, default=None):
+        if self.files is not None:
+            self._touch(keys)
+        return self.index.get(tuple(keys), default)
+
+    def incr(self, keys, amount=1, ttl=None):
+        '''
+        Adds to the number at `keys` (starting from 0) and returns the total.
+        '''
+        self._touch(keys)
+        path = tuple(keys)
+        value = self.index.get(path, 0)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise TypeError(f"Can't increment {type(value).__name__} at {keys}")
+        value += amount
+        self.index.set(path, value)
+        self._changed(keys, ttl, keep_ttl=True)
+        self._log(("incr", keys, amount, self._deadline(ttl)))
+        return value
+
+    def extend(self, keys, items, cap=None, ttl=None):
+        '''
+        Adds items to the end of the list at `keys` (starting from an empty
+        one), dropping the oldest past `cap`. Returns the new length.
+        '''
+        self._touch(keys)
+        path = tuple(keys)
+        value = self.index.get(path, [])
+        if not isinstance(value, list):
+            raise TypeError(f"Can't append to {type(value).__name__} at {keys}")
+        value.extend(items)
+        if cap is not None and len(value) > cap:
+            del value[:len(value) - cap]
+        # Set again even if it was already there, so its size is updated
+        self.index.set(path, value)
+        self._changed(keys, ttl, keep_ttl=True)
+        self._log(("extend", keys, items, cap, self._deadline(ttl)))
+        return len(value)
+
+    def cas(self, keys, expected, payload, ttl=None):
+        '''
+        Stores `payload` only if the value at `keys` is `expected` (None for
+        a path that doesn't exist). Returns whether it did, and the value
+        that's there now.
+        '''
+        self._touch(keys)
+        current = self.index.get(tuple(keys))
+        if current != expected:
+            return False, current
+        self.store({"keys": keys, "payload": payload, "ttl": ttl})
+        return True, payload
+
+    def delete(self, keys):
+        '''
+        Removes the value at `keys`. Returns False if there wasn't one.
+        '''
+        self._touch(keys)
+        path = tuple(keys)
+        self._replaced(path)
+        if not self.index.delete(path, keep_parent=True):
+            return False
+        self._changed(keys)
+        self._log(("delete", keys))
+        return True
+
+    def set_ttl(self, keys, ttl):
+        deadline = time.monotonic() + ttl
+        self.expiries[tuple(keys)] = deadline
+        heapq.heappush(self.expiry_heap, (deadline, tuple(keys)))
+
+    def next_expiry(self):
+        # Seconds until the next TTL runs out, or None if there aren't any
+        while self.expiry_heap:
+            deadline, path = self.expiry_heap[0]
+            if self.expiries.get(path) == deadline:
+                return max(0, deadline - time.monotonic())
+            heapq.heappop(self.expiry_heap)
+        return None
+
+    def expire(self):
+        '''
+        Deletes every path whose TTL has run out and returns them.
+        '''
+        now = time.monotonic()
+        expired = []
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            deadline, path = heapq.heappop(self.expiry_heap)
+            if self.expiries.get(path) != deadline: continue
+            del self.expiries[path]
+            if self.delete(list(path)):
+                expired.append(list(path))
+        return expired
+
+    def restore(self):
+        '''
+        Loads the last snapshot and replays the log on top of it. Only the
+        manifest is read up front, top-level keys are read in as they're
+        used. Returns stats for the startup report.
+        '''
+        started = time.monotonic()
+        replayed = 0
+        # The history of changes doesn't survive a restart
+        self.epoch = os.urandom(8).hex()
+        snapshot = self.files.load_manifest()
+        if snapshot is not None:
+            self.version, expiries = snapshot
+            self.evicted = set(self.files.files)
+            self.sizes = OrderedDict((key, size) for key, (_, size) in self.files.files.items())
+            for path, deadline in expiries:
+                self.set_ttl(list(path), deadline - time.time())
+        self.replaying = True
+        try:
+            for record in self.files.read_wal():
+                version, op, keys = record[:3]
+                # Already in the snapshot
+                if version <= self.version: continue
+                if op == "store":
+                    self.store({"keys": keys, "payload": record[3], "ttl": self._remaining(record[4])})
+                elif op == "incr":
+                    self.incr(keys, record[3], self._remaining(record[4]))
+                elif op == "extend":
+                    self.extend(keys, record[3], record[4], self._remaining(record[5]))
+                elif op == "delete":
+                    self.delete(keys)
+                replayed += 1
+        finally:
+            self.replaying = False
+        self.files.open_wal()
+        return {
+            "restore_ms": round((time.monotonic() - started) * 1000, 1),
+            "version": self.version,
+            "replayed": replayed,
+            **self.memory()
+        }
+
+    def _remaining(self, deadline):
+        return deadline - time.time() if deadline is not None else None
+
+    def checkpoint(self):
+        '''
+        Snapshots the top-level keys that changed, then evicts cold ones if
+        the store is over its memory budget.
+        '''
+        if self.files is None: return
+        subtrees = {key: self.index.get((key,), self.MISSING) for key in self.dirty}
+        deleted = [key for key, value in subtrees.items() if value is self.MISSING]
+        for key in deleted:
+            del subtrees[key]
+        now, wall = time.monotonic(), time.time()
+        expiries = [(path, wall + deadline - now) for path, deadline in self.expiries.items()]
+        # (Updating a size leaves the key where it is in the LRU order)
+        for key, size in self.files.write_snapshot(self.version, subtrees, deleted, expiries).items():
+            self.sizes[key] = size
+        for key in deleted:
+            self.sizes.pop(key, None)
+        self.dirty = set()
+        self.checkpoints += 1
+        self._evict()
+
+    def _evict(self):
+        if not self.memory_budget: return
+        resident = self.index.size(())[0]
+        for key in list(self.sizes):
+            if resident <= self.memory_budget: break
+            if key in self.evicted or key in self.dirty: continue
+            resident -= self.index.size((key,))[0]
+            self.index.delete((key,))
+            self.evicted.add(key)
+            self.evictions += 1
+
+    def memory(self):
+        # Sizes are roughly what the values take serialized (the objects in
+        # memory are bigger), and evicted keys count what their snapshot took
+        resident, leaves = self.index.size(())
+        on_disk = sum(self.sizes[key] for key in self.evicted)
+        return {"resident_bytes": resident, "total_bytes": resident + on_disk, "leaves": leaves, "keys": len(self.sizes), "evicted": len(self.evicted)}
+
+    def scan(self, keys, limit=100, after=None):
+        '''
+        Lists the keys right under `keys` with their values, a page at a time.
+        Returns (items, next), where next is the `after` for the next page.
+        '''
+        if self.files is not None:
+            self._touch(keys)
+        return self.index.scan(tuple(keys), limit, after)
+
+    def size(self, keys):
+        # Roughly how many bytes are stored at or under `keys`, and in how
+        # many leaf values
+        if self.files is not None:
+            self._touch(keys)
+        return self.index.size(tuple(keys))
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "expiring": len(self.expiries),
+            "dirty": len(self.dirty),
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "checkpoints": self.checkpoints,
+            "wal_bytes": self.files.wal_bytes if self.files is not None else 0,
+            **self.memory()
+        }
+
+    def close(self):
+        if self.files is None: return
+        self.checkpoint()
+        self.files.close()
+
+    def changed_since(self, prefix, since):
+        '''
+        Returns the paths at, above or below `prefix` that changed after
+        version `since`, oldest first, or None if that's further back than
+        the history goes.
+        '''
+        if since > self.version or (since < self.version and (not self.changes or self.changes[0][0] > since + 1)):
+            return None
+        paths = {}
+        for version, keys in self.changes:
+            if version <= since: continue
+            depth = min(len(keys), len(prefix))
+            if keys[:depth] == prefix[:depth]:
+                # Only the latest change to each path matters
+                paths.pop(tuple(keys), None)
+                paths[tuple(keys)] = keys
+        return list(paths.values())
@@ -1,24 +1,57 @@
-import re
+import json
+
+from scripts.log_parsing import check_known_events
+from scripts.server.condition_index import ConditionIndex, RegexIndex, FieldPredicate
 
 class EventEngine:
+    CONDITION_TYPES = ("logged", "regex", "match", "exclude", "startswith", "endswith", "equal", "event", "fields")
+
     def __init__(self, debug=False):
         self.condition_registry = {}
         self.callback_registry = {}
-        self.compiled_regex = {}
+        self.condition_index = ConditionIndex()
+        self.regex_index = RegexIndex()
+        self.compiled_regex = self.regex_index.compiled
+        # Number of conditions (other than 'exclude') each callback needs to see
+        self.required_hits = {}
+        # Callbacks that only have 'exclude' conditions fire unless vetoed
+        self.exclude_only = set()
+        # Structured events: compiled 'fields' checks, which event types each
+        # one is attached to (None for any), and who needs lines parsed at all
+        self.field_predicates = {}
+        self.fields_for_event = {}
+        self.structured_callbacks = set()
         self.debug = debug
 
     def register(self, addr, body):
         registry = body["registry"]
         for name, conds in registry.items():
-            conditions = [(k, v) for k, v in conds.items()]
             callback = (addr, name)
+            if callback in self.callback_registry:
+                self.unregister(addr, {"events": [name]})
+            conditions = [(k, self._condition_value(k, v)) for k, v in conds.items()]
+            # Field checks and regexes are compiled before anything else is
+            # touched, so a bad one is rejected without leaving half an event.
+            # Compiled regexes are counted per subscriber.
+            predicate = FieldPredicate(conds["fields"]) if "fields" in conds else None
+            if "regex" in conds:
+                self.regex_index.add(conds["regex"])
             for condition in conditions:
                 if condition not in self.condition_registry:
                     self.condition_registry[condition] = set()
+                    self.condition_index.add(condition)
                 self.condition_registry[condition].add(callback)
-                if condition[0] == "regex" and condition[1] not in self.compiled_regex:
-                    self.compiled_regex[condition[1]] = re.compile(condition[1])
+                if condition[0] == "fields":
+                    self.field_predicates.setdefault(condition[1], predicate)
+                    attached = self.fields_for_event.setdefault(conds.get("event"), {})
+                    attached[condition[1]] = attached.get(condition[1], 0) + 1
+            if "event" in conds or "fields" in conds:
+                self.structured_callbacks.add(callback)
             self.callback_registry[callback] = conditions
+            # Unknown condition types are treated as always satisfied
+            self.required_hits[callback] = sum(1 for type_, _ in conditions if type_ in self.CONDITION_TYPES and type_ != "exclude")
+            if not self.required_hits[callback]:
+                self.exclude_only.add(callback)
             if self.debug:
                 print(f"Registered {name} for {addr}!")
 
@@ -29,12 +62,26 @@ class EventEngine:
             if callback not in self.callback_registry: continue
             conditions = self.callback_registry[callback]
             del self.callback_registry[callback]
+            del self.required_hits[callback]
+            self.exclude_only.discard(callback)
+            self.structured_callbacks.discard(callback)
+            event_type = dict(conditions).get("event")
             for condition in conditions:
+                if condition[0] == "regex":
+                    self.regex_index.remove(condition[1])
+                elif condition[0] == "fields":
+                    attached = self.fields_for_event[event_type]
+                    attached[condition[1]] -= 1
+                    if not attached[condition[1]]:
+                        del attached[condition[1]]
+                    if not attached:
+                        del self.fields_for_event[event_type]
                 self.condition_registry[condition].remove(callback)
                 if not self.condition_registry[condition]:
                     del self.condition_registry[condition]
-                    if condition[0] == "regex":
-                        del self.compiled_regex[condition[0]]
+                    self.condition_index.remove(condition)
+                    if condition[0] == "fields":
+                        del self.field_predicates[condition[1]]
 
     def unregister_all_for_addr(self, addr):
         # Unregister all callbacks for this addr
@@ -50,30 +97,51 @@ class EventEngine:
             loginfo = text[:25]
             text = text[25:]
 
-        satisfaction = {k: len(v) for k, v in self.callback_registry.items()}
-        for condition, callbacks in self.condition_registry.items():
-            type_, val = condition
-            matches = True
-            if type_ == 'logged':
-                matches = str(loginfo != "") == val
-            elif type_ == 'regex':
-                matches = self.compiled_regex[val].search(text)
-            elif type_ == 'match':
-                matches = val in text
-            elif type_ == 'exclude':
-                matches = val not in text
-            elif type_ == 'startswith':
-                matches = text.startswith(val)
-            elif type_ == 'endswith':
-                matches = text.endswith(val)
-            elif type_ == 'equal':
-                matches = text == val
-            if matches:
-                for callback in callbacks:
-                    satisfaction[callback] -= 1
+        # Only conditions that actually fired are looked at, rather than
+        # evaluating every registered condition against the line
+        hits = self.condition_index.search(text)
+        hits.append(("equal", text))
+        hits.append(("logged", str(loginfo != "")))
+        for val in self.regex_index.search(text):
+            hits.append(("regex", val))
+
+        # Lines are only parsed into structured events when someone asked
+        # for them, and then only once no matter how many subscribers there are
+        event = None
+        if self.structured_callbacks:
+            event_type, fields = check_known_events(text)
+            if event_type is not None:
+                event = (event_type, fields)
+                hits.append(("event", event_type))
+                keys = set(self.fields_for_event.get(event_type, ()))
+                keys.update(self.fields_for_event.get(None, ()))
+                for key in keys:
+                    if self.field_predicates[key](fields):
+                        hits.append(("fields", key))
+
+        counts = {}
+        vetoed = set()
+        for condition in hits:
+            callbacks = self.condition_registry.get(condition)
+            if not callbacks: continue
+            if condition[0] == "exclude":
+                vetoed.update(callbacks)
+                continue
+            for callback in callbacks:
+                counts[callback] = counts.get(callback, 0) + 1
 
         triggered = []
-        for callback, complete in satisfaction.items():
-            if complete == 0:
+        for callback, count in counts.items():
+            if count == self.required_hits[callback] and callback not in vetoed:
+                triggered.append(callback)
+        for callback in self.exclude_only:
+            if callback not in vetoed:
                 triggered.append(callback)
-        return text, loginfo, triggered
+        return text, loginfo, triggered, event
+
+    @staticmethod
+    def _condition_value(type_, val):
+        # Field specs are dicts, so they're keyed by a canonical JSON string
+        if type_ == "fields":
+            return json.dumps(val, sort_keys=True)
+        return val
@@ -0,0 +1,160 @@
+import os
+import time
+import struct
+import bisect
+
+class EventJournal:
+    '''
+    Append-only on-disk journal of every server output line, each with a
+    sequence number that keeps counting up across restarts. Lines are stored
+    in segment files that roll over by size and are deleted by age, and each
+    segment has an index of record offsets so a replay can jump straight to
+    any sequence number.
+
+    Segment files are `<first_seq>.seg` holding records of (seq, timestamp,
+    length) followed by the line, and `<first_seq>.idx` holding one 8 byte
+    offset per record.
+    '''
+    RECORD = struct.Struct("<QdI")
+    OFFSET = struct.Struct("<Q")
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_age=24 * 60 * 60, debug=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_age = max_age
+        self.debug = debug
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = sorted(
+            int(name[:-4]) for name in os.listdir(directory) if name.endswith(".seg") and name[:-4].isdigit()
+        )
+        self.seq = 0
+        self.seg_file = None
+        self.idx_file = None
+        self.seg_size = 0
+        if self.segments:
+            first = self.segments[-1]
+            self.seq = first + self._recover(first) - 1
+            self._open_segment(first)
+        self.expire()
+
+    def _recover(self, first_seq):
+        '''
+        Trims anything written after the last complete, indexed record of a
+        segment (like after a crash mid-write). Returns the record count.
+        '''
+        idx_path, seg_path = self._path(first_seq, "idx"), self._path(first_seq, "seg")
+        if not os.path.exists(idx_path):
+            open(idx_path, "wb").close()
+        count = os.path.getsize(idx_path) // self.OFFSET.size
+        end = 0
+        with open(seg_path, "rb") as seg:
+            while count:
+                with open(idx_path, "rb") as idx:
+                    idx.seek((count - 1) * self.OFFSET.size)
+                    offset = self.OFFSET.unpack(idx.read(self.OFFSET.size))[0]
+                seg.seek(offset)
+                header = seg.read(self.RECORD.size)
+                if len(header) == self.RECORD.size:
+                    length = self.RECORD.unpack(header)[2]
+                    if len(seg.read(length)) == length:
+                        end = offset + self.RECORD.size + length
+                        break
+                count -= 1
+        os.truncate(idx_path, count * self.OFFSET.size)
+        os.truncate(seg_path, end)
+        return count
+
+    def _path(self, first_seq, ext):
+        return os.path.join(self.directory, f"{first_seq:020d}.{ext}")
+
+    def _open_segment(self, first_seq):
+        self.seg_file = open(self._path(first_seq, "seg"), "ab")
+        self.idx_file = open(self._path(first_seq, "idx"), "ab")
+        self.seg_size = self.seg_file.tell()
+
+    def _roll(self):
+        self.close()
+        self.segments.append(self.seq + 1)
+        self._open_segment(self.seq + 1)
+        self.expire()
+
+    def append(self, line):
+        '''
+        Writes a line to the journal and returns its sequence number.
+        '''
+        return self.append_batch([line])[0]
+
+    def append_batch(self, lines):
+        '''
+        Writes a batch of lines to the journal and returns their sequence
+        numbers.
+        '''
+        seqs = []
+        now = time.time()
+        for line in lines:
+            if self.seg_file is None or self.seg_size >= self.segment_bytes:
+                self._roll()
+            self.seq += 1
+            data = line.encode(errors="ignore")
+            self.idx_file.write(self.OFFSET.pack(self.seg_size))
+            self.seg_file.write(self.RECORD.pack(self.seq, now, len(data)) + data)
+            self.seg_size += self.RECORD.size + len(data)
+            seqs.append(self.seq)
+        # Flushed to the OS (not fsynced) once per batch, so replays can see
+        # it right away and it survives the hub itself going down
+        if self.seg_file is not None:
+            self.seg_file.flush()
+            self.idx_file.flush()
+        return seqs
+
+    def expire(self):
+        # Drops whole segments that haven't been written to in max_age seconds
+        if not self.max_age: return
+        cutoff = time.time() - self.max_age
+        while len(self.segments) > 1:
+            first = self.segments[0]
+            try:
+                if os.path.getmtime(self._path(first, "seg")) >= cutoff: break
+                os.unlink(self._path(first, "seg"))
+                os.unlink(self._path(first, "idx"))
+            except FileNotFoundError:
+                pass
+            self.segments.pop(0)
+            if self.debug:
+                print(f"[EventJournal] Expired segment starting at {first}.")
+
+    def read_from(self, seq, until=None):
+        '''
+        Yields (seq, line) for every journaled line from `seq` through
+        `until` (or the newest line). Lines that have already expired are
+        skipped, so this starts at the oldest line still on disk.
+        '''
+        until = self.seq if until is None else until
+        if not self.segments or seq > until: return
+        seq = max(seq, self.segments[0])
+        position = bisect.bisect_right(self.segments, seq) - 1
+        for first in list(self.segments[position:]):
+            if first > until: break
+            try:
+                with open(self._path(first, "idx"), "rb") as idx, open(self._path(first, "seg"), "rb") as seg:
+                    idx.seek((max(seq, first) - first) * self.OFFSET.size)
+                    entry = idx.read(self.OFFSET.size)
+                    if len(entry) < self.OFFSET.size: continue
+                    seg.seek(self.OFFSET.unpack(entry)[0])
+                    while True:
+                        header = seg.read(self.RECORD.size)
+                        if len(header) < self.RECORD.size: break
+                        record_seq, _, length = self.RECORD.unpack(header)
+                        if record_seq > until: return
+                        data = seg.read(length)
+                        yield record_seq, data.decode(errors="ignore")
+            except FileNotFoundError:
+                # Expired while we were reading
+                pass
+
+    def close(self):
+        if self.seg_file is not None:
+            self.seg_file.close()
+            self.idx_file.close()
+            self.seg_file = self.idx_file = None
@@ -1,39 +1,149 @@
 import asyncio
 import os
+import re
 import sys
 import signal
-import json
 
 from scripts.server.fof_server_wrapper import FofServerWrapper
-from scripts.server.event_engine import EventEngine
+from scripts.server.match_pool import MatchPool
 from scripts.server.data_store import DataStore
+from scripts.server.store_files import StoreFiles
 from scripts.server.protocol import FofServerProtocol
+from scripts.server.wire import SharedEvent, default_socket_path, make_private_dir
+from scripts.server.shm_ring import LogRing
+from scripts.server.event_journal import EventJournal
+from scripts.server.relay import RelayLink
+from scripts.server.local_plugins import LocalPlugins
 
 class FofServerEventHandler:
-    def __init__(self, fof_server, host, port, debug=False):
-        self.server = fof_server
-        self.event_engine = EventEngine(debug=debug)
-        self.data_store = DataStore()
-        self.protocol = FofServerProtocol(self.event_engine, self.data_store, self.server, debug=debug)
+    # Seconds between checks for journal segments past their max age
+    JOURNAL_EXPIRE_INTERVAL = 60
+    SERVER_ID = re.compile(r"[A-Za-z0-9_-]+")
+
+    def __init__(self, fof_server, host, port, client_queue_size=1000, client_overflow_policy="drop_oldest",
+                 unix_socket=None, ring_slots=4096, ring_slot_size=1024, journal_dir=None,
+                 journal_segment_bytes=16 * 1024 * 1024, journal_max_age=24 * 60 * 60, match_workers=0,
+                 relay=None, relay_token=None, store_dir=None, store_memory_budget=None,
+                 store_wal_bytes=16 * 1024 * 1024, store_snapshot_interval=300, local_plugins=None,
+                 local_plugin_budget_ms=5, local_plugin_max_overruns=10, debug=False):
+        # Either one server, or a dict of server id -> server to supervise a
+        # whole box of them. Events from those are tagged with the server id.
+        # An empty dict makes a hub that only aggregates other hubs' events.
+        if isinstance(fof_server, dict):
+            self.servers = {str(server_id): server for server_id, server in fof_server.items()}
+            # Ids end up in journal paths, so nothing like '../' or '/'
+            for server_id in self.servers:
+                if not self.SERVER_ID.fullmatch(server_id):
+                    raise ValueError(f"Server id '{server_id}' can only have letters, digits, '_' and '-'")
+        else:
+            self.servers = {None: fof_server}
+        self.server = next(iter(self.servers.values()), None)
+        # Matching can be spread over worker processes, one server per worker
+        self.match_pool = MatchPool(workers=match_workers, debug=debug)
+        # Shared storage is kept on disk if there's a store_dir, as a
+        # snapshot plus a log of everything since
+        self.store_snapshot_interval = store_snapshot_interval
+        self.checkpoint_task = None
+        if store_dir:
+            self.data_store = DataStore(files=StoreFiles(store_dir, debug=debug), memory_budget=store_memory_budget, wal_max_bytes=store_wal_bytes)
+            report = self.data_store.restore()
+            print(f"[EventHandler] Restored shared storage (version {report['version']}, {report['replayed']} logged changes) "
+                  f"in {report['restore_ms']} ms: {report['keys']} keys, {report['total_bytes'] // 1024} KB "
+                  f"({report['resident_bytes'] // 1024} KB in memory)")
+        else:
+            self.data_store = DataStore()
+        self.protocol = FofServerProtocol(
+            self.match_pool, self.data_store, self.server,
+            max_queue=client_queue_size, overflow=client_overflow_policy, debug=debug
+        )
+        self.protocol.servers = self.servers
+        # Trusted plugins that run right here, called as lines are matched
+        self.local_plugins = LocalPlugins(self.protocol, local_plugins or [], budget_ms=local_plugin_budget_ms,
+                                          max_overruns=local_plugin_max_overruns, debug=debug)
+        self.protocol.local_plugins = self.local_plugins
         self.host = host
         self.port = port
+        # Same-host plugins can use a unix socket, and read log lines out of
+        # shared memory instead of the socket if ring_slots isn't 0
+        self.unix_socket = unix_socket if unix_socket is not None else default_socket_path(port)
+        self.ring_slots = ring_slots
+        self.ring_slot_size = ring_slot_size
+        self.unix_server = None
+        # Every line goes in the journal so reconnecting plugins can catch up
+        # on what they missed (each server gets its own)
+        self.journals = {}
+        if journal_dir:
+            for server_id in self.servers:
+                directory = journal_dir if server_id is None else os.path.join(journal_dir, server_id)
+                self.journals[server_id] = EventJournal(directory, segment_bytes=journal_segment_bytes, max_age=journal_max_age, debug=debug)
+        self.protocol.journals = self.journals
+        self.journal_task = None
+        # Other hubs can relay their events here (if they have the token),
+        # and this hub can relay its own to an upstream one. `relay` is a
+        # dict of RelayLink arguments.
+        self.protocol.relay_token = relay_token
+        self.protocol.relay_handler = self.dispatch_relayed
+        self.relay_config = relay
+        self.relay_link = None
+        self.running = 0
         self.debug = debug
         self.stop_event = None
 
+    async def start_unix_server(self):
+        if not self.unix_socket: return
+        try:
+            # The default spot is a directory only this user can get into
+            if self.unix_socket == default_socket_path(self.port):
+                make_private_dir(os.path.dirname(self.unix_socket))
+            if os.path.exists(self.unix_socket):
+                os.unlink(self.unix_socket)
+            self.unix_server = await asyncio.start_unix_server(self.protocol.handle_client, path=self.unix_socket)
+            print(f"[EventHandler listening on {self.unix_socket}]")
+        except OSError as e:
+            print(f"[EventHandler] Couldn't listen on {self.unix_socket}, plugins will use TCP: {e}")
+            return
+        if self.ring_slots:
+            self.protocol.log_ring = LogRing(slots=self.ring_slots, slot_size=self.ring_slot_size)
+
+    async def stop_unix_server(self):
+        if self.unix_server is not None:
+            self.unix_server.close()
+            await self.unix_server.wait_closed()
+            try:
+                os.unlink(self.unix_socket)
+            except OSError:
+                pass
+        if self.protocol.log_ring is not None:
+            self.protocol.log_ring.close()
+            self.protocol.log_ring = None
+
     async def start(self):
-        await self.server.start()
+        for server in self.servers.values():
+            await server.start()
         self.server_proc = await asyncio.start_server(self.protocol.handle_client, self.host, self.port)
         print(f"[EventHandler listening on {self.host}:{self.port}]")
+        await self.start_unix_server()
 
-        log_task = asyncio.create_task(self.dispatch_log_events())
-        cli_task = asyncio.create_task(self.handle_cli_input())
-
+        loop = asyncio.get_running_loop()
+        self.match_pool.start(loop)
+        # TTLs that were restored from disk
+        self.protocol.schedule_expiry()
+        await self.local_plugins.start()
+        if self.data_store.files is not None:
+            self.checkpoint_task = asyncio.create_task(self.checkpoint_data())
+        if self.journals:
+            self.journal_task = asyncio.create_task(self.expire_journals())
+        if self.relay_config:
+            self.relay_link = RelayLink(self.protocol, debug=self.debug, **self.relay_config)
+            self.relay_link.start()
         self.stop_event = asyncio.Event()
+        self.running = len(self.servers)
+        log_tasks = [asyncio.create_task(self.dispatch_log_events(server_id, server)) for server_id, server in self.servers.items()]
+        cli_task = asyncio.create_task(self.handle_cli_input())
 
         def on_shutdown():
             self.stop_event.set()
 
-        loop = asyncio.get_running_loop()
         loop.add_signal_handler(signal.SIGINT, on_shutdown)
         loop.add_signal_handler(signal.SIGTERM, on_shutdown)
 
@@ -43,56 +153,132 @@ class FofServerEventHandler:
         finally:
             if self.debug:
                 print("[EventHandler] Shutting down...")
-            log_task.cancel()
-            cli_task.cancel()
-            try: await log_task
-            except (asyncio.CancelledError, KeyboardInterrupt): pass
-            try: await cli_task
-            except (asyncio.CancelledError, KeyboardInterrupt): pass
-
-            await self.server.shutdown()
-            for writer in list(self.protocol.clients.values()):
-                writer.close()
-                await writer.wait_closed()
+            tasks = log_tasks + [cli_task] + [task for task in (self.checkpoint_task, self.journal_task) if task is not None]
+            for task in tasks:
+                task.cancel()
+            for task in tasks:
+                try: await task
+                except (asyncio.CancelledError, KeyboardInterrupt): pass
+            await self.local_plugins.stop()
+
+            for server in self.servers.values():
+                await server.shutdown()
+            if self.relay_link is not None:
+                await self.relay_link.wait_closed()
+            for client in list(self.protocol.clients.values()):
+                await client.wait_closed()
             self.server_proc.close()
             await self.server_proc.wait_closed()
+            await self.stop_unix_server()
+            self.match_pool.close()
+            for journal in self.journals.values():
+                journal.close()
+            self.data_store.close()
+
+    async def checkpoint_data(self):
+        # Snapshots keep the log (and restarts) short, and are when cold
+        # keys get evicted. A full log brings the next one forward, so the
+        # fsyncs don't happen in the middle of handling a store.
+        wal_full = asyncio.Event()
+        self.data_store.on_wal_full = wal_full.set
+        while True:
+            try:
+                await asyncio.wait_for(wal_full.wait(), self.store_snapshot_interval)
+            except asyncio.TimeoutError:
+                pass
+            wal_full.clear()
+            if self.data_store.dirty:
+                self.data_store.checkpoint()
+                if self.debug:
+                    print(f"[EventHandler] Shared storage snapshot: {self.data_store.stats()}")
 
-    async def dispatch_log_events(self):
+    async def expire_journals(self):
+        # Old segments go even when a quiet server isn't rolling new ones
+        while True:
+            await asyncio.sleep(self.JOURNAL_EXPIRE_INTERVAL)
+            for journal in self.journals.values():
+                journal.expire()
+
+    async def dispatch_log_events(self, server_id, server):
+        journal = self.journals.get(server_id)
         try:
-            async for raw_line in self.server.read_lines():
+            async for lines in server.read_batches():
                 if self.debug:
-                    print(raw_line)
-                text, loginfo, triggered = self.event_engine.process_line(raw_line)
-
-                # Group events by client
-                staged_callbacks = {}
-                for addr, event_name in triggered:
-                    if addr not in staged_callbacks:
-                        staged_callbacks[addr] = {
-                            "type": "event",
-                            "data": text,
-                            "loginfo": loginfo,
-                            "triggered": []
-                        }
-                    staged_callbacks[addr]["triggered"].append(event_name)
-
-                for addr, payload in staged_callbacks.items():
-                    writer = self.protocol.clients.get(addr)
-                    if writer is None:
-                        continue
-                    try:
-                        writer.write((json.dumps(payload) + "\n").encode())
-                        await writer.drain()
-                    except Exception:
-                        self.event_engine.unregister_all_for_addr(addr)
-                        writer.close()
-                        await writer.wait_closed()
-                        del self.protocol.clients[addr]
+                    for raw_line in lines:
+                        print(raw_line if server_id is None else f"[{server_id}] {raw_line}")
+                seqs = journal.append_batch(lines) if journal is not None else None
+                for i, result in await self.match_pool.process_lines(server_id, lines):
+                    self.dispatch_event(result, server_id, seqs[i] if seqs else None)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             if self.debug:
                 print(f"[Log Dispatcher Error] {e}")
         finally:
-            self.stop_event.set()
+            # The hub keeps going as long as any of its servers are up
+            self.running -= 1
+            if not self.running:
+                self.stop_event.set()
+
+    def dispatch_event(self, result, server_id, seq=None, origin=None):
+        text, loginfo, triggered, event = result
+        # Group events by client, leaving out any the client only wants from
+        # other servers (relayed events go by their origin hub)
+        source = server_id if origin is None else origin
+        staged_callbacks = {}
+        local_callbacks = {}
+        for addr, event_name in triggered:
+            plugin = self.local_plugins.clients.get(addr)
+            if plugin is not None:
+                if plugin.wants(event_name, source):
+                    local_callbacks.setdefault(addr, []).append(event_name)
+                continue
+            client = self.protocol.clients.get(addr)
+            if client is None or not client.wants(event_name, source):
+                continue
+            if addr not in staged_callbacks:
+                staged_callbacks[addr] = []
+            staged_callbacks[addr].append(event_name)
+        # Plugins in the hub go first, they're the ones that can't wait
+        if local_callbacks:
+            shared = SharedEvent.from_line(text, loginfo, event, seq, server=server_id, origin=origin).shared
+            for addr, event_names in local_callbacks.items():
+                self.local_plugins.dispatch(addr, event_names, shared)
+        if not staged_callbacks:
+            return
+
+        # Everything but the triggered list is the same for every client, so
+        # it's only encoded once per wire format
+        shared_event = SharedEvent.from_line(
+            text, loginfo, event, seq, self.write_to_ring(text, staged_callbacks), server=server_id, origin=origin
+        )
+
+        # Only queued here - each client has its own writer task, so a slow
+        # plugin never holds up reading the server output
+        for addr, event_names in staged_callbacks.items():
+            self.protocol.clients[addr].send_event(shared_event, event_names)
+
+    async def dispatch_relayed(self, origin, lines):
+        # Lines from a downstream hub, as [raw line, server id, time read].
+        # They're matched against this hub's plugins like local output.
+        results = await self.match_pool.process_lines(("relay", origin), [line[0] for line in lines])
+        for i, result in results:
+            self.dispatch_event(result, lines[i][1], origin=origin)
+
+    def write_to_ring(self, text, staged_callbacks):
+        # Only worth writing if somebody who'll get this line reads the ring
+        ring = self.protocol.log_ring
+        if ring is None: return None
+        for addr in staged_callbacks:
+            client = self.protocol.clients.get(addr)
+            if client is not None and client.use_ring:
+                return ring.write(text.encode())
+        return None
+
+    def _report_command(self, future):
+        # Nobody's waiting on commands typed at the console, so say if one failed
+        if not future.cancelled() and future.exception() is not None:
+            print(f"[Command Error] {future.exception() or type(future.exception()).__name__}")
 
     async def handle_cli_input(self):
         """
@@ -118,8 +304,16 @@ class FofServerEventHandler:
                 if not line:
                     break
                 line = line.decode().strip()
+                # '@<server id> <command>' picks the server when there are several
+                server = self.server
+                if line.startswith("@") and " " in line:
+                    server_id, line = line[1:].split(" ", 1)
+                    server = self.servers.get(server_id)
+                    if server is None:
+                        print(f"[Command Error] Unknown server '{server_id}', expected one of {', '.join(map(str, self.servers))}")
+                        continue
                 try:
-                    self.server.send_command(line)
+                    server.command(line).add_done_callback(self._report_command)
                 except Exception as e:
                     if self.debug:
                         print(f"[Command Error] {e}")
@@ -139,27 +333,108 @@ if __name__ == "__main__":
 
     local_host = config.get("fof_local_host", "127.0.0.1")
     local_port = config.get("fof_local_port", "9000")
+    client_queue_size = config.get("client_queue_size", 1000)
+    client_overflow_policy = config.get("client_overflow_policy", "drop_oldest")
+    local_socket = config.get("fof_local_socket", None)
+    ring_slots = config.get("shm_ring_slots", 4096)
+    ring_slot_size = config.get("shm_ring_slot_size", 1024)
+    journal_dir = config.get("journal_dir", None)
+    journal_segment_mb = config.get("journal_segment_mb", 16)
+    journal_max_age_hours = config.get("journal_max_age_hours", 24)
+    store_dir = config.get("store_dir", None)
+    store_memory_mb = config.get("store_memory_mb", 0)
+    store_wal_mb = config.get("store_wal_mb", 16)
+    store_snapshot_minutes = config.get("store_snapshot_minutes", 5)
+    local_plugins = config.get("local_plugins", [])
+    local_plugin_budget_ms = config.get("local_plugin_budget_ms", 5)
+    local_plugin_max_overruns = config.get("local_plugin_max_overruns", 10)
 
     starting_map = config.get("starting_map", "fof_fistful")
     max_players = str(config.get("max_players", "20"))
     server_port = str(config.get("server_port", "27015"))
+    pty_buffer_lines = config.get("pty_buffer_lines", 10000)
+    command_rate = config.get("command_rate", 20)
+    command_timeout = config.get("command_timeout", 5.0)
+    rcon_addr = config.get("fof_rcon_address", None)
+    rcon_port = config.get("fof_rcon_port", 27015)
+    rcon_password = os.environ.get("FOF_RCON_PASSWORD", "")
+    rcon_pool_size = config.get("rcon_pool_size", 2)
+
+    servers = config.get("servers", None)
+    match_workers = config.get("match_workers", 0)
+    aggregator = config.get("aggregator", False)
+    relay_token = os.environ.get("FOF_RELAY_TOKEN", None) or None
+    relay_upstream = config.get("relay_upstream", None)
+    # Relay links come from other machines, so there's no relaying without a token
+    if (aggregator or relay_upstream) and not relay_token:
+        raise SystemExit("Set FOF_RELAY_TOKEN in server-wrapper-secrets.env to run an aggregator or relay.")
+    relay = None
+    if relay_upstream:
+        relay_host, relay_port = relay_upstream.rsplit(":", 1)
+        relay = {
+            "host": relay_host,
+            "port": int(relay_port),
+            "origin": config.get("relay_origin", relay_host),
+            "registry": config.get("relay_events", {}),
+            "token": relay_token,
+            "window_ms": config.get("relay_window_ms", 100),
+            "max_events": config.get("relay_max_events", 256),
+            "max_pending": config.get("relay_max_pending", 10000)
+        }
+
+    def make_server(entry):
+        # Entries in 'servers' can override any of the single-server settings
+        port = str(entry.get("server_port", server_port))
+        launch_cmd = [
+            './srcds_run',
+            '-game', 'fof',
+            '+map', entry.get("starting_map", starting_map),
+            '+maxplayers', str(entry.get("max_players", max_players)),
+            '-debug',
+            '-port', port
+        ]
+        return FofServerWrapper(
+            launch_cmd=launch_cmd,
+            buffer_lines=pty_buffer_lines,
+            command_rate=command_rate,
+            command_timeout=command_timeout,
+            rcon_addr=entry.get("fof_rcon_address", rcon_addr),
+            rcon_port=entry.get("fof_rcon_port", entry.get("server_port", rcon_port)),
+            rcon_password=rcon_password,
+            rcon_pool_size=rcon_pool_size,
+            debug=True
+        )
+
+    if aggregator:
+        # No servers of its own, just events relayed from other hubs
+        fof_server = {}
+    elif servers:
+        fof_server = {entry["id"]: make_server(entry) for entry in servers}
+    else:
+        fof_server = make_server({})
 
-    launch_cmd = [
-        './srcds_run',
-        '-game', 'fof',
-        '+map', starting_map,
-        '+maxplayers', max_players,
-        '-debug',
-        '-port', server_port
-    ]
-    fof_server = FofServerWrapper(
-        launch_cmd=launch_cmd,
-        debug=True
-    )
     event_handler = FofServerEventHandler(
         fof_server,
         host=local_host,
         port=local_port,
+        client_queue_size=client_queue_size,
+        client_overflow_policy=client_overflow_policy,
+        unix_socket=local_socket,
+        ring_slots=ring_slots,
+        ring_slot_size=ring_slot_size,
+        journal_dir=journal_dir,
+        journal_segment_bytes=journal_segment_mb * 1024 * 1024,
+        journal_max_age=journal_max_age_hours * 60 * 60,
+        match_workers=match_workers,
+        relay=relay,
+        relay_token=relay_token,
+        store_dir=store_dir,
+        store_memory_budget=store_memory_mb * 1024 * 1024 or None,
+        store_wal_bytes=store_wal_mb * 1024 * 1024,
+        store_snapshot_interval=store_snapshot_minutes * 60,
+        local_plugins=local_plugins,
+        local_plugin_budget_ms=local_plugin_budget_ms,
+        local_plugin_max_overruns=local_plugin_max_overruns,
         debug=True
     )
     asyncio.run(event_handler.start())
@@ -6,9 +6,25 @@ import fcntl
 import termios
 import signal
 
+from scripts.server.pty_drain import PtyDrain
+from scripts.server.command_pipeline import CommandPipeline
+from scripts.server.rcon_pool import RconPool, RconNotSent
+
 class FofServerWrapper:
-    def __init__(self, launch_cmd, debug=False):
+    def __init__(self, launch_cmd, buffer_lines=10000, command_rate=20, command_timeout=5.0,
+                 rcon_addr=None, rcon_port=27015, rcon_password=None, rcon_pool_size=2, debug=False):
         self.launch_cmd = launch_cmd
+        self.buffer_lines = buffer_lines
+        self.command_rate = command_rate
+        self.command_timeout = command_timeout
+        self.drain = None
+        self.commands = None
+        # With an RCON password, commands go over RCON instead of the console
+        # (and a server this didn't launch can still be controlled)
+        self.rcon = None
+        if rcon_addr and rcon_password:
+            self.rcon = RconPool(rcon_addr, int(rcon_port), rcon_password, size=rcon_pool_size, timeout=command_timeout,
+                                rate=command_rate, debug=debug)
         self.debug = debug
         self.leader_fd = None
         self.fof_proc = None
@@ -27,7 +43,10 @@ class FofServerWrapper:
             print(f"Do not run as root. Exiting.")
             return
         if self.launch_cmd is None:
-            print("Can't start server - no launch command!")
+            if self.rcon is not None:
+                print(f"No launch command - sending commands to {self.rcon.host}:{self.rcon.port} over RCON.")
+            else:
+                print("Can't start server - no launch command!")
             return
 
         # Launching subprocess
@@ -48,33 +67,36 @@ class FofServerWrapper:
 
         os.close(follower_fd)
 
+        self.commands = CommandPipeline(self.leader_fd, rate=self.command_rate, timeout=self.command_timeout, debug=self.debug)
+        self.commands.start()
+
         if self.debug:
             print("[FofServerWrapper] Server process started.")
 
     async def read_lines(self):
         """Yields output lines from the server as they come in."""
-        loop = asyncio.get_running_loop()
+        async for lines in self.read_batches():
+            for line in lines: yield line
+
+    async def read_batches(self):
+        """Yields lists of output lines, however many came in together."""
+        if self.leader_fd is None and self.rcon is not None:
+            # Only attached over RCON, so there's no console to read
+            await asyncio.get_running_loop().create_future()
+        # The PTY is drained on its own thread, so srcds can keep writing
+        # output even when the event loop is busy
+        self.drain = PtyDrain(self.leader_fd, max_lines=self.buffer_lines, debug=self.debug)
+        self.drain.start(asyncio.get_running_loop())
         try:
-            buffer = ""
             while True:
-                # Reading text output
-                try:
-                    data = await asyncio.wait_for(loop.run_in_executor(None, os.read, self.leader_fd, 4096), timeout=1.0)
-                except asyncio.TimeoutError:
-                    continue
-                except (KeyboardInterrupt, asyncio.CancelledError) as e:
+                lines = await self.drain.get_lines()
+                if lines is None:
                     break
-                except OSError as e:
-                    if e.errno == 5: break
-                    raise
-                if not data:
-                    break
-                text = data.decode(errors='ignore')
-
-                # Splitting on lines; only sending completed lines
-                lines = (buffer + text).split("\n")
-                buffer = lines[-1]
-                for line in lines[:-1]: yield line
+                # Output markers from captured commands aren't passed on
+                if self.commands is not None:
+                    lines = [line for line in lines if not self.commands.feed(line)]
+                if lines:
+                    yield lines
 
         except asyncio.CancelledError:
             raise
@@ -83,13 +105,59 @@ class FofServerWrapper:
             if self.debug:
                 print(f"[FofServerWrapper] Error while reading output: {e}")
 
+        finally:
+            self.drain.stop()
+            if self.debug:
+                print(f"[FofServerWrapper] Output buffer stats: {self.drain.stats()}")
+
+    def stats(self):
+        stats = self.drain.stats() if self.drain is not None else {}
+        if self.commands is not None:
+            stats["commands"] = self.commands.stats()
+        if self.rcon is not None:
+            stats["rcon"] = self.rcon.stats()
+        return stats
+
+    def command(self, command, capture=False):
+        '''
+        Queues a command for the server and returns a future for it. With
+        capture, the future resolves to the console output of the command.
+        '''
+        if self.rcon is not None:
+            return asyncio.ensure_future(self._rcon_command(command, capture))
+        if self.commands is None:
+            raise RuntimeError("Server isn't running")
+        return self.commands.submit(command, capture)
+
+    async def _rcon_command(self, command, capture):
+        try:
+            response = await self.rcon.execute(command)
+        except RconNotSent as e:
+            # Fall back on the console if there is one. Only when RCON never
+            # sent it, or it could end up running twice
+            if self.commands is None:
+                raise
+            if self.debug:
+                print(f"[FofServerWrapper] RCON failed, using the console for '{command}': {e}")
+            return await self.commands.submit(command, capture)
+        return response.splitlines() if capture else None
+
     def send_command(self, command):
+        # Writes straight to the console, skipping the queue
         os.write(self.leader_fd, bytes(f"{command}\n", "utf-8"))
 
     async def shutdown(self):
+        if self.rcon is not None:
+            await self.rcon.close()
+        if self.fof_proc is None:
+            return
+
         if self.debug:
             print(f"[FofServerWrapper] Shutting down server (PID={self.fof_proc.pid}, PGID={os.getpgid(self.fof_proc.pid)})...")
 
+        if self.commands is not None:
+            await self.commands.stop()
+
         # Attempt graceful shutdown via leader_fd
         try:
             self.send_command("quit")
@@ -153,6 +221,7 @@ if __name__ == "__main__":
         rcon_addr = config.get("fof_rcon_address", "127.0.1.1")
         rcon_port = config.get("fof_rcon_port", 27015)
         rcon_password = os.environ.get("FOF_RCON_PASSWORD", "")
+        rcon_pool_size = config.get("rcon_pool_size", 2)
 
         starting_map = config.get("starting_map", "fof_fistful")
         max_players = str(config.get("max_players", "20"))
@@ -172,6 +241,7 @@ if __name__ == "__main__":
             rcon_addr=rcon_addr,
             rcon_port=rcon_port,
             rcon_password=rcon_password,
+            rcon_pool_size=rcon_pool_size,
             debug=True)
 
         server.restrict_interrupt()
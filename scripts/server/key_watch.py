@@ -0,0 +1,73 @@
+class KeyWatch:
+    '''
+    Tracks which clients are interested in which key paths of the shared
+    storage (cached copies, or watched prefixes). Paths are kept in a tree by
+    key, and a store at some path hits every watched path that's above it
+    (its value changed underneath it) or below it (it was replaced).
+    '''
+    def __init__(self):
+        self.root = {"children": {}, "addrs": set()}
+        self.watching = {}
+
+    def watch(self, addr, keys):
+        node = self.root
+        for key in keys:
+            node = node["children"].setdefault(key, {"children": {}, "addrs": set()})
+        node["addrs"].add(addr)
+        self.watching.setdefault(addr, set()).add(tuple(keys))
+
+    def unwatch(self, addr, keys):
+        keys = tuple(keys)
+        paths = self.watching.get(addr)
+        if paths is None or keys not in paths: return
+        paths.discard(keys)
+        if not paths:
+            del self.watching[addr]
+        self._remove(self.root, keys, 0, addr)
+
+    def unwatch_all_for_addr(self, addr):
+        for keys in self.watching.pop(addr, ()):
+            self._remove(self.root, keys, 0, addr)
+
+    def _remove(self, node, keys, depth, addr):
+        # Returns True if the node is empty and its parent can let go of it
+        if depth == len(keys):
+            node["addrs"].discard(addr)
+        else:
+            child = node["children"].get(keys[depth])
+            if child is not None and self._remove(child, keys, depth + 1, addr):
+                del node["children"][keys[depth]]
+        return not node["addrs"] and not node["children"]
+
+    def stored(self, keys, forget=False):
+        '''
+        Called after something is stored at `keys`. Returns {addr: [paths]}
+        for the watched paths it touched. With forget, those paths stop being
+        watched (like cached copies the clients are about to drop).
+        '''
+        hits = {}
+        node = self.root
+        path = []
+        for key in keys:
+            for addr in node["addrs"]:
+                hits.setdefault(addr, []).append(list(path))
+            node = node["children"].get(key)
+            if node is None: break
+            path.append(key)
+        else:
+            self._collect(node, path, hits)
+        if not forget:
+            return hits
+        for addr, paths in hits.items():
+            for cached in paths:
+                self.unwatch(addr, cached)
+        return hits
+
+    def _collect(self, node, path, hits):
+        for addr in node["addrs"]:
+            hits.setdefault(addr, []).append(list(path))
+        for key, child in node["children"].items():
+            self._collect(child, path + [key], hits)
+
+    def stats(self):
+        return {"clients": len(self.watching), "paths": sum(len(paths) for paths in self.watching.values())}
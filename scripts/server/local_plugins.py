@@ -0,0 +1,292 @@
+import copy
+import time
+import types
+import asyncio
+import importlib
+
+class LocalPluginClient:
+    '''
+    The FofClient API for a trusted plugin running inside the hub. Its
+    handlers are started straight from the server output pump with each
+    line they registered for, commands go straight to the server, and
+    `data_store` is the hub's own (gets hand back copies, like they would
+    over a socket).
+    '''
+    def __init__(self, plugins, name):
+        self.plugins = plugins
+        self.name = name
+        self.addr = ("plugin", name)
+        self.protocol = plugins.protocol
+        self.data_store = plugins.protocol.data_store
+        self.debug = plugins.debug
+        self.event_handlers = {}
+        # Event name -> seconds a handler step can take, if not the default
+        self.budgets = {}
+        self.event_servers = {}
+        self.disabled = False
+        self._on_connect = []
+        self._on_disconnect = []
+        self.ready = asyncio.get_running_loop().create_future()
+        self.stopped = asyncio.Event()
+
+    def on_connect(self, behavior):
+        self._on_connect.append(behavior)
+
+    def on_disconnect(self, behavior):
+        self._on_disconnect.append(behavior)
+
+    def on_event(self, name, ordered=True, budget_ms=None):
+        # Handlers here are always started in the order lines come in, so
+        # `ordered` is only taken so FofClient plugins work unchanged
+        def decorator(func):
+            self.event_handlers[name] = func
+            if budget_ms is not None:
+                self.budgets[name] = budget_ms / 1000
+            return func
+        return decorator
+
+    def wants(self, event_name, server_id):
+        servers = self.event_servers.get(event_name)
+        return servers is None or server_id in servers
+
+    async def register_event(self, name, regex=None, match_=None, exclude=None, startswith=None, endswith=None, logged=None, equal=None, event=None, fields=None, servers=None):
+        if self.disabled: return
+        registry = {}
+        if regex is not None: registry["regex"] = regex
+        if match_ is not None: registry["match"] = match_
+        if exclude is not None: registry["exclude"] = exclude
+        if startswith is not None: registry["startswith"] = startswith
+        if endswith is not None: registry["endswith"] = endswith
+        if logged is not None: registry["logged"] = logged
+        if equal is not None: registry["equal"] = equal
+        if event is not None: registry["event"] = event
+        if fields is not None: registry["fields"] = fields
+        self.protocol.event_engine.register(self.addr, {"registry": {name: registry}})
+        if servers is not None:
+            self.event_servers[name] = set(servers)
+        else:
+            self.event_servers.pop(name, None)
+
+    async def unregister_event(self, name):
+        self.protocol.event_engine.unregister(self.addr, {"events": [name]})
+
+    async def command(self, command_str, capture=False, timeout=10, server=None):
+        '''
+        Queues a command on the server (or the given server, if the hub runs
+        several). With capture, waits for it and returns the lines it printed.
+        '''
+        target = self.protocol.servers.get(server) if server is not None else self.protocol.server
+        if target is None:
+            raise RuntimeError(f"Unknown server: {server}")
+        future = target.command(command_str, capture=capture)
+        if not capture:
+            return None
+        return await asyncio.wait_for(future, timeout)
+
+    async def get(self, keys, timeout=10):
+        return copy.deepcopy(self.data_store.get(keys))
+
+    async def mget(self, keys_list, timeout=10):
+        return copy.deepcopy([self.data_store.get(keys) for keys in keys_list])
+
+    async def scan(self, keys, limit=100, after=None, timeout=10):
+        items, after = self.data_store.scan(keys, limit, after)
+        return copy.deepcopy(items), after
+
+    async def store(self, keys, value, ttl=None):
+        # Through the protocol so cached copies and watchers hear about it
+        body = {"keys": keys, "payload": value}
+        if ttl is not None:
+            body["ttl"] = ttl
+        self.data_store.store(body)
+        self.protocol.stored(keys, ttl)
+
+    async def _update(self, body, ttl):
+        if ttl is not None:
+            body["ttl"] = ttl
+        return self.protocol.update(body)["result"]
+
+    async def incr(self, keys, amount=1, ttl=None, wait=False, timeout=10):
+        return await self._update({"type": "incr", "keys": keys, "amount": amount}, ttl)
+
+    async def append(self, keys, item, cap=None, ttl=None, wait=False, timeout=10):
+        return await self._update({"type": "append", "keys": keys, "payload": item, "cap": cap}, ttl)
+
+    async def extend(self, keys, items, cap=None, ttl=None, wait=False, timeout=10):
+        return await self._update({"type": "extend", "keys": keys, "payload": list(items), "cap": cap}, ttl)
+
+    async def cas(self, keys, expected, value, ttl=None, timeout=10):
+        result = await self._update({"type": "cas", "keys": keys, "expected": expected, "payload": value}, ttl)
+        return result["swapped"], result["value"]
+
+    async def delete(self, keys, wait=False, timeout=10):
+        return await self._update({"type": "delete", "keys": keys}, None)
+
+    async def run(self, reconnect_delay=1):
+        # The hub is always connected, the plugin just has to be set up
+        if not self.ready.done():
+            self.ready.set_result(True)
+        await self.stopped.wait()
+
+class LocalPlugins:
+    '''
+    Trusted plugins loaded into the hub's own process, so reacting to a line
+    doesn't take a round trip through a socket and another process. Plugin
+    modules look the same as for the plugin host: a `load_plugin()` that
+    returns something with an async `start(client)`.
+
+    Each handler call gets its own task as soon as its line is matched, so
+    it starts on the event loop's next pass, with no socket in between.
+    Every stretch a handler runs without giving the event loop back is
+    timed against its budget, since that's time the server output isn't
+    being read. Overruns are reported, and a plugin that keeps going over is
+    switched off.
+    '''
+    def __init__(self, protocol, modules, budget_ms=5, max_overruns=10, debug=False):
+        self.protocol = protocol
+        self.modules = modules
+        self.budget = budget_ms / 1000
+        self.max_overruns = max_overruns
+        self.debug = debug
+        self.clients = {}
+        self.tasks = set()
+        self.start_tasks = []
+        # "<plugin>.<event>" -> [calls, errors, overruns, ms running, max ms]
+        self.timings = {}
+        self.overruns = {}
+
+    async def start(self):
+        for module_name in self.modules:
+            await self.load(module_name)
+        if self.clients:
+            print(f"[LocalPlugins] Running {len(self.clients)} plugins in the hub: {', '.join(client.name for client in self.clients.values())}")
+
+    async def load(self, module_name):
+        # One broken plugin shouldn't keep the hub from starting
+        try:
+            plugin = importlib.import_module(module_name).load_plugin()
+        except Exception as e:
+            print(f"[LocalPlugins] Couldn't load {module_name}: {e}")
+            return
+        await self.add(module_name.split(".")[-1], plugin)
+
+    async def add(self, name, plugin):
+        '''
+        Starts a plugin object under `name`. Returns its client, or None if
+        it failed.
+        '''
+        client = LocalPluginClient(self, name)
+        task = asyncio.create_task(plugin.start(client))
+        await asyncio.wait([task, client.ready], return_when=asyncio.FIRST_COMPLETED)
+        if task.done() and task.exception() is not None:
+            print(f"[LocalPlugins] {name} failed to start: {task.exception()}")
+            return None
+        self.clients[client.addr] = client
+        self.start_tasks.append(task)
+        # The hub is up, so this is as connected as it gets
+        for behavior in client._on_connect:
+            try:
+                await behavior(client)
+            except Exception as e:
+                print(f"[LocalPlugins] Error setting up {name}: {e}")
+        return client
+
+    async def stop(self):
+        for client in self.clients.values():
+            for behavior in client._on_disconnect:
+                try:
+                    await behavior(client)
+                except Exception as e:
+                    print(f"[LocalPlugins] Error stopping {client.name}: {e}")
+            client.stopped.set()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.start_tasks, *self.tasks, return_exceptions=True)
+
+    def dispatch(self, addr, event_names, shared):
+        client = self.clients.get(addr)
+        if client is None or client.disabled: return
+        message = {**shared, "triggered": event_names}
+        for name in event_names:
+            handler = client.event_handlers.get(name)
+            if handler is not None:
+                self.call(client, name, handler, message)
+
+    def call(self, client, name, handler, message):
+        key = f"{client.name}.{name}"
+        budget = client.budgets.get(name, self.budget)
+        timings = self.timings.setdefault(key, [0, 0, 0, 0.0, 0.0])
+        timings[0] += 1
+        # Never run in the pump's own task, so a handler that times itself
+        # out (or gets cancelled) only ever cancels itself
+        task = asyncio.create_task(self._run(client, key, budget, handler, message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, client, key, budget, handler, message):
+        try:
+            # Plain functions work too, and are done once they return
+            coro = self._step(client, key, budget, handler, message)
+            if isinstance(coro, types.CoroutineType):
+                await self._timed(client, key, budget, coro)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._failed(key, e)
+
+    @types.coroutine
+    def _timed(self, client, key, budget, coro):
+        # Passes everything through to the handler like `await` would, but
+        # times each step
+        send, value = coro.send, None
+        while True:
+            try:
+                waiting_on = self._step(client, key, budget, send, value)
+            except StopIteration as e:
+                return e.value
+            try:
+                send, value = coro.send, (yield waiting_on)
+            except BaseException as e:
+                send, value = coro.throw, e
+
+    def _step(self, client, key, budget, func, arg):
+        started = time.perf_counter()
+        try:
+            return func(arg)
+        finally:
+            took = time.perf_counter() - started
+            timings = self.timings[key]
+            timings[3] += took * 1000
+            timings[4] = max(timings[4], took * 1000)
+            if took > budget:
+                self._overran(client, key, took, budget)
+
+    def _failed(self, key, error):
+        self.timings[key][1] += 1
+        print(f"[LocalPlugins] Error in handler for {key}: {error}")
+
+    def _overran(self, client, key, took, budget):
+        self.timings[key][2] += 1
+        overruns = self.overruns[client.name] = self.overruns.get(client.name, 0) + 1
+        print(f"[LocalPlugins] {key} held up the server output for {took * 1000:.1f} ms (budget {budget * 1000:.1f} ms)")
+        if self.max_overruns and overruns >= self.max_overruns and not client.disabled:
+            # Its lines stop being matched at all, so it can't stall anything
+            client.disabled = True
+            self.protocol.event_engine.unregister_all_for_addr(client.addr)
+            print(f"[LocalPlugins] Switched off {client.name} after {overruns} overruns.")
+
+    def stats(self):
+        stats = {}
+        for key, (calls, errors, overruns, total, max_ms) in self.timings.items():
+            stats[key] = {
+                "calls": calls,
+                "errors": errors,
+                "overruns": overruns,
+                "avg_ms": round(total / calls, 3) if calls else 0,
+                "max_ms": round(max_ms, 3)
+            }
+        return {
+            "plugins": [client.name for client in self.clients.values()],
+            "disabled": [client.name for client in self.clients.values() if client.disabled],
+            "handlers": stats
+        }
@@ -0,0 +1,196 @@
+import queue
+import pickle
+import asyncio
+import itertools
+import threading
+import multiprocessing
+
+from scripts.server.event_engine import EventEngine
+
+def _match_worker(conn):
+    # Runs in each worker process with its own copy of the registrations
+    engine = EventEngine()
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        type_ = message[0]
+        if type_ == "lines":
+            _, batch_id, lines = message
+            results = []
+            for i, line in enumerate(lines):
+                result = engine.process_line(line)
+                if result[2]:
+                    results.append((i, result))
+            conn.send((batch_id, results))
+        elif type_ == "register":
+            engine.register(message[1], message[2])
+        elif type_ == "unregister":
+            engine.unregister(message[1], message[2])
+        elif type_ == "unregister_all":
+            engine.unregister_all_for_addr(message[1])
+        elif type_ == "stop":
+            return
+
+class MatchPool:
+    '''
+    Matches server output against the registered events, optionally spread
+    over worker processes so several servers' output can be matched on
+    different cores. Registrations are checked against a local EventEngine
+    first (so a bad one is rejected right away) and then copied to every
+    worker. Each server's lines always go to the same worker.
+
+    Messages to a worker are written by a thread of its own, never on the
+    event loop: a send blocks once the pipe is full, and the worker can be
+    stuck sending results that only the event loop reads.
+
+    With no workers, everything is matched in-process by the local engine.
+    '''
+    def __init__(self, workers=0, debug=False):
+        self.engine = EventEngine(debug=debug)
+        self.workers = []
+        self.senders = []
+        self.debug = debug
+        self.batch_ids = itertools.count(1)
+        self.loop = None
+        self.waiting = {}
+        self.shards = {}
+        # Metrics
+        self.batches = 0
+        self.lines = 0
+        if workers:
+            # Forked, since 'spawn' would re-run `python -m scripts.server`
+            # in every worker. The pool is made before the event loop or any
+            # threads are running, so that's safe.
+            context = multiprocessing.get_context("fork")
+            for _ in range(workers):
+                conn, child_conn = context.Pipe()
+                process = context.Process(target=_match_worker, args=(child_conn,), daemon=True)
+                process.start()
+                child_conn.close()
+                self.workers.append((process, conn, queue.SimpleQueue()))
+            # Only once every worker is forked
+            self.senders = [threading.Thread(target=self._send_loop, args=(conn, outbox), daemon=True) for _, conn, outbox in self.workers]
+            for sender in self.senders:
+                sender.start()
+
+    def start(self, loop):
+        self.loop = loop
+        for _, conn, _ in self.workers:
+            loop.add_reader(conn.fileno(), self._read_results, conn)
+
+    def _send_loop(self, conn, outbox):
+        while True:
+            data = outbox.get()
+            if data is None:
+                return
+            try:
+                conn.send_bytes(data)
+            except (OSError, ValueError) as e:
+                if self.loop is not None:
+                    self.loop.call_soon_threadsafe(self._drop_worker, conn, e)
+                return
+
+    def _send(self, worker, message):
+        # Pickled here, so nothing can change under it before it's written
+        worker[2].put(pickle.dumps(message))
+
+    def _read_results(self, conn):
+        try:
+            while conn.poll():
+                batch_id, results = conn.recv()
+                future, _ = self.waiting.pop(batch_id, (None, None))
+                if future is not None and not future.done():
+                    future.set_result(results)
+        except (EOFError, OSError) as e:
+            self._drop_worker(conn, e)
+
+    def _drop_worker(self, conn, error):
+        # Its servers get spread over whatever is left (or matched locally)
+        if not any(worker[1] is conn for worker in self.workers): return
+        if self.debug:
+            print(f"[MatchPool] Lost a worker: {error}")
+        asyncio.get_running_loop().remove_reader(conn.fileno())
+        for worker in self.workers:
+            if worker[1] is conn:
+                worker[2].put(None)
+        self.workers = [worker for worker in self.workers if worker[1] is not conn]
+        self.shards = {}
+        for batch_id, (future, batch_conn) in list(self.waiting.items()):
+            if batch_conn is conn:
+                del self.waiting[batch_id]
+                if not future.done():
+                    future.set_exception(RuntimeError("Match worker exited"))
+
+    def _broadcast(self, message):
+        for worker in self.workers:
+            self._send(worker, message)
+
+    def register(self, addr, body):
+        self.engine.register(addr, body)
+        self._broadcast(("register", addr, body))
+
+    def unregister(self, addr, body):
+        self.engine.unregister(addr, body)
+        self._broadcast(("unregister", addr, body))
+
+    def unregister_all_for_addr(self, addr):
+        self.engine.unregister_all_for_addr(addr)
+        self._broadcast(("unregister_all", addr))
+
+    async def process_lines(self, shard, lines):
+        '''
+        Matches a batch of lines from one server. Returns (index, result) for
+        the lines that triggered something, where result is what
+        EventEngine.process_line returns.
+        '''
+        self.batches += 1
+        self.lines += len(lines)
+        if self.workers:
+            if shard not in self.shards:
+                self.shards[shard] = len(self.shards) % len(self.workers)
+            worker = self.workers[self.shards[shard]]
+            batch_id = next(self.batch_ids)
+            future = asyncio.get_running_loop().create_future()
+            self.waiting[batch_id] = (future, worker[1])
+            try:
+                self._send(worker, ("lines", batch_id, lines))
+                return await future
+            except RuntimeError:
+                # Its worker exited, so these are matched here
+                self.waiting.pop(batch_id, None)
+        results = []
+        for i, line in enumerate(lines):
+            result = self.engine.process_line(line)
+            if result[2]:
+                results.append((i, result))
+        return results
+
+    def close(self):
+        loop = asyncio.get_running_loop()
+        # Anything going wrong from here on is expected
+        self.loop = None
+        for process, conn, outbox in self.workers:
+            loop.remove_reader(conn.fileno())
+            outbox.put(pickle.dumps(("stop",)))
+            outbox.put(None)
+        for sender in self.senders:
+            sender.join(timeout=1)
+        for process, conn, _ in self.workers:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
+        self.workers = []
+        for future, _ in self.waiting.values():
+            future.cancel()
+        self.waiting = {}
+
+    def stats(self):
+        return {
+            "workers": len(self.workers),
+            "shards": {str(shard): worker for shard, worker in self.shards.items()},
+            "batches": self.batches,
+            "lines": self.lines
+        }
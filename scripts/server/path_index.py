@@ -0,0 +1,196 @@
+import marshal
+from bisect import bisect_left, insort
+
+class PathIndex:
+    '''
+    Storage behind DataStore. Values are kept in nested dicts like they
+    always were, so gets and stores are just a walk down the keys. Alongside
+    them is a tree of bookkeeping for the prefixes that have been asked
+    about: the sorted keys right under a prefix that's been scanned (kept up
+    to date from then on) and the (bytes, leaf count) of one that's been
+    sized (worked out again only after something under it changes).
+
+    Each bookkeeping node is [children, size, sorted keys], and only exists
+    for prefixes that have been scanned or sized (and everything above them),
+    so stores to the rest of the tree don't pay for it.
+    '''
+    MISSING = object()
+    # Sorts after anything that can follow an encoded key
+    END = "\U0010ffff"
+
+    def __init__(self):
+        self.root = {}
+        self.meta = [{}, None, None]
+
+    @staticmethod
+    def encode_key(key):
+        # Each key is tagged by type and ends in "\0\0" (with any "\0" in it
+        # escaped), so a key's encoding is never the start of another's
+        if isinstance(key, str):
+            return ("s" + key.replace("\0", "\0\1") if "\0" in key else "s" + key) + "\0\0"
+        if isinstance(key, (int, float)):
+            # Keys that are equal in a dict (1, 1.0, True) encode the same
+            return "n" + repr(int(key) if isinstance(key, bool) or (isinstance(key, float) and key.is_integer()) else key) + "\0\0"
+        return "r" + repr(key).replace("\0", "\0\1") + "\0\0"
+
+    def get(self, path, default=None):
+        node = self.root
+        for key in path:
+            if not isinstance(node, dict):
+                return default
+            node = node.get(key, self.MISSING)
+            if node is self.MISSING:
+                return default
+        return node
+
+    def set(self, path, value):
+        if not path:
+            self.root = value if isinstance(value, dict) else {}
+            self.meta = [{}, None, None]
+            return
+        node, meta = self.root, self.meta
+        for key in path[:-1]:
+            child = node.get(key, self.MISSING)
+            if child is self.MISSING:
+                child = node[key] = {}
+                if meta is not None:
+                    self._added(meta, key)
+            elif not isinstance(child, dict):
+                # A leaf in the way is replaced by a dict to put this in
+                child = node[key] = {}
+            node = child
+            if meta is not None:
+                meta[1] = None
+                meta = meta[0].get(key)
+        key = path[-1]
+        old = node.get(key, self.MISSING)
+        node[key] = value
+        if meta is None: return
+        meta[1] = None
+        if old is self.MISSING:
+            self._added(meta, key)
+        elif isinstance(old, dict) or isinstance(value, dict):
+            # Nothing known about the old subtree holds for the new one
+            meta[0].pop(key, None)
+        else:
+            child = meta[0].get(key)
+            if child is not None:
+                child[1] = None
+
+    def _added(self, meta, key):
+        if meta[2] is not None:
+            insort(meta[2], (self.encode_key(key), key))
+
+    def delete(self, path, keep_parent=False):
+        '''
+        Removes the value at `path`. Returns False if there wasn't one. With
+        `keep_parent`, a dict left empty stays behind as {} (like deleting
+        from a nested dict), otherwise empty dicts above it go too.
+        '''
+        if not path:
+            if not self.root: return False
+            self.set((), {})
+            return True
+        # The dicts and bookkeeping nodes at each prefix of the path
+        nodes, metas = [self.root], [self.meta]
+        for key in path[:-1]:
+            node = nodes[-1].get(key)
+            if not isinstance(node, dict):
+                return False
+            nodes.append(node)
+            metas.append(metas[-1][0].get(key) if metas[-1] is not None else None)
+        depth = len(path) - 1
+        if path[depth] not in nodes[depth]:
+            return False
+        while True:
+            del nodes[depth][path[depth]]
+            if metas[depth] is not None:
+                self._removed(metas[depth], path[depth])
+            if keep_parent or depth == 0 or nodes[depth]:
+                break
+            depth -= 1
+        for meta in metas[:depth + 1]:
+            if meta is not None:
+                meta[1] = None
+        return True
+
+    def _removed(self, meta, key):
+        meta[0].pop(key, None)
+        if meta[2] is not None:
+            keys = meta[2]
+            i = bisect_left(keys, (self.encode_key(key),))
+            if i < len(keys) and keys[i][1] == key:
+                del keys[i]
+
+    def has_children(self, path):
+        value = self.get(path)
+        return isinstance(value, dict) and bool(value)
+
+    def _meta(self, path):
+        # The bookkeeping node for a prefix, made if it isn't there yet
+        meta = self.meta
+        for key in path:
+            child = meta[0].get(key)
+            if child is None:
+                child = meta[0][key] = [{}, None, None]
+            meta = child
+        return meta
+
+    def scan(self, path, limit=100, after=None):
+        '''
+        Lists the keys right under `path` with their values, in index order,
+        starting after the key `after`. Returns (items, next) where `next` is
+        the `after` for the following page, or None if that was the last.
+        '''
+        node = self.get(path)
+        if not isinstance(node, dict) or not node:
+            return [], None
+        meta = self._meta(path)
+        if meta[2] is None:
+            meta[2] = sorted((self.encode_key(key), key) for key in node)
+        keys = meta[2]
+        start = bisect_left(keys, (self.encode_key(after) + self.END,)) if after is not None else 0
+        page = keys[start:start + limit]
+        items = [[key, node[key]] for _, key in page]
+        return items, (page[-1][1] if start + limit < len(keys) else None)
+
+    def size(self, path):
+        '''
+        Roughly how many bytes the value at `path` takes, and how many leaves
+        it has (an empty dict counts as one).
+        '''
+        value = self.get(path, self.MISSING)
+        if value is self.MISSING:
+            return 0, 0
+        if not isinstance(value, dict):
+            return self._size(path[-1] if path else None, value), 1
+        return self._measure(value, self._meta(path))
+
+    def _measure(self, node, meta):
+        if meta[1] is not None:
+            return meta[1]
+        # The leaves right under a dict are sized together, dicts under it
+        # are measured (and cached) separately
+        size = count = 0
+        leaves = {}
+        for key, value in node.items():
+            if isinstance(value, dict) and value:
+                child = meta[0].get(key)
+                if child is None:
+                    child = meta[0][key] = [{}, None, None]
+                child_size, child_count = self._measure(value, child)
+                size += child_size
+                count += child_count
+            else:
+                leaves[key] = value
+        if leaves:
+            size += self._size(None, leaves)
+            count += len(leaves)
+        meta[1] = (size, count)
+        return meta[1]
+
+    def _size(self, key, value):
+        try:
+            return len(marshal.dumps((key, value)))
+        except ValueError:
+            return len(repr(value))
@@ -1,38 +1,75 @@
-import json
+import hmac
+import time
+import socket
 import asyncio
+import itertools
+
+from scripts.server.client_connection import ClientConnection
+from scripts.server.key_watch import KeyWatch
+from scripts.server.event_engine import EventEngine
+from scripts.server.wire import negotiate, SharedEvent
 
 class FofServerProtocol:
-    def __init__(self, event_engine, data_store, server, debug=False):
+    # Data store updates that only answer when there's an id (or they're in
+    # a batch), so fire-and-forget counters don't get a reply for every one
+    UPDATES = ("incr", "append", "extend", "cas", "delete")
+    # A replay still going after this many seconds is for a client that
+    # isn't reading, which is disconnected (it can resume again later)
+    REPLAY_TIMEOUT = 60
+
+    def __init__(self, event_engine, data_store, server, max_queue=1000, overflow="drop_oldest", debug=False):
         self.clients = {}
         self.event_engine = event_engine
         self.data_store = data_store
         self.server = server
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.log_ring = None
+        self.journals = {}
+        # Key paths clients have cached (so stores can invalidate them) or
+        # are watching for changes
+        self.cache_watch = KeyWatch()
+        self.data_watch = KeyWatch()
+        self.expiry_timer = None
+        # Hubs relaying their events to this one, and what to do with them
+        self.relay_token = None
+        self.relay_handler = None
+        self.links = {}
+        # Plugins running inside the hub, set by the event handler
+        self.local_plugins = None
+        self.servers = {None: server}
+        self.unix_ids = itertools.count(1)
         self.debug = debug
 
     async def handle_client(self, reader, writer):
-        addr = writer.get_extra_info('peername')
-        self.clients[addr] = writer
+        sock = writer.get_extra_info('socket')
+        local = sock is not None and sock.family == socket.AF_UNIX
+        # Unix socket peers don't have an address of their own
+        addr = ("unix", next(self.unix_ids)) if local else writer.get_extra_info('peername')
+        client = ClientConnection(addr, writer, local=local, max_queue=self.max_queue, overflow=self.overflow, debug=self.debug)
+        self.clients[addr] = client
         try:
             while True:
-                try:
-                    data = await asyncio.wait_for(reader.readline(), timeout=60.0)
-                except asyncio.TimeoutError:
-                    continue
-                if not data: break
-                body = json.loads(data.decode(errors='ignore').strip())
+                body = await client.wire.read(reader)
+                if body is None: break
                 type_ = body["type"]
-                if type_ == 'ping':
-                    await self.ping(writer)
-                elif type_ == "store":
-                    self.data_store.store(body)
-                elif type_ == "get":
-                    await self.get(body, writer)
-                elif type_ == "command":
-                    self.server.send_command(body["command"])
-                elif type_ == "register":
-                    self.event_engine.register(addr, body)
-                elif type_ == "unregister":
-                    self.event_engine.unregister(addr, body)
+                if type_ == "hello":
+                    if not self.hello(body, client): break
+                elif type_ == "relay-hello":
+                    if not self.relay_hello(body, client): break
+                elif not client.trusted and self.relay_token is not None:
+                    # A hub with a token (an aggregator, or one that takes
+                    # relays) only talks to other machines once they've sent it
+                    if self.debug:
+                        print(f"[Client Handler] {addr} sent '{type_}' without the token, disconnecting.")
+                    client.send({"type": "error", "request": type_, "error": "Send the hub's token in a 'hello' first"})
+                    break
+                elif type_ == "relay":
+                    await self.relay(body, client)
+                else:
+                    response = self.handle_request(body, client)
+                    if response is not None:
+                        client.send(response)
         except asyncio.CancelledError:
             raise
         except Exception as e:
@@ -40,22 +77,427 @@ class FofServerProtocol:
                 print(f"[Client Handler Error] {e}")
         finally:
             if self.debug:
-                print(f"[Client Disconnected] {addr}")
+                print(f"[Client Disconnected] {addr} {client.stats()}")
             # Unregister all events for this client!
             self.event_engine.unregister_all_for_addr(addr)
-            writer.close()
-            await writer.wait_closed()
+            self.cache_watch.unwatch_all_for_addr(addr)
+            self.data_watch.unwatch_all_for_addr(addr)
+            if client.replay_task is not None:
+                client.replay_task.cancel()
+            if client.origin is not None and client.origin in self.links:
+                self.links[client.origin]["connected"] = False
+            await client.wait_closed()
             del self.clients[addr]
 
-    async def ping(self, writer):
+    def handle_request(self, body, client, quiet=True):
+        '''
+        Handles one request and returns the response to send back, if any.
+        Requests with an 'id' always get a response with the same 'id' (an
+        'ack' if there's nothing else to say, or an 'error' if it failed).
+        '''
+        try:
+            response = self._handle_request(body, client)
+        except Exception as e:
+            if "id" not in body:
+                # Fire-and-forget updates (like an incr on a list) have nobody
+                # to tell, but aren't worth dropping the plugin over
+                if body.get("type") in self.UPDATES:
+                    if self.debug:
+                        print(f"[Request Error] {client.addr} {body['type']} {body.get('keys')}: {e}")
+                    return None
+                # Otherwise it's the old behavior
+                raise
+            if self.debug:
+                print(f"[Request Error] {client.addr} {body.get('type')}: {e}")
+            return {"type": "error", "id": body["id"], "request": body.get("type"), "error": str(e) or type(e).__name__}
+        if "id" not in body or body["type"] == "command":
+            if quiet and body["type"] in self.UPDATES: return None
+            return response
+        if response is None:
+            response = {"type": "ack", "request": body["type"]}
+        response["id"] = body["id"]
+        return response
+
+    def _handle_request(self, body, client):
+        type_ = body["type"]
+        if type_ == 'ping':
+            return self.ping()
+        elif type_ == "store":
+            self.data_store.store(body)
+            self.stored(body["keys"], body.get("ttl"))
+        elif type_ in self.UPDATES:
+            return self.update(body)
+        elif type_ == "mstore":
+            self.mstore(body)
+        elif type_ == "get":
+            return self.get(body, client)
+        elif type_ == "mget":
+            return self.mget(body)
+        elif type_ == "scan":
+            return self.scan(body)
+        elif type_ == "batch":
+            return self.batch(body, client)
+        elif type_ == "watch":
+            return self.watch(body, client)
+        elif type_ == "unwatch":
+            self.data_watch.unwatch(client.addr, body["keys"])
+            client.watch_windows.pop(tuple(body["keys"]), None)
+            client.watch_versions.pop(tuple(body["keys"]), None)
+        elif type_ == "command":
+            self.command(body, client)
+        elif type_ == "register":
+            self.register(body, client)
+        elif type_ == "unregister":
+            self.event_engine.unregister(client.addr, body)
+            for name in body["events"]:
+                client.event_servers.pop(name, None)
+        elif type_ == "stats":
+            return self.stats()
+        elif type_ == "batching":
+            client.set_batching(body.get("window_ms"), body.get("max_events", 32))
+        elif "id" in body:
+            raise ValueError(f"Unknown request type '{type_}'")
+        return None
+
+    def hello(self, body, client):
+        # Off-machine clients only get binary framing (or anything at all, on
+        # a hub with a token) if they know the token
+        if "token" in body and not client.trusted:
+            if not self.check_token(body["token"]):
+                if self.debug:
+                    print(f"[Client Handler] Rejected {client.addr}: bad token.")
+                return False
+            client.trusted = True
+        # The response goes out in the old format, everything after in the new one
+        ring_name = self.log_ring.name if self.log_ring is not None and client.local else None
+        wire, response = negotiate(body, ring_name, trusted=client.trusted)
+        client.send(response)
+        client.set_wire(wire)
+        client.use_ring = "ring" in response
+        return True
+
+    def register(self, body, client):
+        self.event_engine.register(client.addr, body)
+        registry = body.get("registry", {})
+        # One list for every event in the packet, or a list per event name
+        servers = body.get("servers")
+        for name in registry:
+            event_servers = servers.get(name) if isinstance(servers, dict) else servers
+            if event_servers is not None:
+                client.event_servers[name] = set(event_servers)
+            else:
+                client.event_servers.pop(name, None)
+        resume_from = body.get("resume_from")
+        if resume_from is None or not self.journals: return
+        # A plain number is the seq for a hub with just the one server,
+        # otherwise it's a seq per server id
+        if not isinstance(resume_from, dict):
+            resume_from = {None: resume_from}
+        resume_from = {server_id: seq for server_id, seq in resume_from.items() if server_id in self.journals}
+        if not resume_from: return
+        # Everything up to here has already been dispatched, so the replay
+        # covers through the current seq and anything newer is held
+        ends = {server_id: self.journals[server_id].seq for server_id in resume_from}
+        for name, conditions in registry.items():
+            client.replay_pending[name] = (conditions, ends)
+        starts = client.replay_start or {}
+        for server_id, seq in resume_from.items():
+            starts[server_id] = min(starts.get(server_id, seq), seq)
+        client.replay_start = starts
+        client.hold_events()
+        if client.replay_task is None:
+            client.replay_task = asyncio.create_task(self.replay(client))
+
+    async def replay(self, client):
+        '''
+        Sends a reconnecting client the events it missed, straight out of the
+        journal. Registers that arrive together (like everything a plugin
+        registers on connect) are replayed in one pass over each server's
+        journal.
+        '''
+        replayed = {}
+        sent = 0
         try:
-            writer.write(b'__pong__\n')
-            await writer.drain()
-        except Exception:
-            pass
+            async with asyncio.timeout(self.REPLAY_TIMEOUT):
+                while client.replay_pending and not client.closed:
+                    pending, client.replay_pending = client.replay_pending, {}
+                    starts, client.replay_start = client.replay_start, None
+                    engine = EventEngine()
+                    engine.register(client.addr, {"registry": {name: conditions for name, (conditions, _) in pending.items()}})
+                    for server_id, start in starts.items():
+                        end = max(ends.get(server_id, 0) for _, ends in pending.values())
+                        for i, (seq, line) in enumerate(self.journals[server_id].read_from(start + 1, end)):
+                            text, loginfo, triggered, event = engine.process_line(line)
+                            # Each event only replays up to when it was registered
+                            names = [
+                                name for _, name in triggered
+                                if seq <= pending[name][1].get(server_id, 0) and client.wants(name, server_id)
+                            ]
+                            if names:
+                                shared_event = SharedEvent.from_line(text, loginfo, event, seq, server=server_id, replay=True)
+                                client.send_event(shared_event, names, replay=True)
+                                sent += 1
+                            if i % 500 == 499:
+                                await client.wait_for_room()
+                                await asyncio.sleep(0)
+                                if client.closed: return
+                    for name, (_, ends) in pending.items():
+                        for server_id, until in ends.items():
+                            replayed[(server_id, name)] = until
+        except asyncio.CancelledError:
+            raise
+        except TimeoutError:
+            print(f"[Replay] {client.addr} didn't keep up with its replay in {self.REPLAY_TIMEOUT}s, disconnecting.")
+            client.close()
+        except Exception as e:
+            if self.debug:
+                print(f"[Replay Error] {client.addr}: {e}")
+        finally:
+            client.replay_task = None
+            client.replay_pending = {}
+            client.replay_start = None
+            client.release_events(replayed)
+            if self.debug:
+                print(f"[Replay] Sent {sent} missed events to {client.addr}.")
+
+    def command(self, body, client):
+        # Without a server id, commands go to the first server
+        server = self.servers.get(body["server"]) if "server" in body else self.server
+        if server is None:
+            if "id" in body:
+                client.send({"type": "command-response", "id": body["id"], "command": body["command"], "output": None, "error": "unknown server"})
+            return
+        future = server.command(body["command"], capture=body.get("capture", False))
+        # Only clients that gave the command an id are waiting on an answer
+        if "id" not in body: return
+
+        def respond(future):
+            response = {"type": "command-response", "id": body["id"], "command": body["command"], "output": None}
+            if future.cancelled():
+                response["error"] = "cancelled"
+            elif future.exception() is not None:
+                response["error"] = str(future.exception()) or type(future.exception()).__name__
+            else:
+                response["output"] = future.result()
+            client.send(response)
+        future.add_done_callback(respond)
+
+    def check_token(self, token):
+        if self.relay_token is None or not isinstance(token, str): return False
+        return hmac.compare_digest(token.encode(), self.relay_token.encode())
 
-    async def get(self, body, writer):
+    def relay_hello(self, body, client):
+        # Relays always need the token, and a hub without one takes none
+        if not self.check_token(body.get("token")):
+            if self.debug:
+                print(f"[Relay] Rejected link from {client.addr}: bad token.")
+            return False
+        client.trusted = True
+        client.origin = str(body["origin"])
+        link = self.links.setdefault(client.origin, {
+            "lines": 0, "batches": 0, "lag_ms": 0, "max_lag_ms": 0, "avg_lag_ms": 0, "connects": 0
+        })
+        link["connected"] = True
+        link["connects"] += 1
+        link["addr"] = f"{client.addr[0]}:{client.addr[1]}"
+        if self.debug:
+            print(f"[Relay] Link from '{client.origin}' at {client.addr}.")
+        return True
+
+    async def relay(self, body, client):
+        '''
+        Takes a batch of lines from a downstream hub. Waiting on the dispatch
+        here means the next batch isn't read until this one is handled, which
+        is what pushes back on a relay that's sending faster than we can keep
+        up with.
+        '''
+        if client.origin is None: return
+        lines = body.get("lines", [])
+        if not lines: return
+        # Lag is from when the line was read downstream, so it counts on the
+        # two machines' clocks agreeing
+        link = self.links[client.origin]
+        lag_ms = max(0, (time.time() - min(line[2] for line in lines)) * 1000)
+        link["lines"] += len(lines)
+        link["batches"] += 1
+        link["lag_ms"] = round(lag_ms, 1)
+        link["max_lag_ms"] = round(max(link["max_lag_ms"], lag_ms), 1)
+        link["avg_lag_ms"] = round(link["avg_lag_ms"] * 0.9 + lag_ms * 0.1, 1)
+        if self.relay_handler is not None:
+            await self.relay_handler(client.origin, lines)
+
+    def ping(self):
+        return {"type": "pong"}
+
+    def get(self, body, client):
         keys = body["keys"]
         payload = self.data_store.get(keys)
-        writer.write((json.dumps({"type": "get-response", "keys": keys, "payload": payload}) + "\n").encode())
-        await writer.drain()
\ No newline at end of file
+        response = {"type": "get-response", "keys": keys, "payload": payload}
+        # Paths the client has dropped from its cache come along with its
+        # next get
+        for path in body.get("uncache", []):
+            self.cache_watch.unwatch(client.addr, path)
+        if body.get("cache"):
+            self.cache_watch.watch(client.addr, keys)
+            response["cached"] = True
+        return response
+
+    def mget(self, body):
+        # Many key paths in one round trip, answered in the same order
+        keys = body["keys"]
+        return {"type": "mget-response", "keys": keys, "payloads": [self.data_store.get(path) for path in keys]}
+
+    def scan(self, body):
+        # One page of what's right under a prefix, and how big all of it is
+        keys = body["keys"]
+        items, next_ = self.data_store.scan(keys, body.get("limit", 100), body.get("after"))
+        size, leaves = self.data_store.size(keys)
+        return {"type": "scan-response", "keys": keys, "items": items, "next": next_, "bytes": size, "leaves": leaves}
+
+    def mstore(self, body):
+        for item in body["items"]:
+            self.data_store.store(item)
+            self.stored(item["keys"], item.get("ttl"))
+
+    def update(self, body):
+        '''
+        Runs one of the read-modify-write updates in the data store and
+        answers with its result.
+        '''
+        type_, keys, ttl = body["type"], body["keys"], body.get("ttl")
+        changed = True
+        if type_ == "incr":
+            result = self.data_store.incr(keys, body.get("amount", 1), ttl)
+        elif type_ in ("append", "extend"):
+            items = [body["payload"]] if type_ == "append" else body["payload"]
+            result = self.data_store.extend(keys, items, body.get("cap"), ttl)
+        elif type_ == "cas":
+            changed, value = self.data_store.cas(keys, body.get("expected"), body["payload"], ttl)
+            result = {"swapped": changed, "value": value}
+        else:
+            result = changed = self.data_store.delete(keys)
+        if changed:
+            self.stored(keys, ttl)
+        return {"type": "update-response", "request": type_, "keys": keys, "result": result}
+
+    def expire_data(self):
+        self.expiry_timer = None
+        for keys in self.data_store.expire():
+            self.stored(keys)
+        self.schedule_expiry()
+
+    def schedule_expiry(self):
+        delay = self.data_store.next_expiry()
+        if delay is None: return
+        loop = asyncio.get_running_loop()
+        if self.expiry_timer is not None:
+            if self.expiry_timer.when() <= loop.time() + delay: return
+            self.expiry_timer.cancel()
+        self.expiry_timer = loop.call_later(delay, self.expire_data)
+
+    def stored(self, keys, ttl=None):
+        if ttl is not None:
+            self.schedule_expiry()
+        # Clients caching anything at or around these keys drop it
+        for addr, paths in self.cache_watch.stored(keys, forget=True).items():
+            client = self.clients.get(addr)
+            if client is not None:
+                client.send({"type": "invalidate", "keys": paths})
+        # and ones watching them hear what changed
+        for addr, prefixes in self.data_watch.stored(keys).items():
+            client = self.clients.get(addr)
+            if client is None: continue
+            for prefix in prefixes:
+                path = keys if len(keys) >= len(prefix) else prefix
+                # Bursts to the same path go out once, with the latest value
+                key = (tuple(prefix), tuple(path))
+                client.pending_changes.pop(key, None)
+                client.pending_changes[key] = path
+                window = client.watch_windows.get(tuple(prefix), 0)
+                if client.change_timer is None:
+                    client.change_timer = asyncio.get_running_loop().call_later(window, self.flush_changes, client)
+
+    def change(self, keys):
+        value = self.data_store.get(keys, self.data_store.MISSING)
+        if value is self.data_store.MISSING:
+            return {"keys": keys, "deleted": True}
+        return {"keys": keys, "value": value}
+
+    def flush_changes(self, client):
+        client.change_timer = None
+        pending, client.pending_changes = client.pending_changes, {}
+        by_prefix = {}
+        for (prefix, key), path in pending.items():
+            # A change above this one already carries its current value
+            if any((prefix, key[:i]) in pending for i in range(len(prefix), len(key))): continue
+            by_prefix.setdefault(prefix, []).append(self.change(path))
+        store = self.data_store
+        for prefix, changes in by_prefix.items():
+            # The base lets the client tell if it missed a packet in between
+            base = client.watch_versions.get(prefix)
+            client.watch_versions[prefix] = store.version
+            client.send({"type": "changes", "keys": list(prefix), "epoch": store.epoch, "base": base, "version": store.version, "changes": changes})
+
+    def watch(self, body, client):
+        '''
+        Subscribes the client to changes at or under a key prefix. The answer
+        has the changes since the client's `since` version, or the prefix's
+        whole value (with 'reset') if it didn't give one, it's too old, or
+        it's from another epoch of the store.
+        '''
+        prefix = list(body["keys"])
+        self.data_watch.watch(client.addr, prefix)
+        client.watch_windows[tuple(prefix)] = body.get("window_ms", 0) / 1000
+        client.watch_versions[tuple(prefix)] = self.data_store.version
+        since = body.get("since")
+        if since is not None and body.get("epoch") == self.data_store.epoch:
+            paths = self.data_store.changed_since(prefix, since)
+        else:
+            paths = None
+        if paths is None:
+            changes = [self.change(prefix)]
+        else:
+            changes = {}
+            for path in paths:
+                path = path if len(path) >= len(prefix) else prefix
+                changes.pop(tuple(path), None)
+                changes[tuple(path)] = self.change(path)
+            changes = list(changes.values())
+        return {"type": "watch-response", "keys": prefix, "epoch": self.data_store.epoch, "version": self.data_store.version, "changes": changes, "reset": paths is None}
+
+    def batch(self, body, client):
+        '''
+        Runs a list of requests in order and answers with all of their
+        responses at once (None for ones with nothing to say). One failing
+        doesn't stop the rest.
+        '''
+        responses = []
+        for request in body["requests"]:
+            if request.get("type") in ("hello", "relay-hello", "relay", "batch"):
+                responses.append({"type": "error", "request": request.get("type"), "error": "not allowed in a batch"})
+                continue
+            try:
+                responses.append(self.handle_request(request, client, quiet=False))
+            except Exception as e:
+                responses.append({"type": "error", "request": request.get("type"), "error": str(e) or type(e).__name__})
+        return {"type": "batch-response", "responses": responses}
+
+    def stats(self):
+        clients = {f"{addr[0]}:{addr[1]}": c.stats() for addr, c in self.clients.items()}
+        server = self.server.stats() if self.server is not None and hasattr(self.server, "stats") else {}
+        response = {"type": "stats-response", "clients": clients, "server": server}
+        if len(self.servers) > 1:
+            response["servers"] = {server_id: s.stats() for server_id, s in self.servers.items()}
+        if hasattr(self.event_engine, "stats"):
+            response["matching"] = self.event_engine.stats()
+        if self.links:
+            response["links"] = self.links
+        if self.cache_watch.watching:
+            response["cache"] = self.cache_watch.stats()
+        if self.data_watch.watching:
+            response["watch"] = self.data_watch.stats()
+        if hasattr(self.data_store, "stats"):
+            response["store"] = self.data_store.stats()
+        if self.local_plugins is not None and self.local_plugins.clients:
+            response["plugins"] = self.local_plugins.stats()
+        return response
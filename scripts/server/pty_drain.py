@@ -0,0 +1,174 @@
+import os
+import errno
+import select
+import tempfile
+import threading
+from collections import deque
+
+class PtyDrain:
+    '''
+    Drains the server's PTY on a dedicated thread so srcds never blocks on a
+    full terminal buffer, however slow the asyncio side gets. Complete lines
+    go into a bounded in-memory buffer, and once that's full they spill to a
+    temp file until the consumer catches up.
+    '''
+    MIN_READ_SIZE = 16384
+    MAX_READ_SIZE = 262144
+    # How often the thread checks whether it's been asked to stop
+    POLL_INTERVAL = 0.5
+    # How many spilled lines are pulled back into memory at a time
+    SPILL_READ_SIZE = 1048576
+
+    def __init__(self, fd, max_lines=10000, debug=False):
+        self.fd = fd
+        self.max_lines = max_lines
+        self.debug = debug
+        self.lines = deque()
+        self.lock = threading.Lock()
+        self.spill = None
+        self.spill_read = 0
+        self.spill_write = 0
+        self.spill_pending = 0
+        self.eof = False
+        self.stopping = False
+        self.thread = None
+        self.loop = None
+        self.waiter = None
+        # Metrics
+        self.lines_read = 0
+        self.high_water = 0
+        self.spilled_lines = 0
+        self.spilled_bytes = 0
+        self.spill_high_water = 0
+
+    def start(self, loop):
+        self.loop = loop
+        self.thread = threading.Thread(target=self._drain, name="PtyDrain", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        if self.thread is not None:
+            self.thread.join(timeout=self.POLL_INTERVAL * 2)
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+    def _drain(self):
+        buffer = bytearray()
+        read_size = self.MIN_READ_SIZE
+        try:
+            while not self.stopping:
+                ready, _, _ = select.select([self.fd], [], [], self.POLL_INTERVAL)
+                if not ready: continue
+                try:
+                    data = os.read(self.fd, read_size)
+                except OSError as e:
+                    if e.errno == errno.EIO: break
+                    raise
+                if not data: break
+
+                if len(data) == read_size:
+                    read_size = min(read_size * 2, self.MAX_READ_SIZE)
+                elif len(data) < read_size // 4:
+                    read_size = max(read_size // 2, self.MIN_READ_SIZE)
+
+                buffer += data
+                start = 0
+                lines = []
+                while (end := buffer.find(b"\n", start)) != -1:
+                    lines.append(bytes(buffer[start:end]))
+                    start = end + 1
+                del buffer[:start]
+                if lines:
+                    self._push(lines)
+        except Exception as e:
+            if self.debug:
+                print(f"[PtyDrain] Error while reading output: {e}")
+        finally:
+            with self.lock:
+                self.eof = True
+            self._wake()
+
+    def _push(self, lines):
+        with self.lock:
+            self.lines_read += len(lines)
+            # Once anything has spilled, everything after it has to spill too
+            # or lines would come out of order
+            room = 0 if self.spill_pending else max(0, self.max_lines - len(self.lines))
+            self.lines.extend(lines[:room])
+            self.high_water = max(self.high_water, len(self.lines))
+            if len(lines) > room:
+                self._spill(lines[room:])
+        self._wake()
+
+    def _spill(self, lines):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+        data = b"\n".join(lines) + b"\n"
+        self.spill.seek(self.spill_write)
+        self.spill.write(data)
+        self.spill_write += len(data)
+        self.spill_pending += len(lines)
+        self.spilled_lines += len(lines)
+        self.spilled_bytes += len(data)
+        self.spill_high_water = max(self.spill_high_water, self.spill_pending)
+        if self.debug and self.spill_pending == len(lines):
+            print(f"[PtyDrain] Line buffer full ({self.max_lines} lines), spilling to disk.")
+
+    def _unspill(self):
+        # Pulls the oldest spilled lines back into memory (lock held)
+        self.spill.seek(self.spill_read)
+        data = self.spill.read(self.SPILL_READ_SIZE)
+        end = data.rfind(b"\n")
+        if end == -1:
+            # A single line longer than the read size
+            data += self.spill.readline()
+            end = len(data) - 1
+        lines = data[:end].split(b"\n")
+        self.spill_read += end + 1
+        self.spill_pending -= len(lines)
+        self.lines.extend(lines)
+        if not self.spill_pending:
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.spill_read = self.spill_write = 0
+
+    def _wake(self):
+        waiter = self.waiter
+        if waiter is not None:
+            self.loop.call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(None))
+
+    async def get_lines(self):
+        '''
+        Returns every buffered line (decoded), waiting if there are none.
+        Returns None once the PTY is closed and everything has been read.
+        '''
+        while True:
+            with self.lock:
+                if not self.lines and self.spill_pending:
+                    self._unspill()
+                lines, self.lines = self.lines, deque()
+                if not lines and self.eof:
+                    return None
+                if not lines:
+                    self.waiter = self.loop.create_future()
+            if lines:
+                return [line.decode(errors='ignore') for line in lines]
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "buffered": len(self.lines),
+                "max_lines": self.max_lines,
+                "lines_read": self.lines_read,
+                "high_water": self.high_water,
+                "spilled_lines": self.spilled_lines,
+                "spilled_bytes": self.spilled_bytes,
+                "spill_pending": self.spill_pending,
+                "spill_high_water": self.spill_high_water
+            }
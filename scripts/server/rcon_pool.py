@@ -0,0 +1,256 @@
+import time
+import struct
+import asyncio
+import itertools
+
+class RconError(Exception):
+    pass
+
+class RconNotSent(RconError):
+    '''
+    The command never went out (no connection, bad password, too long), so
+    it's safe to send some other way.
+    '''
+    pass
+
+class RconAuthError(RconNotSent):
+    '''
+    The server turned down the RCON password, which retrying won't fix.
+    '''
+    pass
+
+class RconConnection:
+    '''
+    One authenticated Source RCON connection. Any number of commands can be
+    in flight at once: every command is followed by an empty response-value
+    packet, which the server mirrors back once it's done answering, so each
+    response is found by its request id and its end by the terminator's id.
+    '''
+    HEADER = struct.Struct("<iii")
+    SERVERDATA_AUTH = 3
+    SERVERDATA_AUTH_RESPONSE = 2
+    SERVERDATA_EXECCOMMAND = 2
+    SERVERDATA_RESPONSE_VALUE = 0
+    # srcds won't take packets bigger than this
+    MAX_BODY = 4096 - 10
+
+    def __init__(self, host, port, password, timeout=5.0, debug=False):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.debug = debug
+        self.reader = None
+        self.writer = None
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.terminators = {}
+        self.read_task = None
+        self.connected = False
+
+    def _packet(self, id_, type_, body):
+        data = body.encode() + b"\x00\x00"
+        return self.HEADER.pack(len(data) + 8, id_, type_) + data
+
+    async def _read_packet(self):
+        size = struct.unpack("<i", await self.reader.readexactly(4))[0]
+        data = await self.reader.readexactly(size)
+        id_, type_ = struct.unpack_from("<ii", data)
+        return id_, type_, data[8:-2]
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        try:
+            auth_id = next(self.ids)
+            self.writer.write(self._packet(auth_id, self.SERVERDATA_AUTH, self.password))
+            await self.writer.drain()
+            while True:
+                id_, type_, _ = await asyncio.wait_for(self._read_packet(), self.timeout)
+                # srcds sends an empty response-value before the auth response
+                if type_ != self.SERVERDATA_AUTH_RESPONSE: continue
+                if id_ == -1:
+                    raise RconAuthError("RCON password was rejected")
+                if id_ == auth_id: break
+        except BaseException:
+            self.writer.close()
+            raise
+        self.connected = True
+        self.read_task = asyncio.create_task(self._read_responses())
+
+    async def _read_responses(self):
+        try:
+            while True:
+                id_, type_, body = await self._read_packet()
+                if id_ in self.pending:
+                    self.pending[id_]["parts"].append(body)
+                elif id_ in self.terminators:
+                    # srcds answers the terminator with two packets, either
+                    # one means the response before it is complete
+                    entry = self.pending.pop(self.terminators.pop(id_), None)
+                    if entry is not None and not entry["future"].done():
+                        entry["future"].set_result(b"".join(entry["parts"]).decode(errors="ignore"))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.debug:
+                print(f"[RconConnection] Lost connection to {self.host}:{self.port}: {e}")
+        finally:
+            self._fail_pending(RconError("RCON connection lost"))
+
+    def _fail_pending(self, error):
+        self.connected = False
+        pending, self.pending, self.terminators = self.pending, {}, {}
+        for entry in pending.values():
+            if not entry["future"].done():
+                entry["future"].set_exception(error)
+
+    def execute(self, command):
+        '''
+        Sends a command and returns a future for the server's response text.
+        '''
+        if not self.connected:
+            raise RconNotSent("Not connected")
+        if len(command.encode()) > self.MAX_BODY:
+            raise RconNotSent("Command is too long for RCON")
+        id_, terminator = next(self.ids), next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[id_] = {"parts": [], "future": future}
+        self.terminators[terminator] = id_
+        # A response that never comes (timed out or cancelled) shouldn't
+        # leave its entries behind for as long as the connection lasts
+        future.add_done_callback(lambda _: self._forget(id_, terminator))
+        self.writer.write(
+            self._packet(id_, self.SERVERDATA_EXECCOMMAND, command)
+            + self._packet(terminator, self.SERVERDATA_RESPONSE_VALUE, "")
+        )
+        return future
+
+    def _forget(self, id_, terminator):
+        self.pending.pop(id_, None)
+        self.terminators.pop(terminator, None)
+
+    async def close(self):
+        if self.read_task is not None:
+            self.read_task.cancel()
+            try:
+                await self.read_task
+            except asyncio.CancelledError:
+                pass
+            self.read_task = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+        self._fail_pending(RconError("RCON connection closed"))
+
+class RconPool:
+    '''
+    A few persistent RCON connections to the server. Commands go to whichever
+    connection has the least in flight, connections are opened when they're
+    first needed, and dropped connections are reopened the next time they're
+    picked. Commands go out no faster than `rate` per second, like the
+    console's.
+    '''
+    def __init__(self, host, port, password, size=2, timeout=5.0, rate=20, debug=False):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.size = size
+        self.timeout = timeout
+        self.min_interval = 1 / rate if rate else 0
+        self.next_send = 0
+        self.debug = debug
+        self.connections = [None] * size
+        self.connecting = [None] * size
+        self.in_flight = [0] * size
+        # Metrics
+        self.sent = 0
+        self.reconnects = 0
+        self.errors = 0
+
+    async def _connection(self, slot):
+        connection = self.connections[slot]
+        if connection is not None and connection.connected:
+            return connection
+        # Only one reconnect per slot at a time
+        if self.connecting[slot] is None:
+            self.connecting[slot] = asyncio.create_task(self._connect(slot))
+        try:
+            return await asyncio.shield(self.connecting[slot])
+        finally:
+            if self.connecting[slot] is not None and self.connecting[slot].done():
+                self.connecting[slot] = None
+
+    async def _connect(self, slot):
+        if self.connections[slot] is not None:
+            self.reconnects += 1
+            await self.connections[slot].close()
+        connection = RconConnection(self.host, self.port, self.password, timeout=self.timeout, debug=self.debug)
+        await connection.connect()
+        self.connections[slot] = connection
+        if self.debug:
+            print(f"[RconPool] Connection {slot} to {self.host}:{self.port} is up.")
+        return connection
+
+    def _pick(self):
+        # Fewest commands in flight, counting ones still waiting on a connection
+        return min(range(self.size), key=lambda slot: self.in_flight[slot])
+
+    async def execute(self, command):
+        '''
+        Runs a command over RCON and returns the response text. Commands are
+        only retried if they never made it out, so nothing runs twice, and
+        RconNotSent means it didn't go out at all. Any other error means it
+        may well have run.
+        '''
+        # Each command takes the next free send slot, in the order they came in
+        now = time.monotonic()
+        send_at = max(now, self.next_send)
+        self.next_send = send_at + self.min_interval
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+        slot = self._pick()
+        self.in_flight[slot] += 1
+        try:
+            for attempt in range(2):
+                try:
+                    connection = await self._connection(slot)
+                    future = connection.execute(command)
+                    break
+                except RconError as e:
+                    # Bad passwords won't fix themselves
+                    if attempt or isinstance(e, RconAuthError):
+                        self.errors += 1
+                        raise e if isinstance(e, RconNotSent) else RconNotSent(str(e))
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                    if attempt:
+                        self.errors += 1
+                        raise RconNotSent(f"Couldn't reach {self.host}:{self.port}: {e}")
+            self.sent += 1
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except (RconError, asyncio.TimeoutError):
+                self.errors += 1
+                raise
+        finally:
+            self.in_flight[slot] -= 1
+
+    async def close(self):
+        for task in self.connecting:
+            if task is not None:
+                task.cancel()
+        for connection in self.connections:
+            if connection is not None:
+                await connection.close()
+        self.connections = [None] * self.size
+
+    def stats(self):
+        return {
+            "connections": sum(1 for c in self.connections if c is not None and c.connected),
+            "in_flight": sum(self.in_flight),
+            "sent": self.sent,
+            "reconnects": self.reconnects,
+            "errors": self.errors
+        }
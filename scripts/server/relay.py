@@ -0,0 +1,154 @@
+import time
+import asyncio
+from collections import deque
+
+from scripts.server.wire import JsonLines, BinaryFrames
+
+class RelayLink:
+    '''
+    Forwards the lines matching a set of registrations to an upstream
+    aggregator hub over one long-lived connection. The link sits in the
+    protocol's client table like any other plugin, so the hub's matching and
+    dispatch don't know the difference.
+
+    Lines wait in a bounded buffer and go out in compressed batches. The next
+    batch isn't sent until the last one has drained, so a slow upstream backs
+    up into the buffer, and past `max_pending` lines the oldest are dropped.
+    '''
+    def __init__(self, protocol, host, port, origin, registry, token=None, window_ms=100, max_events=256,
+                 max_pending=10000, reconnect_delay=5, debug=False):
+        if not token:
+            raise ValueError("Relaying needs a token (FOF_RELAY_TOKEN), the upstream hub won't take a link without one")
+        self.protocol = protocol
+        self.host = host
+        self.port = port
+        self.origin = origin
+        self.registry = registry
+        self.token = token
+        self.window = window_ms / 1000
+        self.max_events = max_events
+        self.reconnect_delay = reconnect_delay
+        self.debug = debug
+        self.addr = ("relay", origin)
+        self.use_ring = False
+        self.pending = deque(maxlen=max_pending)
+        self.ready = asyncio.Event()
+        self.writer = None
+        self.connected = False
+        self.task = None
+        # Metrics
+        self.sent = 0
+        self.batches = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.reconnects = 0
+
+    def start(self):
+        self.protocol.clients[self.addr] = self
+        self.protocol.event_engine.register(self.addr, {"registry": self.registry})
+        self.task = asyncio.create_task(self._run())
+
+    def wants(self, event_name, server_id):
+        return True
+
+    def send_event(self, event, triggered, replay=False):
+        shared = event.shared
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        # Sent as the raw line so the upstream hub can match it against its
+        # own plugins' events
+        self.pending.append([shared["loginfo"] + shared["data"], shared.get("server"), time.time()])
+        self.high_water = max(self.high_water, len(self.pending))
+        self.ready.set()
+        return True
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        wire = JsonLines()
+        # The upstream hub only speaks binary with peers that know its token
+        hello = {"type": "hello", "framing": "binary", "compress": True, "token": self.token}
+        writer.write(wire.frame(wire.dumps(hello)))
+        await writer.drain()
+        response = await asyncio.wait_for(wire.read(reader), timeout=5)
+        if not response or response.get("framing") != "binary":
+            writer.close()
+            raise ConnectionError("Upstream hub doesn't support binary framing")
+        wire = BinaryFrames(compress=response.get("compress", False))
+        hello = {"type": "relay-hello", "origin": self.origin, "token": self.token}
+        writer.write(wire.frame(wire.dumps(hello)))
+        await writer.drain()
+        return reader, writer, wire
+
+    async def _run(self):
+        while True:
+            closed = None
+            try:
+                reader, self.writer, wire = await self._connect()
+                self.connected = True
+                if self.debug:
+                    print(f"[RelayLink] Relaying to {self.host}:{self.port} as '{self.origin}'.")
+                closed = asyncio.create_task(reader.read())
+                while not closed.done():
+                    if not self.pending:
+                        self.ready.clear()
+                        ready = asyncio.create_task(self.ready.wait())
+                        await asyncio.wait([closed, ready], return_when=asyncio.FIRST_COMPLETED)
+                        ready.cancel()
+                        continue
+                    # Give a busy moment a little time to fill the batch
+                    if len(self.pending) < self.max_events:
+                        await asyncio.sleep(self.window)
+                    count = min(len(self.pending), self.max_events)
+                    lines = [self.pending[i] for i in range(count)]
+                    self.writer.write(wire.frame(wire.dumps({"type": "relay", "lines": lines, "sent": time.time()})))
+                    await self.writer.drain()
+                    # Only let go of them once they're on their way (some may
+                    # already have been pushed out of a full buffer meanwhile)
+                    sent = {id(line) for line in lines}
+                    while self.pending and id(self.pending[0]) in sent:
+                        self.pending.popleft()
+                    self.sent += count
+                    self.batches += 1
+                raise ConnectionError("Upstream hub closed the link")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.debug:
+                    print(f"[RelayLink] Link to {self.host}:{self.port} is down: {e}")
+            finally:
+                self.connected = False
+                if closed is not None:
+                    closed.cancel()
+                if self.writer is not None:
+                    self.writer.close()
+                    self.writer = None
+            self.reconnects += 1
+            await asyncio.sleep(self.reconnect_delay)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def wait_closed(self):
+        self.close()
+        if self.task is not None:
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.protocol.event_engine.unregister_all_for_addr(self.addr)
+        self.protocol.clients.pop(self.addr, None)
+
+    def stats(self):
+        return {
+            "upstream": f"{self.host}:{self.port}",
+            "connected": self.connected,
+            "queued": len(self.pending),
+            "max_queue": self.pending.maxlen,
+            "high_water": self.high_water,
+            "sent": self.sent,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "reconnects": self.reconnects
+        }
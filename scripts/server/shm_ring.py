@@ -0,0 +1,90 @@
+import os
+import struct
+from multiprocessing import shared_memory, resource_tracker
+
+class LogRing:
+    '''
+    Ring buffer of recent log lines in shared memory. The hub writes each line
+    once and local plugins read it straight out of the ring by sequence
+    number, so the line itself isn't copied to every client's socket.
+
+    Layout: a header (magic, slot count, slot size) followed by fixed-size
+    slots. Each slot starts with the sequence number and length of the line
+    in it. The sequence is zeroed while a slot is being rewritten, so readers
+    can tell a torn or overwritten slot from the line they asked for.
+    '''
+    MAGIC = b"FOFR"
+    HEADER = struct.Struct("<4sII")
+    SLOT_HEADER = struct.Struct("<QI")
+
+    def __init__(self, name=None, slots=4096, slot_size=1024, create=True):
+        if create:
+            size = self.HEADER.size + slots * slot_size
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.HEADER.pack_into(self.shm.buf, 0, self.MAGIC, slots, slot_size)
+        else:
+            self.shm = self._attach(name)
+            magic, slots, slot_size = self.HEADER.unpack_from(self.shm.buf, 0)
+            if magic != self.MAGIC:
+                self.shm.close()
+                raise ValueError(f"Shared memory '{name}' is not a log ring")
+        self.name = self.shm.name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_line = slot_size - self.SLOT_HEADER.size
+        self.owner = create
+        self.seq = 0
+
+    @staticmethod
+    def _attach(name):
+        # Attaching registers the segment with this process's resource
+        # tracker, which would unlink it out from under the hub on exit
+        try:
+            return shared_memory.SharedMemory(name=name, create=False, track=False)
+        except TypeError:
+            # Before Python 3.13 it can only be unregistered afterwards, by
+            # the name the tracker knows it by (with the leading slash)
+            shm = shared_memory.SharedMemory(name=name, create=False)
+            if os.name == "posix":
+                resource_tracker.unregister("/" + shm.name.lstrip("/"), "shared_memory")
+            return shm
+
+    def _offset(self, seq):
+        return self.HEADER.size + (seq % self.slots) * self.slot_size
+
+    def write(self, data):
+        '''
+        Appends a line (as bytes) and returns its sequence number, or None if
+        it's too long for a slot and has to be sent the normal way.
+        '''
+        if len(data) > self.max_line: return None
+        self.seq += 1
+        offset = self._offset(self.seq)
+        buf = self.shm.buf
+        self.SLOT_HEADER.pack_into(buf, offset, 0, len(data))
+        start = offset + self.SLOT_HEADER.size
+        buf[start:start + len(data)] = data
+        self.SLOT_HEADER.pack_into(buf, offset, self.seq, len(data))
+        return self.seq
+
+    def read(self, seq):
+        '''
+        Returns the line for a sequence number, or None if it has already
+        been overwritten by newer lines.
+        '''
+        offset = self._offset(seq)
+        buf = self.shm.buf
+        found, length = self.SLOT_HEADER.unpack_from(buf, offset)
+        if found != seq or length > self.max_line: return None
+        start = offset + self.SLOT_HEADER.size
+        data = bytes(buf[start:start + length])
+        if self.SLOT_HEADER.unpack_from(buf, offset)[0] != seq: return None
+        return data
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
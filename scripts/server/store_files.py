@@ -0,0 +1,129 @@
+import os
+import struct
+import marshal
+import itertools
+
+class StoreFiles:
+    '''
+    On-disk side of a persistent DataStore. A snapshot is one file per
+    top-level key plus a `manifest` naming them (with the store version and
+    TTLs it was taken at), and `wal` logs every change made since. Restoring
+    is the snapshot plus the log tail past its version.
+
+    Snapshots only rewrite the top-level keys that changed, and a key that
+    hasn't changed since can be dropped from memory, since its snapshot file
+    is already an up to date copy.
+    '''
+    RECORD = struct.Struct("<I")
+
+    def __init__(self, directory, debug=False):
+        self.directory = directory
+        self.debug = debug
+        self.subtree_dir = os.path.join(directory, "subtrees")
+        os.makedirs(self.subtree_dir, exist_ok=True)
+        self.manifest_path = os.path.join(directory, "manifest")
+        self.wal_path = os.path.join(directory, "wal")
+        # Top-level key -> (file name, size) in the current snapshot
+        self.files = {}
+        self.file_ids = itertools.count(1)
+        self.wal = None
+        self.wal_bytes = 0
+
+    def load_manifest(self):
+        '''
+        Returns (version, expiries) from the last snapshot, or None if there
+        isn't one. Expiries are (path, wall clock deadline) pairs.
+        '''
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path, "rb") as fp:
+            manifest = marshal.load(fp)
+        self.files = manifest["files"]
+        used = [int(name.split(".")[0]) for name, _ in self.files.values()]
+        self.file_ids = itertools.count(max(used, default=0) + 1)
+        # Files from a snapshot that didn't finish
+        names = {name for name, _ in self.files.values()}
+        for name in os.listdir(self.subtree_dir):
+            if name not in names:
+                os.remove(os.path.join(self.subtree_dir, name))
+        return manifest["version"], manifest["expiries"]
+
+    def read_subtree(self, key):
+        with open(os.path.join(self.subtree_dir, self.files[key][0]), "rb") as fp:
+            return marshal.load(fp)
+
+    def read_wal(self):
+        '''
+        Yields the logged records in order, and trims a record that was only
+        half written (like after a crash).
+        '''
+        if not os.path.exists(self.wal_path): return
+        end = 0
+        with open(self.wal_path, "rb") as fp:
+            while True:
+                header = fp.read(self.RECORD.size)
+                if len(header) < self.RECORD.size: break
+                data = fp.read(self.RECORD.unpack(header)[0])
+                try:
+                    record = marshal.loads(data)
+                except (EOFError, ValueError, TypeError):
+                    break
+                end = fp.tell()
+                yield record
+        os.truncate(self.wal_path, end)
+
+    def open_wal(self):
+        self.wal = open(self.wal_path, "ab")
+        self.wal_bytes = self.wal.tell()
+
+    def log(self, record):
+        data = marshal.dumps(record)
+        self.wal.write(self.RECORD.pack(len(data)) + data)
+        # Flushed to the OS every time, so only the machine going down (not
+        # the hub) can lose a change
+        self.wal.flush()
+        self.wal_bytes += self.RECORD.size + len(data)
+
+    def write_snapshot(self, version, subtrees, deleted, expiries):
+        '''
+        Writes the changed top-level keys and a new manifest, then starts a
+        fresh log. Returns {key: size} for the keys it wrote.
+        '''
+        written = {}
+        old_files = []
+        for key, value in subtrees.items():
+            data = marshal.dumps(value)
+            name = f"{next(self.file_ids)}.bin"
+            with open(os.path.join(self.subtree_dir, name), "wb") as fp:
+                fp.write(data)
+                os.fsync(fp.fileno())
+            if key in self.files:
+                old_files.append(self.files[key][0])
+            self.files[key] = (name, len(data))
+            written[key] = len(data)
+        for key in deleted:
+            if key in self.files:
+                old_files.append(self.files.pop(key)[0])
+
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "wb") as fp:
+            marshal.dump({"version": version, "files": self.files, "expiries": expiries}, fp)
+            os.fsync(fp.fileno())
+        os.replace(temp_path, self.manifest_path)
+        # Anything left in the old log is now older than the snapshot, and
+        # would be skipped on restore anyway
+        if self.wal is not None:
+            self.wal.close()
+        self.wal = open(self.wal_path, "wb")
+        self.wal_bytes = 0
+        for name in old_files:
+            try:
+                os.remove(os.path.join(self.subtree_dir, name))
+            except OSError:
+                pass
+        return written
+
+    def close(self):
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
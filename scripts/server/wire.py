@@ -0,0 +1,210 @@
+import os
+import json
+import zlib
+import stat
+import getpass
+import asyncio
+import struct
+import ipaddress
+import marshal
+import tempfile
+
+class JsonLines:
+    '''
+    The original wire format: one JSON object per line. Every client starts
+    out speaking this, and old clients never leave it.
+    '''
+    name = "json"
+
+    def dumps(self, message):
+        return json.dumps(message).encode()
+
+    def loads(self, body):
+        return json.loads(body.decode(errors="ignore"))
+
+    def frame(self, body):
+        return body + b"\n"
+
+    async def read(self, reader):
+        line = await reader.readline()
+        if not line: return None
+        return self.loads(line.strip())
+
+    def event_prefix(self, shared):
+        # Everything but the closing brace, ready for the triggered list
+        return json.dumps(shared)[:-1].encode() + b', "triggered": '
+
+    def event_body(self, prefix, triggered):
+        return prefix + json.dumps(triggered).encode() + b"}"
+
+    def batch_body(self, bodies):
+        return b'{"type": "batch", "events": [' + b", ".join(bodies) + b']}'
+
+
+class BinaryFrames:
+    '''
+    Length-prefixed frames with a marshal-encoded body, optionally zlib
+    compressed when they get big. The 4 byte big-endian header holds the body
+    length, with the top bit set if the body is compressed.
+
+    marshal is only safe with trusted peers, so the hub only agrees to it
+    for clients on the same machine (or ones that have sent the hub's
+    token). Anyone else asking for it gets JSON.
+    '''
+    name = "binary"
+    # Marshal version 2 has no back-references, so separately encoded pieces
+    # can be spliced together (see event_body and batch_body)
+    MARSHAL_VERSION = 2
+    HEADER = struct.Struct("!I")
+    COMPRESSED = 0x80000000
+    MAX_FRAME = 64 * 1024 * 1024
+    COMPRESS_THRESHOLD = 1024
+
+    def __init__(self, compress=False):
+        self.compress = compress
+
+    def dumps(self, message):
+        return marshal.dumps(message, self.MARSHAL_VERSION)
+
+    def loads(self, body):
+        return marshal.loads(body)
+
+    def frame(self, body):
+        if self.compress and len(body) >= self.COMPRESS_THRESHOLD:
+            compressed = zlib.compress(body, 1)
+            if len(compressed) < len(body):
+                return self.HEADER.pack(len(compressed) | self.COMPRESSED) + compressed
+        return self.HEADER.pack(len(body)) + body
+
+    async def read(self, reader):
+        try:
+            header = await reader.readexactly(self.HEADER.size)
+        except asyncio.IncompleteReadError:
+            return None
+        (length,) = self.HEADER.unpack(header)
+        compressed = length & self.COMPRESSED
+        length &= ~self.COMPRESSED
+        if length > self.MAX_FRAME:
+            raise ValueError(f"Frame of {length} bytes is over the {self.MAX_FRAME} byte limit")
+        body = await reader.readexactly(length)
+        if compressed:
+            # A small frame can inflate to anything, so cap it too
+            inflate = zlib.decompressobj()
+            body = inflate.decompress(body, self.MAX_FRAME)
+            if inflate.unconsumed_tail:
+                raise ValueError(f"Compressed frame inflates past the {self.MAX_FRAME} byte limit")
+        return self.loads(body)
+
+    def event_prefix(self, shared):
+        # A marshalled dict is its items followed by a '0' terminator
+        return self.dumps(shared)[:-1] + self.dumps("triggered")
+
+    def event_body(self, prefix, triggered):
+        return prefix + self.dumps(triggered) + b"0"
+
+    def batch_body(self, bodies):
+        return (
+            b"{" + self.dumps("type") + self.dumps("batch") + self.dumps("events")
+            + b"[" + struct.pack("<i", len(bodies)) + b"".join(bodies) + b"0"
+        )
+
+
+def is_loopback(addr):
+    '''
+    Whether a peer address (from 'peername') is on this machine.
+    '''
+    try:
+        return ipaddress.ip_address(addr[0]).is_loopback
+    except (TypeError, ValueError, IndexError):
+        return False
+
+
+def runtime_dir():
+    '''
+    A directory only this user can get into, so nobody else can put a socket
+    where plugins go looking for the hub. XDG_RUNTIME_DIR already is one.
+    '''
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if base and os.path.isdir(base):
+        return base
+    user = os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+    return os.path.join(tempfile.gettempdir(), f"fof-hub-{user}")
+
+
+def make_private_dir(path):
+    '''
+    Creates `path` (mode 0700) if needed, and refuses to use it if someone
+    else owns it or can get into it.
+    '''
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"{path} is not a directory")
+    if hasattr(os, "getuid") and (info.st_uid != os.getuid() or info.st_mode & 0o077):
+        raise PermissionError(f"{path} isn't private to this user")
+
+
+def default_socket_path(port):
+    # Derived from the TCP port so plugins can find it without extra config
+    return os.path.join(runtime_dir(), f"fof-hub-{port}.sock")
+
+
+def negotiate(request, ring_name=None, trusted=True):
+    '''
+    Picks the wire format for a client's 'hello' request. Returns the format
+    and the 'hello-response' to send back (in the old format). ring_name is
+    the shared memory log ring to offer, if the client can use one. Clients
+    that aren't trusted always get JSON.
+    '''
+    if request.get("framing") == "binary" and trusted:
+        wire = BinaryFrames(compress=bool(request.get("compress", False)))
+    else:
+        wire = JsonLines()
+    response = {"type": "hello-response", "framing": wire.name, "compress": getattr(wire, "compress", False)}
+    if request.get("ring") and ring_name is not None:
+        response["ring"] = ring_name
+    return wire, response
+
+
+class SharedEvent:
+    '''
+    An event payload whose common fields (everything but 'triggered') are
+    encoded once per wire format, no matter how many clients receive it.
+    If the line was written to the shared memory ring, clients reading from
+    the ring get its sequence number in place of the line itself.
+    '''
+    def __init__(self, shared, ring_seq=None):
+        self.shared = shared
+        self.ring_seq = ring_seq
+        self.prefixes = {}
+
+    @classmethod
+    def from_line(cls, text, loginfo, event=None, seq=None, ring_seq=None, server=None, origin=None, replay=False):
+        '''
+        Builds the shared part of an event packet for a processed line, so
+        live and replayed events look the same.
+        '''
+        shared = {"type": "event", "data": text, "loginfo": loginfo}
+        if event is not None:
+            shared["event"] = event[1]
+        if seq is not None:
+            shared["seq"] = seq
+        if server is not None:
+            shared["server"] = server
+        if origin is not None:
+            shared["origin"] = origin
+        if replay:
+            shared["replay"] = True
+        return cls(shared, ring_seq)
+
+    def body(self, wire, triggered, use_ring=False):
+        use_ring = use_ring and self.ring_seq is not None
+        key = (wire.name, use_ring)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            shared = self.shared
+            if use_ring:
+                shared = {k: v for k, v in shared.items() if k != "data"}
+                shared["ring"] = self.ring_seq
+            prefix = self.prefixes[key] = wire.event_prefix(shared)
+        return wire.event_body(prefix, triggered)
@@ -0,0 +1,44 @@
+import asyncio
+import unittest
+
+from scripts.client.fofclient import FofClient
+from tests.test_relay import FakeServer, Hub, until
+
+class ClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = FakeServer()
+        self.hub = Hub(self.server)
+        await self.hub.start()
+        self.client = FofClient(port=self.hub.port, transport="tcp", handler_queue_size=2)
+
+    async def asyncTearDown(self):
+        await self.client.disconnect()
+        await self.hub.stop()
+
+    async def test_full_handler_queue_drops_events(self):
+        client = self.client
+        handled = []
+
+        @client.on_event("kills")
+        async def on_kill(message):
+            # Needs the listener to keep reading to get its answer
+            handled.append(await client.get(["kills"], timeout=2))
+
+        await client.register_event("kills", match_="killed")
+        await client.connect()
+        # A round trip, so the registration is in before the lines
+        await client.get(["kills"])
+        for _ in range(20):
+            self.server.lines.put_nowait('"a<1><BOT><>" killed "b<2><BOT><>" with "arrow"')
+        await until(lambda: client.events_dropped and not client.handler_pending, timeout=1.5)
+        self.assertEqual(len(handled) + client.events_dropped, 20)
+
+    async def test_timed_out_request_leaves_outbox(self):
+        client = self.client
+        await client.store(["a"], 1)
+        with self.assertRaises(asyncio.TimeoutError):
+            await client.command("changelevel fof_depot", capture=True, timeout=0.05)
+        self.assertEqual([message["type"] for message in client.outbox], ["store"])
+        await client.connect()
+        self.assertEqual(await client.get(["a"]), 1)
+        self.assertFalse(client.outbox)
@@ -0,0 +1,117 @@
+import os
+import copy
+import time
+import random
+import tempfile
+import unittest
+
+from scripts.server.data_store import DataStore
+from scripts.server.store_files import StoreFiles
+
+class DataStoreFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.files.close()
+        self.directory.cleanup()
+
+    def open(self, **kwargs):
+        store = DataStore(files=StoreFiles(self.directory.name), **kwargs)
+        self.stores.append(store)
+        store.restore()
+        return store
+
+    def random_ops(self, rng, stores, count):
+        # The same random changes to every store, over enough top-level
+        # keys that some get evicted
+        for _ in range(count):
+            path = [f"key{rng.randrange(20)}", rng.choice(["a", "b", 1])]
+            if rng.random() < 0.5:
+                path.append(rng.choice(["x", "y"]))
+            op, payload = rng.random(), rng.choice([1, "text" * 10, {"n": [1, 2]}])
+            for store in stores:
+                if op < 0.5:
+                    store.store({"keys": path, "payload": copy.deepcopy(payload)})
+                elif op < 0.65:
+                    store.delete(path)
+                elif op < 0.8:
+                    try:
+                        store.incr(path + ["count"], 2)
+                    except TypeError:
+                        pass
+                else:
+                    try:
+                        store.extend(path + ["list"], ["item"], cap=3)
+                    except TypeError:
+                        pass
+
+    def test_restore_after_checkpoints_and_evictions(self):
+        rng = random.Random(0)
+        reference = DataStore()
+        store = self.open(memory_budget=2000)
+        for _ in range(3):
+            self.random_ops(random.Random(rng.random()), [reference, store], 300)
+            store.checkpoint()
+        self.assertTrue(store.evicted)
+        # And some only in the log
+        self.random_ops(rng, [reference, store], 100)
+        self.assertEqual(store.get([]), reference.get([]))
+
+        restored = self.open(memory_budget=2000)
+        self.assertEqual(restored.version, store.version)
+        self.assertEqual(restored.get([]), reference.get([]))
+        self.assertFalse(restored.evicted)
+        self.assertEqual(restored.memory()["total_bytes"], store.memory()["total_bytes"])
+
+    def test_logged_changes_in_snapshot_are_skipped(self):
+        store = self.open()
+        store.incr(["count"], 1)
+        with open(store.files.wal_path, "rb") as fp:
+            old_wal = fp.read()
+        store.checkpoint()
+        store.incr(["count"], 10)
+        # As if the hub went down before the old log was cleared
+        with open(store.files.wal_path, "rb") as fp:
+            new_wal = fp.read()
+        with open(store.files.wal_path, "wb") as fp:
+            fp.write(old_wal + new_wal)
+
+        restored = self.open()
+        self.assertEqual(restored.get(["count"]), 11)
+        self.assertEqual(restored.version, 2)
+
+    def test_ttls_survive_restart(self):
+        store = self.open()
+        store.store({"keys": ["short"], "payload": 1, "ttl": 0.2})
+        store.store({"keys": ["long"], "payload": 1, "ttl": 100})
+        store.checkpoint()
+        store.store({"keys": ["logged"], "payload": 1, "ttl": 0.2})
+        time.sleep(0.3)
+
+        restored = self.open()
+        self.assertEqual(sorted(restored.expire()), [["logged"], ["short"]])
+        self.assertEqual(restored.get(["long"]), 1)
+        self.assertGreater(restored.next_expiry(), 90)
+
+    def test_wal_full_hook(self):
+        calls = []
+        store = self.open(wal_max_bytes=200)
+        store.on_wal_full = lambda: calls.append(store.files.wal_bytes)
+        for i in range(20):
+            store.store({"keys": ["key", i], "payload": "x" * 20})
+        self.assertTrue(calls)
+        self.assertEqual(store.checkpoints, 0)
+
+        # Without a hook it checkpoints right away
+        store.on_wal_full = None
+        store.store({"keys": ["key", "last"], "payload": 1})
+        self.assertEqual(store.checkpoints, 1)
+        self.assertEqual(store.files.wal_bytes, 0)
+        self.assertTrue(os.path.exists(store.files.manifest_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
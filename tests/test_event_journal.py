@@ -0,0 +1,85 @@
+import os
+import time
+import tempfile
+import unittest
+
+from scripts.server.event_journal import EventJournal
+
+class EventJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journals = []
+
+    def tearDown(self):
+        for journal in self.journals:
+            journal.close()
+        self.directory.cleanup()
+
+    def open(self, **kwargs):
+        # Small segments, so a few hundred lines make several
+        journal = EventJournal(self.directory.name, segment_bytes=kwargs.pop("segment_bytes", 1000), **kwargs)
+        self.journals.append(journal)
+        return journal
+
+    def fill(self, journal, count):
+        return journal.append_batch([f"line {i}" for i in range(journal.seq + 1, journal.seq + 1 + count)])
+
+    def test_append_and_read(self):
+        journal = self.open()
+        self.assertEqual(self.fill(journal, 3), [1, 2, 3])
+        self.assertEqual(journal.append("line 4"), 4)
+        self.assertEqual(list(journal.read_from(2)), [(2, "line 2"), (3, "line 3"), (4, "line 4")])
+        self.assertEqual(list(journal.read_from(2, 3)), [(2, "line 2"), (3, "line 3")])
+        self.assertEqual(list(journal.read_from(5)), [])
+
+    def test_across_segments(self):
+        journal = self.open()
+        self.fill(journal, 300)
+        self.assertGreater(len(journal.segments), 3)
+        # Starting from every seq finds it through that segment's index
+        for seq in [1, 2, journal.segments[1] - 1, journal.segments[1], journal.segments[2] + 3, 299, 300]:
+            self.assertEqual([s for s, _ in journal.read_from(seq)], list(range(seq, 301)))
+        self.assertEqual(list(journal.read_from(journal.segments[1] - 1, journal.segments[1])),
+                         [(journal.segments[1] - 1, f"line {journal.segments[1] - 1}"), (journal.segments[1], f"line {journal.segments[1]}")])
+
+    def test_restart_keeps_counting(self):
+        journal = self.open()
+        self.fill(journal, 100)
+        journal.close()
+        # Half a record, like the hub went down mid-write
+        with open(journal._path(journal.segments[-1], "seg"), "ab") as fp:
+            fp.write(b"\x65\x00\x00")
+
+        journal = self.open()
+        self.assertEqual(journal.seq, 100)
+        self.assertEqual(self.fill(journal, 1), [101])
+        self.assertEqual([s for s, _ in journal.read_from(95)], [95, 96, 97, 98, 99, 100, 101])
+
+    def test_expire(self):
+        journal = self.open(max_age=60)
+        self.fill(journal, 300)
+        segments = list(journal.segments)
+        old = time.time() - 120
+        for first in segments[:2]:
+            os.utime(journal._path(first, "seg"), (old, old))
+        journal.expire()
+        self.assertEqual(journal.segments, segments[2:])
+        self.assertFalse(os.path.exists(journal._path(segments[0], "seg")))
+        self.assertFalse(os.path.exists(journal._path(segments[0], "idx")))
+
+        # Resuming from inside an expired segment starts at the oldest line left
+        self.assertEqual(next(journal.read_from(segments[0] + 1))[0], segments[2])
+        self.assertEqual(next(journal.read_from(segments[1] + 1))[0], segments[2])
+        self.assertEqual([s for s, _ in journal.read_from(segments[1])][-1], 300)
+
+    def test_current_segment_never_expires(self):
+        journal = self.open(max_age=60, segment_bytes=1 << 20)
+        self.fill(journal, 10)
+        old = time.time() - 120
+        os.utime(journal._path(journal.segments[0], "seg"), (old, old))
+        journal.expire()
+        self.assertEqual(len(list(journal.read_from(1))), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
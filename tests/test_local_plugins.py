@@ -0,0 +1,63 @@
+import asyncio
+import unittest
+
+from tests.test_relay import FakeServer, Hub, until
+
+KILL = '"a<1><BOT><>" killed "b<2><BOT><>" with "arrow"'
+
+class Plugin:
+    def __init__(self, handler):
+        self.handler = handler
+
+    async def start(self, client):
+        async def setup(client):
+            await client.register_event("kills", match_="killed")
+
+        client.on_connect(setup)
+        client.on_event("kills")(lambda message: self.handler(client, message))
+        await client.run()
+
+class LocalPluginsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = FakeServer()
+        self.hub = Hub(self.server)
+        await self.hub.start()
+
+    async def asyncTearDown(self):
+        await self.hub.handler.local_plugins.stop()
+        await self.hub.stop()
+
+    async def test_timeout_only_cancels_the_handler(self):
+        timed_out = []
+
+        async def on_kill(client, message):
+            try:
+                async with asyncio.timeout(0.01):
+                    await asyncio.sleep(1)
+            except TimeoutError:
+                timed_out.append(message["data"])
+
+        await self.hub.handler.local_plugins.add("sleepy", Plugin(on_kill))
+        self.server.lines.put_nowait(KILL)
+        await until(lambda: timed_out)
+        # The output pump is still going
+        self.server.lines.put_nowait(KILL)
+        await until(lambda: len(timed_out) == 2)
+        self.assertFalse(self.hub.pump.done())
+
+    async def test_gets_are_copies(self):
+        store = self.hub.handler.protocol.data_store
+        store.store({"keys": ["players", "a"], "payload": {"kills": 1}})
+        seen = []
+
+        async def on_kill(client, message):
+            record = await client.get(["players", "a"])
+            record["kills"] += 1
+            items, _ = await client.scan(["players"])
+            items[0][1]["kills"] += 1
+            seen.append(record)
+
+        await self.hub.handler.local_plugins.add("greedy", Plugin(on_kill))
+        self.server.lines.put_nowait(KILL)
+        await until(lambda: seen)
+        self.assertEqual(store.get(["players", "a"]), {"kills": 1})
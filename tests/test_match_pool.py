@@ -0,0 +1,40 @@
+import asyncio
+import unittest
+
+from scripts.server.match_pool import MatchPool
+
+KILL = 'L 01/01/2025 - 00:00:00: "a<1><[U:1:1]><>" killed "b<2><[U:1:2]><>" with "{}"'
+
+class MatchPoolTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Forked before the test's event loop is running
+        self.pool = MatchPool(workers=1)
+
+    async def asyncSetUp(self):
+        self.pool.start(asyncio.get_running_loop())
+        self.pool.register(("client", 1), {"registry": {"kills": {"match": "killed"}}})
+
+    async def asyncTearDown(self):
+        self.pool.close()
+
+    async def test_servers_sharing_a_worker(self):
+        # Enough matches that the results fill the pipe back while the
+        # other servers' lines are still going out
+        batches = [[KILL.format(f"arrow {i}") for i in range(5000)] for _ in range(3)]
+        results = await asyncio.wait_for(asyncio.gather(*(self.pool.process_lines(f"server{i}", lines) for i, lines in enumerate(batches))), 10)
+        self.assertEqual([len(result) for result in results], [5000] * 3)
+        self.assertEqual(len(self.pool.workers), 1)
+        self.assertEqual(set(self.pool.shards.values()), {0})
+
+    async def test_registrations_reach_the_worker(self):
+        self.pool.unregister(("client", 1), {"events": ["kills"]})
+        self.assertEqual(await self.pool.process_lines("server", [KILL.format("arrow")]), [])
+
+    async def test_lost_worker(self):
+        process = self.pool.workers[0][0]
+        process.terminate()
+        process.join()
+        # Matched locally once the worker is gone
+        results = await asyncio.wait_for(self.pool.process_lines("server", [KILL.format("arrow")]), 5)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(self.pool.workers, [])
@@ -0,0 +1,87 @@
+import copy
+import random
+import unittest
+
+from scripts.server.path_index import PathIndex
+
+def fresh(index):
+    # The same values with nothing cached yet
+    other = PathIndex()
+    other.set((), copy.deepcopy(index.root))
+    return other
+
+def scan_all(index, path, limit):
+    items, after = index.scan(path, limit)
+    while after is not None:
+        page, after = index.scan(path, limit, after)
+        items += page
+    return items
+
+class PathIndexTest(unittest.TestCase):
+    def test_paging(self):
+        index = PathIndex()
+        for i in range(250):
+            index.set(("players", f"p{i:03d}"), i)
+        items = scan_all(index, ("players",), 100)
+        self.assertEqual([key for key, _ in items], [f"p{i:03d}" for i in range(250)])
+
+        # Changes between pages show up in the next one
+        page, after = index.scan(("players",), 10)
+        index.set(("players", "p005a"), "new")
+        index.delete(("players", "p011"))
+        page, _ = index.scan(("players",), 3, after)
+        self.assertEqual([key for key, _ in page], ["p010", "p012", "p013"])
+        # Even after a key that's gone now
+        page, _ = index.scan(("players",), 1, "p011")
+        self.assertEqual(page, [["p012", 12]])
+
+    def test_mixed_keys(self):
+        index = PathIndex()
+        for key in ["b", 2, "a", 10, 1.5, True, "\0x"]:
+            index.set(("k", key), key)
+        keys = [key for key, _ in scan_all(index, ("k",), 2)]
+        self.assertEqual(sorted(map(repr, keys)), sorted(map(repr, index.get(("k",)))))
+        self.assertEqual(len(keys), 7)
+
+    def test_size_follows_changes(self):
+        index = PathIndex()
+        index.set(("players", "a"), {"kills": 1, "name": "A"})
+        index.set(("players", "b"), {"kills": 2, "name": "B"})
+        sizes = lambda: [index.size(path) for path in [(), ("players",), ("players", "a"), ("players", "a", "kills")]]
+        before = sizes()
+        self.assertEqual(before[0][1], 4)
+
+        steps = [
+            lambda: index.set(("players", "a", "kills"), 100000),
+            lambda: index.delete(("players", "b", "name")),
+            lambda: index.set(("players", "a"), "gone"),
+            lambda: index.set(("players", "a"), {"kills": {"today": 1, "total": 5}}),
+            lambda: index.set(("players", "a", "kills", "today", "deep"), 1),
+            lambda: index.delete(("players", "b")),
+        ]
+        for step in steps:
+            step()
+            self.assertEqual(sizes(), [fresh(index).size(path) for path in [(), ("players",), ("players", "a"), ("players", "a", "kills")]])
+        self.assertNotEqual(sizes(), before)
+
+    def test_random_changes(self):
+        rng = random.Random(0)
+        index = PathIndex()
+        keys = ["a", "b", 1, 2]
+        for _ in range(3000):
+            path = tuple(rng.choice(keys) for _ in range(rng.randint(1, 3)))
+            roll = rng.random()
+            if roll < 0.5:
+                index.set(path, rng.choice([1, "x", {}, {"a": 1, "b": {"c": 2}}]))
+            elif roll < 0.7:
+                index.delete(path, keep_parent=rng.random() < 0.5)
+            elif roll < 0.85:
+                prefix = path[:-1]
+                self.assertEqual(scan_all(index, prefix, 2), scan_all(fresh(index), prefix, 2), prefix)
+            else:
+                self.assertEqual(index.size(path), fresh(index).size(path), path)
+                self.assertEqual(index.size(()), fresh(index).size(()))
+
+
+if __name__ == "__main__":
+    unittest.main()
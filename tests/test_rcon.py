@@ -0,0 +1,131 @@
+import time
+import struct
+import asyncio
+import unittest
+
+from scripts.server.rcon_pool import RconPool, RconNotSent, RconAuthError, RconConnection
+from scripts.server.fof_server_wrapper import FofServerWrapper
+
+class FakeSrcds:
+    '''
+    Just enough of a Source RCON server: checks the password, answers
+    `echo <text>` with the text, never answers `hang`, and mirrors the empty
+    terminator packet back like srcds does.
+    '''
+    def __init__(self, password="secret"):
+        self.password = password
+        self.received = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def packet(self, id_, type_, body):
+        data = body.encode() + b"\x00\x00"
+        return struct.pack("<iii", len(data) + 8, id_, type_) + data
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                size = struct.unpack("<i", await reader.readexactly(4))[0]
+                data = await reader.readexactly(size)
+                id_, type_ = struct.unpack_from("<ii", data)
+                body = data[8:-2].decode()
+                if type_ == 3:
+                    writer.write(self.packet(0, 0, "") + self.packet(id_ if body == self.password else -1, 2, ""))
+                elif type_ == 2:
+                    self.received.append((time.monotonic(), body))
+                    if body.startswith("echo "):
+                        writer.write(self.packet(id_, 0, body[5:] + "\n"))
+                elif type_ == 0 and self.received and self.received[-1][1] != "hang":
+                    writer.write(self.packet(id_, 0, "") + self.packet(id_, 0, "\x00\x01"))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+
+class FakeConsole:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, command, capture=False):
+        self.submitted.append(command)
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+
+class RconTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.srcds = FakeSrcds()
+        await self.srcds.start()
+
+    async def asyncTearDown(self):
+        await self.srcds.stop()
+
+    def wrapper(self, port=None, password="secret", rate=0):
+        wrapper = FofServerWrapper(None, command_rate=rate, command_timeout=0.3, rcon_addr="127.0.0.1",
+                                   rcon_port=port or self.srcds.port, rcon_password=password)
+        wrapper.commands = FakeConsole()
+        return wrapper
+
+    async def test_output(self):
+        wrapper = self.wrapper()
+        self.assertEqual(await wrapper.command("echo hi", capture=True), ["hi"])
+        self.assertEqual(await wrapper.command("echo a"), None)
+        await wrapper.rcon.close()
+
+    async def test_sent_command_not_sent_again(self):
+        wrapper = self.wrapper()
+        with self.assertRaises(asyncio.TimeoutError):
+            await wrapper.command("hang")
+        self.assertEqual(wrapper.commands.submitted, [])
+        self.assertEqual([body for _, body in self.srcds.received], ["hang"])
+        # Nothing is left waiting on an answer that isn't coming
+        connection = wrapper.rcon.connections[0]
+        self.assertEqual((connection.pending, connection.terminators), ({}, {}))
+        await wrapper.rcon.close()
+
+    async def test_unsent_command_uses_console(self):
+        wrapper = self.wrapper(password="wrong")
+        await wrapper.command("say hi")
+        self.assertEqual(wrapper.commands.submitted, ["say hi"])
+        self.assertEqual(self.srcds.received, [])
+
+        # Nothing listening at all
+        await self.srcds.stop()
+        wrapper = self.wrapper()
+        await wrapper.command("say there")
+        self.assertEqual(wrapper.commands.submitted, ["say there"])
+        await self.srcds.start()
+
+    async def test_rate(self):
+        pool = RconPool("127.0.0.1", self.srcds.port, "secret", timeout=1, rate=20)
+        await asyncio.gather(*(pool.execute(f"echo {i}") for i in range(5)))
+        times = [at for at, _ in self.srcds.received]
+        self.assertGreaterEqual(times[-1] - times[0], 4 * 0.05 * 0.9)
+        await pool.close()
+
+    async def test_not_sent_is_an_rcon_error(self):
+        pool = RconPool("127.0.0.1", self.srcds.port, "wrong", timeout=1)
+        with self.assertRaises(RconAuthError):
+            await pool.execute("echo x")
+        self.assertEqual(pool.reconnects, 0)
+        await pool.close()
+
+    async def test_too_long_counts_bytes(self):
+        pool = RconPool("127.0.0.1", self.srcds.port, "secret", timeout=1)
+        # Short enough in characters, not in bytes
+        command = "say " + "é" * (RconConnection.MAX_BODY // 2)
+        with self.assertRaises(RconNotSent):
+            await pool.execute(command)
+        self.assertEqual(self.srcds.received, [])
+        await pool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from scripts.server.fof_server_event_handler import FofServerEventHandler
+from scripts.server.relay import RelayLink
+from scripts.client.fofclient import FofClient
+
+class FakeServer:
+    '''
+    Stands in for a game server: lines are put in by hand.
+    '''
+    def __init__(self):
+        self.lines = asyncio.Queue()
+
+    async def start(self): pass
+    async def shutdown(self): pass
+    def stats(self): return {}
+
+    async def read_batches(self):
+        while True:
+            batch = [await self.lines.get()]
+            while not self.lines.empty():
+                batch.append(self.lines.get_nowait())
+            yield batch
+
+
+async def until(check, timeout=5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not check():
+        if loop.time() > deadline:
+            raise AssertionError("Timed out")
+        await asyncio.sleep(0.01)
+
+
+class Hub:
+    '''
+    The socket side of a hub, plus the log pump if it has a server.
+    '''
+    def __init__(self, server, token=None):
+        self.server = server
+        self.token = token
+        self.handler = FofServerEventHandler(server if server is not None else {}, "127.0.0.1", 0, unix_socket="", relay_token=token)
+        self.pump = None
+        self.link = None
+
+    async def start(self):
+        self.handler.stop_event = asyncio.Event()
+        self.handler.running = 1
+        self.handler.match_pool.start(asyncio.get_running_loop())
+        self.tcp = await asyncio.start_server(self.handler.protocol.handle_client, "127.0.0.1", 0)
+        self.port = self.tcp.sockets[0].getsockname()[1]
+        if self.server is not None:
+            self.pump = asyncio.create_task(self.handler.dispatch_log_events(None, self.server))
+
+    def relay_to(self, upstream, token, registry):
+        self.link = RelayLink(self.handler.protocol, "127.0.0.1", upstream.port, "box1", registry, token=token, window_ms=0, reconnect_delay=0.05)
+        self.link.start()
+
+    async def stop(self):
+        if self.pump is not None:
+            self.pump.cancel()
+        if self.link is not None:
+            await self.link.wait_closed()
+        self.tcp.close()
+        for client in list(self.handler.protocol.clients.values()):
+            await client.wait_closed()
+        await self.tcp.wait_closed()
+        self.handler.match_pool.close()
+
+
+class RelayTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = FakeServer()
+        self.box = Hub(self.server)
+        self.aggregator = Hub(None, token="secret")
+        await self.box.start()
+        await self.aggregator.start()
+        self.clients = []
+
+    async def asyncTearDown(self):
+        for client in self.clients:
+            await client.disconnect()
+        await self.box.stop()
+        await self.aggregator.stop()
+
+    async def plugin(self, **kwargs):
+        client = FofClient(port=self.aggregator.port, transport="tcp", **kwargs)
+        self.clients.append(client)
+        received = []
+
+        @client.on_event("kills")
+        async def on_kill(message):
+            received.append(message)
+
+        await client.register_event("kills", match_="killed")
+        await client.connect()
+        return client, received
+
+    async def test_relayed_events(self):
+        client, received = await self.plugin()
+        self.box.relay_to(self.aggregator, "secret", {"kills": {"match": "killed"}})
+        await until(lambda: self.aggregator.handler.protocol.links.get("box1", {}).get("connected"))
+        self.server.lines.put_nowait('"a<1><BOT><>" killed "b<2><BOT><>" with "arrow"')
+        self.server.lines.put_nowait('"a<1><BOT><>" say "hi"')
+        await until(lambda: received)
+        self.assertEqual(received[0]["origin"], "box1")
+        self.assertIn("killed", received[0]["data"])
+        self.assertEqual(client.wire.name, "binary")
+
+    async def test_bad_token(self):
+        self.box.relay_to(self.aggregator, "wrong", {"kills": {"match": "killed"}})
+        await until(lambda: self.box.link.reconnects >= 2)
+        self.assertEqual(self.aggregator.handler.protocol.links, {})
+
+    async def test_no_token_no_relays(self):
+        self.aggregator.handler.protocol.relay_token = None
+        self.box.relay_to(self.aggregator, "secret", {"kills": {"match": "killed"}})
+        await until(lambda: self.box.link.reconnects >= 2)
+        self.assertEqual(self.aggregator.handler.protocol.links, {})
+
+    def test_relay_needs_token(self):
+        with self.assertRaises(ValueError):
+            RelayLink(self.box.handler.protocol, "127.0.0.1", 1, "box1", {}, token=None)
+
+    async def test_off_machine_clients_need_token(self):
+        with mock.patch("scripts.server.client_connection.is_loopback", return_value=False):
+            client, _ = await self.plugin()
+            # Turned away at the register, and JSON only until then
+            self.assertEqual(client.wire.name, "json")
+            await until(lambda: not self.aggregator.handler.protocol.clients)
+
+            client, _ = await self.plugin(token="wrong")
+            await until(lambda: not self.aggregator.handler.protocol.clients)
+
+            client, _ = await self.plugin(token="secret")
+            self.assertEqual(client.wire.name, "binary")
+            self.assertEqual((await client.request({"type": "ping"}))["type"], "pong")
+
+
+if __name__ == "__main__":
+    unittest.main()
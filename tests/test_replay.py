@@ -0,0 +1,83 @@
+import asyncio
+import tempfile
+import unittest
+
+from scripts.server.protocol import FofServerProtocol
+from scripts.server.event_engine import EventEngine
+from scripts.server.event_journal import EventJournal
+from scripts.server.client_connection import ClientConnection
+from scripts.server.data_store import DataStore
+from scripts.server.wire import SharedEvent
+from tests.test_relay import until
+
+KILL = '"a<1><BOT><>" killed "b<2><BOT><>" with "arrow"'
+
+class StuckWriter:
+    '''
+    A client socket nobody reads: the first write goes out, and the drain
+    after it never finishes.
+    '''
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    async def drain(self):
+        await asyncio.Event().wait()
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+class ReplayTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = EventJournal(self.directory.name)
+        self.journal.append_batch([KILL] * 5000)
+        self.protocol = FofServerProtocol(EventEngine(), DataStore(), None)
+        self.protocol.journals = {None: self.journal}
+        self.clients = []
+
+    async def asyncTearDown(self):
+        for client in self.clients:
+            if client.replay_task is not None:
+                client.replay_task.cancel()
+            await client.wait_closed()
+        self.journal.close()
+        self.directory.cleanup()
+
+    def resume(self, overflow):
+        client = ClientConnection(("10.0.0.2", 5000), StuckWriter(), max_queue=10, overflow=overflow)
+        self.clients.append(client)
+        self.protocol.register({"registry": {"kills": {"match": "killed"}}, "resume_from": 0}, client)
+        return client
+
+    def live(self, client, count):
+        for _ in range(count):
+            seq = self.journal.append(KILL)
+            client.send_event(SharedEvent.from_line(KILL, "", seq=seq), ["kills"])
+
+    async def test_held_events_drop_oldest(self):
+        client = self.resume("drop_oldest")
+        self.live(client, 50)
+        self.assertEqual(len(client.held_events), 10)
+        self.assertEqual(client.held_events[0][0].shared["seq"], 5041)
+        self.assertEqual(client.dropped, 40)
+
+    async def test_held_events_disconnect(self):
+        client = self.resume("disconnect")
+        self.live(client, 11)
+        self.assertTrue(client.closed)
+        self.assertTrue(client.writer.closed)
+
+    async def test_replay_times_out(self):
+        self.protocol.REPLAY_TIMEOUT = 0.2
+        client = self.resume("drop_oldest")
+        await until(lambda: client.replay_task is None)
+        self.assertTrue(client.closed)
+        self.assertFalse(client.holding)
+        self.assertEqual(len(client.held_events), 0)
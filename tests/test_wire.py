@@ -0,0 +1,78 @@
+import json
+import zlib
+import asyncio
+import marshal
+import unittest
+
+from scripts.server.wire import JsonLines, BinaryFrames, SharedEvent, negotiate
+
+class SplicedBodiesTest(unittest.TestCase):
+    '''
+    Event and batch bodies are put together from separately encoded pieces,
+    so they have to decode to the same thing as encoding the whole message.
+    '''
+    SHARED = {"type": "event", "data": "L 01/01/2025 - 00:00:00: \"a<1><BOT><>\" say \"é\"", "loginfo": "", "event": "on_say",
+              "seq": 2 ** 40, "server": "box1", "replay": True}
+    TRIGGERED = [["on_say", {"name": "a", "text": "é", "n": 1.5, "tags": ("x", None)}], ["other", []]]
+
+    def check(self, wire, decode):
+        event = SharedEvent(dict(self.SHARED))
+        body = event.body(wire, self.TRIGGERED)
+        self.assertEqual(decode(body), decode(wire.dumps(dict(self.SHARED, triggered=self.TRIGGERED))))
+
+        bodies = [event.body(wire, [[f"event_{i}", {}]]) for i in range(3)]
+        batch = decode(wire.batch_body(bodies))
+        self.assertEqual(batch["type"], "batch")
+        self.assertEqual([e["triggered"] for e in batch["events"]], [[[f"event_{i}", {}]] for i in range(3)])
+        self.assertEqual(decode(wire.batch_body([])), {"type": "batch", "events": []})
+
+    def test_binary(self):
+        self.check(BinaryFrames(), marshal.loads)
+
+    def test_json(self):
+        self.check(JsonLines(), json.loads)
+
+    def test_ring_body(self):
+        wire = BinaryFrames()
+        body = marshal.loads(SharedEvent(dict(self.SHARED), ring_seq=7).body(wire, [], use_ring=True))
+        self.assertNotIn("data", body)
+        self.assertEqual(body["ring"], 7)
+
+
+class FramesTest(unittest.TestCase):
+    def read(self, wire, data):
+        async def read():
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return [await wire.read(reader), await wire.read(reader)]
+        return asyncio.run(read())
+
+    def test_compressed_round_trip(self):
+        wire = BinaryFrames(compress=True)
+        message = {"type": "get-response", "payload": {"x": "y" * 10000}}
+        frame = wire.frame(wire.dumps(message))
+        self.assertTrue(BinaryFrames.HEADER.unpack(frame[:4])[0] & BinaryFrames.COMPRESSED)
+        self.assertEqual(self.read(wire, frame), [message, None])
+
+    def test_oversized_frame(self):
+        wire = BinaryFrames()
+        with self.assertRaises(ValueError):
+            self.read(wire, BinaryFrames.HEADER.pack(BinaryFrames.MAX_FRAME + 1))
+
+    def test_compressed_frame_limit(self):
+        wire = BinaryFrames(compress=True)
+        wire.MAX_FRAME = 4096
+        body = zlib.compress(b"\0" * 100000)
+        with self.assertRaises(ValueError):
+            self.read(wire, BinaryFrames.HEADER.pack(len(body) | BinaryFrames.COMPRESSED) + body)
+
+    def test_untrusted_gets_json(self):
+        wire, response = negotiate({"framing": "binary"}, trusted=False)
+        self.assertEqual((wire.name, response["framing"]), ("json", "json"))
+        wire, response = negotiate({"framing": "binary", "compress": True})
+        self.assertEqual((wire.name, response["compress"]), ("binary", True))
+
+
+if __name__ == "__main__":
+    unittest.main()